@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Times count_retransmissions.py and plotting/plot_scan_data.py on synthetic
+# data of configurable size.  Every benchmark runs in a fresh process, so the
+# reported peak RSS belongs to that benchmark alone.  Results are written as
+# JSON together with the current commit, so runs can be compared with
+# --compare.
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "plotting"))
+
+def get_peak_rss( ):
+    """
+    Return the peak resident set size of this process in KiB.
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_parse( file_name ):
+
+    import count_retransmissions
+
+    started = time.time()
+    segments = sum(1 for _ in count_retransmissions.read_segments(file_name))
+
+    return (segments, time.time() - started)
+
+def bench_extract( file_name ):
+
+    import count_retransmissions
+
+    started = time.time()
+    tables = count_retransmissions.extract_connections(
+                count_retransmissions.read_segments(file_name))
+
+    return (sum([len(table) for table in tables.values()]),
+            time.time() - started)
+
+def bench_verdict( file_name ):
+
+    import count_retransmissions
+
+    tables = count_retransmissions.extract_connections(
+                count_retransmissions.read_segments(file_name))
+
+    started = time.time()
+    count_retransmissions.analyse_targets(file_name, tables, verbose=False)
+
+    return (len(tables), time.time() - started)
+
+def bench_idle_parse( file_name ):
+
+    import plot_scan_data
+    logging.getLogger().setLevel(logging.WARNING)
+
+    started = time.time()
+    scans = plot_scan_data.parse_file(file_name)
+
+    return (len(scans), time.time() - started)
+
+def bench_idle_table( file_name ):
+
+    import plot_scan_data
+    logging.getLogger().setLevel(logging.WARNING)
+
+    started = time.time()
+    table = plot_scan_data.load_table(file_name)
+    table.filter(region="CN_R7", hour=3, machine_type="Tor_Dir")
+
+    return (len(table), time.time() - started)
+
+def bench_map( file_name ):
+
+    import plot_scan_data
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scans = plot_scan_data.parse_file(file_name)
+    output = file_name + ".html"
+
+    started = time.time()
+    plot_scan_data.print_map(scans, output)
+    elapsed = time.time() - started
+
+    os.remove(output)
+
+    return (len(scans), elapsed)
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "extract": bench_extract,
+    "verdict": bench_verdict,
+    "idle_parse": bench_idle_parse,
+    "idle_table": bench_idle_table,
+    "map": bench_map,
+}
+
+def run_benchmark( name, file_name ):
+    """
+    Run a single benchmark.  This is executed in a fresh worker process.
+    """
+
+    items, seconds = BENCHMARKS[name](file_name)
+
+    return (items, seconds, get_peak_rss())
+
+def run_isolated( func, *args ):
+    """
+    Run the given function in a fresh process and return its result.
+    """
+
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+def get_commit( ):
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def generate_data( directory, targets, lines ):
+    """
+    Write the synthetic data sets and return a list of (benchmark, size, file
+    name) tuples.
+    """
+
+    cases = []
+
+    for count in targets:
+        file_name = os.path.join(directory, "%d_synscan.pcap" % count)
+        run_isolated(synthetic.write_scan_pcap, file_name, count)
+        cases.extend([(name, count, file_name)
+                      for name in ("parse", "extract", "verdict")])
+
+    for count in lines:
+        file_name = os.path.join(directory, "%d_idle_scans.txt" % count)
+        run_isolated(synthetic.write_idle_scans, file_name, count)
+        cases.extend([(name, count, file_name)
+                      for name in ("idle_parse", "idle_table", "map")])
+
+    return cases
+
+def run_benchmarks( cases, repeat ):
+
+    results = []
+
+    for name, size, file_name in cases:
+
+        runs = [run_isolated(run_benchmark, name, file_name)
+                for _ in xrange(repeat)]
+        items, seconds, peak_rss = min(runs, key=lambda run: run[1])
+
+        results.append({"benchmark": name,
+                        "size": size,
+                        "items": items,
+                        "seconds": seconds,
+                        "items_per_second": items / seconds if seconds else 0,
+                        "file_bytes": os.path.getsize(file_name),
+                        "peak_rss_kib": max([run[2] for run in runs])})
+
+        print "%-10s %9d %10d items %9.4fs %12.0f items/s %9d KiB" % \
+              (name, size, items, seconds, results[-1]["items_per_second"],
+               results[-1]["peak_rss_kib"])
+
+    return results
+
+def compare( old_file, new_results ):
+    """
+    Print the speedup of every benchmark relative to an earlier run.
+    """
+
+    with open(old_file) as fd:
+        old = json.load(fd)
+
+    old_results = dict(((result["benchmark"], result["size"]), result)
+                       for result in old["results"])
+
+    print "\nCompared to commit %s:" % old["commit"]
+    for result in new_results:
+        key = (result["benchmark"], result["size"])
+        if not old_results.has_key(key) or not result["seconds"]:
+            continue
+        print "%-10s %9d %6.2fx faster, %+d KiB peak RSS" % \
+              (key[0], key[1], old_results[key]["seconds"] / result["seconds"],
+               result["peak_rss_kib"] - old_results[key]["peak_rss_kib"])
+
+def parse_arguments( ):
+
+    parser = argparse.ArgumentParser(description="Benchmark the analysis of "
+                                     "backlog scan captures and idle scan "
+                                     "files.")
+
+    parser.add_argument("-t", "--targets", metavar="NUM", type=str,
+                        default="1,10,100",
+                        help="Comma-separated numbers of scanned targets per "
+                             "synthetic capture (145 SYNs each).")
+
+    parser.add_argument("-l", "--lines", metavar="NUM", type=str,
+                        default="1000,10000,100000",
+                        help="Comma-separated line counts of the synthetic "
+                             "idle scan files.")
+
+    parser.add_argument("-r", "--repeat", metavar="NUM", type=int, default=3,
+                        help="Run every benchmark this often and report the "
+                             "fastest run.")
+
+    parser.add_argument("-o", "--output", metavar="OUTPUT_FILE", type=str,
+                        default="benchmark_results.json",
+                        help="Where to write the results to.")
+
+    parser.add_argument("-c", "--compare", metavar="RESULTS_FILE", type=str,
+                        default=None,
+                        help="Compare against the results of an earlier run.")
+
+    parser.add_argument("-d", "--directory", metavar="DATA_DIR", type=str,
+                        default=None,
+                        help="Keep the synthetic data in the given directory "
+                             "instead of a temporary one.")
+
+    return parser.parse_args()
+
+def main( ):
+
+    args = parse_arguments()
+
+    directory = args.directory or tempfile.mkdtemp(prefix="backlogscans-")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    try:
+        cases = generate_data(directory,
+                              [int(num) for num in args.targets.split(",")],
+                              [int(num) for num in args.lines.split(",")])
+        results = run_benchmarks(cases, args.repeat)
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory)
+
+    with open(args.output, "w") as fd:
+        json.dump({"commit": get_commit(),
+                   "date": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+                   "results": results}, fd, indent=4, sort_keys=True,
+                  separators=(",", ": "))
+
+    if args.compare:
+        compare(args.compare, results)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Generates synthetic data which resembles what synscan.sh and rstscan.sh
+# capture as well as idle scan files as read by plotting/plot_scan_data.py.
+
+import sys
+import socket
+import struct
+import random
+import argparse
+
+# Time windows of the initial SYN/ACK and its five retransmissions.
+BACKOFF_MODEL = ((0, 1.125), (1, 2.27), (3, 4.5), (7, 9), (15, 17), (31, 33))
+
+SYN = 0x02
+RST = 0x04
+SYN_ACK = 0x12
+
+REGIONS = ["CN_R%d" % i for i in xrange(1, 10)] + ["US", "DE", "SE", "RU"]
+MACHINE_TYPES = ["Tor_Relay", "Tor_Dir", "Web_Server", "GIP"]
+
+def pack_segment( ts, src, dst, sport, dport, seq, ack, flags ):
+    """
+    Return a pcap record holding a Linux cooked frame with the given TCP
+    segment, as written by `tcpdump -i any'.
+    """
+
+    tcp = struct.pack("!HHIIBBHHH", sport, dport, seq, ack, 5 << 4, flags,
+                      29200, 0, 0)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(tcp), 0, 0x4000, 64,
+                     6, 0, socket.inet_aton(src), socket.inet_aton(dst))
+    sll = struct.pack("!HHH8sH", 4, 1, 6, b"\0" * 8, 0x0800)
+
+    frame = sll + ip + tcp
+
+    sec, usec = divmod(int(round(ts * 1e6)), 1000000)
+
+    return struct.pack("<IIII", sec, usec, len(frame), len(frame)) + frame
+
+def generate_scan( syns=145, scan_synacks=6, control_syns=10,
+                   control_synacks=3, noise=0.1, rsts=False, seed=0,
+                   prober="10.0.0.1", target=("192.0.2.1", 443),
+                   start=1400000000.0 ):
+    """
+    Return a time-sorted list of (timestamp, pcap record) tuples of a single
+    backlog scan.
+
+    `syns' SYNs are sent every 13 ms and receive `scan_synacks' SYN/ACKs each.
+    Two seconds later, `control_syns' SYNs follow which receive
+    `control_synacks' SYN/ACKs.  SYN/ACK retransmissions follow the backoff
+    model with jitter.  `noise' is the ratio of unsolicited SYN/ACKs to SYNs.
+    If `rsts' is set, the prober resets every scan SYN like rstscan.sh does.
+    """
+
+    rand = random.Random(seed)
+    dst, dport = target
+    records = []
+
+    def add( ts, *args ):
+        records.append((ts, pack_segment(ts, *args)))
+
+    def add_connection( ts, sport, seq, synacks ):
+        add(ts, prober, dst, sport, dport, seq, 0, SYN)
+        isn = rand.randint(0, 2 ** 32 - 1)
+        for lower, upper in BACKOFF_MODEL[:synacks]:
+            offset = rand.uniform(lower + 0.05, min(upper, lower + 0.5))
+            add(ts + offset, dst, prober, dport, sport, isn, seq + 1, SYN_ACK)
+
+    for i in xrange(syns):
+        ts = start + i * 0.013
+        add_connection(ts, 30000 + i, 1000000 + i, scan_synacks)
+        if rsts:
+            add(ts + 2, prober, dst, 30000 + i, dport, 1000001 + i, 0, RST)
+
+    for i in xrange(control_syns):
+        ts = start + 2 + syns * 0.013 + i * 0.0013
+        add_connection(ts, 20000 + i, rand.randint(0, 2 ** 32 - 1),
+                       control_synacks)
+
+    for _ in xrange(int(syns * noise)):
+        add(start + rand.uniform(0, 65), dst, prober, dport,
+            rand.randint(1024, 65535), rand.randint(0, 2 ** 32 - 1),
+            rand.randint(0, 2 ** 32 - 1), SYN_ACK)
+
+    records.sort()
+
+    return records
+
+def write_pcap( file_name, records ):
+    """
+    Write the given (timestamp, pcap record) tuples to a pcap file.
+    """
+
+    with open(file_name, "wb") as fd:
+        # Microsecond resolution, snap length 262144, LINKTYPE_LINUX_SLL.
+        fd.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 262144, 113))
+        for _, record in records:
+            fd.write(record)
+
+def write_scan_pcap( file_name, targets=1, **kwargs ):
+    """
+    Write a capture of backlog scans to the given number of targets.  All
+    other arguments are passed to generate_scan().
+    """
+
+    seed = kwargs.pop("seed", 0)
+    records = []
+    for i in xrange(targets):
+        target = ("192.0.%d.%d" % (2 + i / 254, 1 + i % 254), 443)
+        records.extend(generate_scan(target=target, seed=seed + i, **kwargs))
+    records.sort()
+
+    write_pcap(file_name, records)
+
+def write_idle_scans( file_name, lines, machines=10000, seed=0 ):
+    """
+    Write an idle scan file as expected by plot_scan_data.parse_file().  Every
+    line has the format: verdict src_ip src_lat src_lon dst_ip dst_lat
+    dst_lon src_region src_type dst_region dst_type hour
+    """
+
+    rand = random.Random(seed)
+
+    hosts = []
+    for _ in xrange(machines):
+        hosts.append("%s %.5f %.5f" % (socket.inet_ntoa(struct.pack("!I",
+                                       rand.randint(0x01000000, 0xdfffffff))),
+                                       rand.uniform(-60, 70),
+                                       rand.uniform(-180, 180)))
+    tags = [(rand.choice(REGIONS), rand.choice(MACHINE_TYPES))
+            for _ in xrange(machines)]
+
+    with open(file_name, "w") as fd:
+        for _ in xrange(lines):
+            src = rand.randrange(machines)
+            dst = rand.randrange(machines)
+            fd.write("%d %s %s %s %s %s %s %d\n" % (rand.randint(0, 3),
+                                                     hosts[src], hosts[dst],
+                                                     tags[src][0], tags[src][1],
+                                                     tags[dst][0], tags[dst][1],
+                                                     rand.randint(0, 23)))
+
+def parse_arguments( ):
+
+    parser = argparse.ArgumentParser(description="Generate synthetic backlog "
+                                     "scan captures and idle scan files.")
+
+    parser.add_argument("output", metavar="OUTPUT_FILE",
+                        help="Where to write the generated data to.")
+
+    parser.add_argument("-i", "--idle-scans", metavar="LINES", type=int,
+                        default=None,
+                        help="Write an idle scan file with the given number "
+                             "of lines instead of a capture.")
+
+    parser.add_argument("-n", "--syns", metavar="NUM", type=int, default=145,
+                        help="Number of scan SYNs per target.")
+
+    parser.add_argument("-t", "--targets", metavar="NUM", type=int, default=1,
+                        help="Number of scanned targets in the capture.")
+
+    parser.add_argument("-s", "--synacks", metavar="NUM", type=int, default=6,
+                        help="SYN/ACKs per scan SYN.  Fewer than 4 mimic a "
+                             "full backlog.")
+
+    parser.add_argument("-r", "--rsts", action="store_true",
+                        help="Mimic rstscan.sh by resetting every scan SYN.")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+
+    if args.idle_scans is not None:
+        write_idle_scans(args.output, args.idle_scans)
+    else:
+        write_scan_pcap(args.output, args.targets, syns=args.syns,
+                        scan_synacks=args.synacks, rsts=args.rsts)
+
+    sys.exit(0)
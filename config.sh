@@ -7,3 +7,8 @@ prober_type="censored"
 
 # The (spoofed) IP address of the censored machine behind the GFW.
 spoofed_addr=""
+
+# Set to "yes" to shorten every SYN and RST scan from 65s to the time it takes
+# the last SYN/ACK retransmission of our last segment to arrive (see scan.sh).
+# Both probers must use the same setting to stay in sync.
+early_stop="no"
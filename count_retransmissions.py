@@ -4,73 +4,358 @@
 #
 # Reads the given .pcap file and determines the subsequent SYN/ACK
 # retransmissions after a SYN segment was sent to a service.
+#
+# Importing scapy takes longer than analysing a typical capture, so scapy is
+# only imported once a capture turns out to need it.
 
+import os
 import sys
+import csv
+import json
+import time
+import array
+import argparse
+import collections
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import pcap_reader
+import result_cache
+from instrumentation import Stats, NO_STATS
+
+# Time windows (in seconds after the SYN) in which the initial SYN/ACK and its
+# retransmissions arrive if the destination uses Linux's default of
+# tcp_synack_retries = 5.
+BACKOFF_MODEL = ((0, 1.125), (1, 2.27), (3, 4.5), (7, 9), (15, 17), (31, 33))
+
+# Time between backlog scan and backlog size estimation.
+TIME_THRESHOLD = 1.5
+
+# Below this mean number of SYN/ACKs per SYN, the backlog was full.
+MEAN_THRESHOLD = 3.5
+
+# A full backlog also requires at least one SYN of the backlog scan which
+# received exactly this many SYN/ACKs.
+REQUIRED_SYNACKS = 3
+
+# Everything the verdict depends on, apart from the capture itself.
+Parameters = collections.namedtuple("Parameters", ["backoff_model",
+                                                   "time_threshold",
+                                                   "mean_threshold",
+                                                   "required_synacks"])
+
+DEFAULT_PARAMETERS = Parameters(BACKOFF_MODEL, TIME_THRESHOLD, MEAN_THRESHOLD,
+                                REQUIRED_SYNACKS)
+
+# File name suffixes of the captures written by synscan.sh and rstscan.sh.
+CAPTURE_SUFFIXES = tuple(name + suffix
+                         for name in ("_synscan.pcap", "_rstscan.pcap")
+                         for suffix in ("",) + pcap_reader.COMPRESSED_SUFFIXES)
+
+# Columns of the verdict table written by --batch and --worker.
+TABLE_HEADER = ["host", "port", "scan_type", "verdict", "syn_ack_mean",
+                "orig_retrans", "scan_retrans", "file"]
+
+# Exit codes of the follow mode.  A timeout(1)-imposed deadline yields 124.
+FOLLOW_EXIT_CODES = {
+    "!SYN": 0, # No drop.
+    "RST": 0,  # No drop.
+    "SYN": 2,  # SYN/ACKs are dropped.
+    "!RST": 2, # RSTs are dropped.
+    "ERR": 3   # Machine was probably offline.
+}
+
+# The outcome of analysing a single .pcap file.
+Result = collections.namedtuple("Result", ["file_name", "target", "scan_type",
+                                           "verdict", "syn_ack_mean",
+                                           "orig_retrans", "scan_retrans",
+                                           "backoff_ok"])
+
+def to_ndarray( values ):
+    """
+    Return a NumPy view of the given array.array without copying it.
+    """
 
-from scapy.all import *
-from scapy.utils import rdpcap
+    if not len(values):
+        return numpy.zeros(0, dtype=values.typecode)
+
+    return numpy.frombuffer(values, dtype=values.typecode)
+
+def argsort( values ):
+    """
+    Return the indices which (stably) sort the given array.array.
+    """
+
+    if numpy is None:
+        return sorted(xrange(len(values)), key=values.__getitem__)
+
+    return to_ndarray(values).argsort(kind="mergesort")
 
 class Connection( object ):
 
     """
-    Represents a TCP connection attempt.
+    Represents a TCP connection attempt.  This is a read-only view of a row in
+    a ConnectionTable.
     """
 
-    def __init__( self, syn):
-        self.syn = syn
-        self.syn_acks = []
+    __slots__ = ("isn", "syn_time", "syn_ack_times")
 
-    def add_syn_ack( self, syn_ack ):
-        self.syn_acks.append(syn_ack)
+    def __init__( self, isn, syn_time, syn_ack_times ):
+        self.isn = isn
+        self.syn_time = syn_time
+        self.syn_ack_times = syn_ack_times
 
     def get_isn( self ):
-        return self.syn[TCP].seq
+        return self.isn
+
+class ConnectionTable( object ):
 
-def extract_connections( pkts ):
     """
-    Iterate over .pcap and create Connection objects.
+    Holds all connection attempts to a target in parallel typed arrays.
+
+    Row i represents the SYN with ISN isns[i] which was sent at syn_times[i]
+    and received syn_ack_counts[i] SYN/ACKs.  After finish() was called, the
+    timestamps of these SYN/ACKs are syn_ack_times[offsets[i]:offsets[i + 1]]
+    and no more connections can be added.
+    """
+
+    __slots__ = ("rows", "live", "isns", "syn_times", "syn_ack_counts",
+                 "syn_ack_rows", "syn_ack_times", "offsets")
+
+    def __init__( self ):
+
+        # Maps (source address, source port, ISN) tuples to row numbers.
+        self.rows = {}
+        self.live = bytearray()
+
+        self.isns = array.array("L")
+        self.syn_times = array.array("d")
+        self.syn_ack_counts = array.array("L")
+
+        # Until finish() is called, SYN/ACKs are stored in arrival order
+        # together with their row number.
+        self.syn_ack_rows = array.array("L")
+        self.syn_ack_times = array.array("d")
+        self.offsets = None
+
+    def __len__( self ):
+        return len(self.isns)
+
+    def __getitem__( self, row ):
+
+        start, end = self.offsets[row], self.offsets[row + 1]
+
+        return Connection(self.isns[row], self.syn_times[row],
+                          self.syn_ack_times[start:end])
+
+    def __iter__( self ):
+        for row in xrange(len(self)):
+            yield self[row]
+
+    def get_columns( self ):
+        """
+        Return the columns of a finished table, e.g., to cache them.
+        """
+
+        return {"isns": self.isns,
+                "syn_times": self.syn_times,
+                "syn_ack_counts": self.syn_ack_counts,
+                "syn_ack_times": self.syn_ack_times,
+                "offsets": self.offsets}
+
+    @classmethod
+    def from_columns( cls, columns ):
+        """
+        Create a finished table out of columns returned by get_columns().
+        """
+
+        table = cls()
+        for name, column in columns.items():
+            setattr(table, name, column)
+        table.live = bytearray([1] * len(table.isns))
+
+        return table
+
+    def add_syn( self, flow, isn, time ):
+
+        # A SYN of a known flow replaces the old connection attempt.
+        if self.rows.has_key(flow):
+            self.live[self.rows[flow]] = 0
+
+        self.rows[flow] = len(self.isns)
+        self.live.append(1)
+        self.isns.append(isn)
+        self.syn_times.append(time)
+        self.syn_ack_counts.append(0)
+
+    def add_syn_ack( self, flow, time ):
+        """
+        Add a SYN/ACK and return False if it is unsolicited.
+        """
+
+        row = self.rows.get(flow)
+        if row is None:
+            return False
+
+        self.syn_ack_counts[row] += 1
+        self.syn_ack_rows.append(row)
+        self.syn_ack_times.append(time)
+
+        return True
+
+    def finish( self ):
+        """
+        Group the SYN/ACK timestamps by row and drop replaced rows.
+        """
+
+        # The sort is stable, so every row's SYN/ACKs remain in arrival order.
+        order = argsort(self.syn_ack_rows)
+        if numpy is None:
+            times = array.array("d", [self.syn_ack_times[i] for i in order])
+        else:
+            times = array.array("d",
+                                to_ndarray(self.syn_ack_times)[order].tobytes())
+
+        offsets = array.array("L", [0])
+        for count in self.syn_ack_counts:
+            offsets.append(offsets[-1] + count)
+
+        keep = [row for row in xrange(len(self.isns)) if self.live[row]]
+        if len(keep) < len(self.isns):
+            kept_times = array.array("d")
+            kept_offsets = array.array("L", [0])
+            for row in keep:
+                kept_times.extend(times[offsets[row]:offsets[row + 1]])
+                kept_offsets.append(len(kept_times))
+            times, offsets = kept_times, kept_offsets
+
+            self.isns = array.array("L", [self.isns[row] for row in keep])
+            self.syn_times = array.array("d", [self.syn_times[row]
+                                               for row in keep])
+            self.syn_ack_counts = array.array("L", [self.syn_ack_counts[row]
+                                                    for row in keep])
+            self.live = bytearray([1] * len(keep))
+
+        self.rows = {}
+        self.syn_ack_times = times
+        self.syn_ack_rows = array.array("L")
+        self.offsets = offsets
+
+        return self
+
+def add_segments( tables, pkts, stats=NO_STATS ):
+    """
+    Add the SYNs and SYN/ACKs among the given segments to the dictionary
+    which maps (IP address, port) tuples of targets to ConnectionTables.
+
+    Within a target's table, connections are identified by the prober's
+    address and port as well as the ISN, so concurrent scans to several
+    targets never get mixed up.
     """
 
     SYN = 2
     SYN_ACK = 18
 
-    # Maps ISNs to Connection objects.
-    connections = {}
+    segments = syns = syn_acks = unsolicited = 0
 
     for pkt in pkts:
 
-        flags = pkt[TCP].flags
+        flags = pkt.flags
+        segments += 1
 
-        # Add a new SYN segment to our hash table.
+        # Add a new SYN segment to its target's table.
         if flags == SYN:
-            connections[pkt[TCP].seq] = Connection(pkt)
+            target = (pkt.dst, pkt.dport)
+            if not tables.has_key(target):
+                tables[target] = ConnectionTable()
+            tables[target].add_syn((pkt.src, pkt.sport, pkt.seq), pkt.seq,
+                                   pkt.time)
+            syns += 1
 
-        # Add a SYN/ACK response to the respective SYN segment.
+        # Add a SYN/ACK response to the respective SYN segment.  If we don't
+        # know the flow, the SYN/ACK is unsolicited.
         elif flags == SYN_ACK:
-            # If the key doesn't exist, the SYN/ACK is unsolicited.
-            if connections.has_key(pkt[TCP].ack - 1):
-                conn = connections[pkt[TCP].ack - 1]
-                conn.add_syn_ack(pkt)
+            syn_acks += 1
+            connections = tables.get((pkt.src, pkt.sport))
+            if connections is None or \
+               not connections.add_syn_ack((pkt.dst, pkt.dport, pkt.ack - 1),
+                                           pkt.time):
+                unsolicited += 1
 
-    return connections
+    stats.count("segments", segments)
+    stats.count("syns", syns)
+    stats.count("syn_acks", syn_acks)
+    stats.count("unsolicited_syn_acks", unsolicited)
 
-def has_exponential_backoff( connection ):
+    return tables
+
+def extract_connections( pkts, stats=NO_STATS ):
     """
-    Check if the given connection used exponential backoff for retransmissions.
+    Iterate over .pcap and fill one ConnectionTable per scanned target.
+
+    `pkts' can be any iterable of pcap_reader.Segment tuples, e.g., as yielded
+    by read_segments().  Only segments which belong to a connection are kept,
+    so memory usage depends on the number of connections rather than the size
+    of the capture.  Returns a dictionary which maps the targets' (IP address,
+    port) tuples to finished tables.
     """
 
-    backoff_model = ((0, 1.125), (1, 2.27), (3, 4.5), (7, 9), (15, 17), (31, 33))
+    tables = add_segments({}, pkts, stats)
+
+    for connections in tables.values():
+        connections.finish()
+        stats.count("connections", len(connections))
+    stats.count("targets", len(tables))
+
+    return tables
+
+def get_backoff_model( synack_retries=5 ):
+    """
+    Return the backoff model for the given tcp_synack_retries setting.
+
+    Every retransmission beyond the default five doubles the timeout again.
+    """
+
+    model = list(BACKOFF_MODEL[:synack_retries + 1])
+
+    for i in xrange(len(model), synack_retries + 1):
+        model.append((2 ** i - 1, 2 ** i + 1))
+
+    return tuple(model)
+
+def parse_backoff_model( model_spec ):
+    """
+    Turn a string such as "0-1.125,1-2.27,3-4.5" into a backoff model.
+    """
+
+    model = []
+
+    for interval in model_spec.split(","):
+        lower, upper = interval.split("-")
+        model.append((float(lower), float(upper)))
+
+    return tuple(model)
+
+def has_exponential_backoff( connection, verbose=True,
+                             backoff_model=BACKOFF_MODEL ):
+    """
+    Check if the given connection used exponential backoff for retransmissions.
+    """
 
     backoffs = []
 
-    start_time = connection.syn.time
+    start_time = connection.syn_time
 
     good = True
 
     # Iterate over all SYN/ACKs inside a connection.
-    for syn_ack in connection.syn_acks:
+    for syn_ack_time in connection.syn_ack_times:
 
-        time_diff = syn_ack.time - start_time
+        time_diff = syn_ack_time - start_time
         backoffs.append(time_diff)
 
         fit = [upper <= time_diff <= lower for upper, lower in backoff_model]
@@ -78,12 +363,73 @@ def has_exponential_backoff( connection ):
             good = False
 
     if not good:
-        print backoffs
+        if verbose:
+            print backoffs
         return False
 
     return True
 
-def extract_retransmissions( connections ):
+def check_backoff_offsets( offsets, counts, backoff_model=BACKOFF_MODEL ):
+    """
+    Match SYN/ACK offsets against the backoff model in one vectorised pass.
+
+    `offsets' holds the time between SYN and SYN/ACK for all SYN/ACKs of all
+    connections, grouped by connection, and `counts' holds the number of
+    SYN/ACKs per connection.  Returns the tuple (passed, offending) where
+    `passed' is a boolean array with one element per connection and
+    `offending' maps the index of every failed connection to the offsets
+    which fit none of the model's intervals.
+    """
+
+    offsets = numpy.asarray(offsets, dtype=numpy.float64)
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    model = numpy.asarray(backoff_model, dtype=numpy.float64).reshape(-1, 2)
+
+    fits = ((offsets[:, numpy.newaxis] >= model[:, 0]) &
+            (offsets[:, numpy.newaxis] <= model[:, 1])).any(axis=1)
+
+    conn_ids = numpy.repeat(numpy.arange(len(counts)), counts)
+    misfits = numpy.bincount(conn_ids[~fits], minlength=len(counts))
+    passed = misfits == 0
+
+    # Offsets are grouped by connection, so the misfits are, too, and a single
+    # split hands every failed connection its offending offsets.
+    misfit_ids = conn_ids[~fits]
+    failed, starts = numpy.unique(misfit_ids, return_index=True)
+    offending = dict(zip(failed.tolist(),
+                         numpy.split(offsets[~fits], starts[1:])))
+
+    return (passed, offending)
+
+def check_backoff( connections, backoff_model=BACKOFF_MODEL ):
+    """
+    Check all connections of the given ConnectionTable for exponential backoff.
+
+    The return value is the same as for check_backoff_offsets().  Without
+    NumPy, we fall back to has_exponential_backoff().
+    """
+
+    if numpy is None:
+        passed, offending = [], {}
+        for conn_id, conn in enumerate(connections):
+            passed.append(has_exponential_backoff(conn, False, backoff_model))
+            if passed[-1]:
+                continue
+            offsets = [syn_ack_time - conn.syn_time
+                       for syn_ack_time in conn.syn_ack_times]
+            offending[conn_id] = [offset for offset in offsets if not
+                                  any([lower <= offset <= upper
+                                       for lower, upper in backoff_model])]
+        return (passed, offending)
+
+    counts = to_ndarray(connections.syn_ack_counts).astype(numpy.int64)
+    offsets = (to_ndarray(connections.syn_ack_times) -
+               numpy.repeat(to_ndarray(connections.syn_times), counts))
+
+    return check_backoff_offsets(offsets, counts, backoff_model)
+
+def extract_retransmissions( connections, verbose=True,
+                             time_threshold=TIME_THRESHOLD, stats=NO_STATS ):
 
     start_time = None
 
@@ -93,31 +439,33 @@ def extract_retransmissions( connections ):
     # Amount of SYN/ACK retransmissions when backlog is > 50% full.
     scan_retrans = []
 
-    # Time between backlog scan and backlog size estimation.
-    TIME_THRESHOLD = 1.5
+    # Now sort the connections based on the timestamps.
+    with stats.timer("sort"):
+        order = argsort(connections.syn_times)
 
-    # Now sort the dictionary based on the timestamps.
-    sorted_connections = sorted(connections.items(),
-                                key = lambda pkt: pkt[1].syn.time)
+    stats.start("retransmissions")
 
     i = 1
     syns = synacks = max_synacks = 0
 
     # Extract SYN/ACK retransmissions for every connection.
-    for (_, conn) in sorted_connections:
+    for row in order:
+
+        syn_time = connections.syn_times[row]
 
         # When was the first SYN sent?
         if start_time is None:
-            start_time = conn.syn.time
+            start_time = syn_time
 
-        syn_ack_count = len(conn.syn_acks)
-        if conn.syn.time > (start_time + TIME_THRESHOLD):
+        syn_ack_count = int(connections.syn_ack_counts[row])
+        if syn_time > (start_time + time_threshold):
             orig_retrans.append(syn_ack_count)
         else:
             scan_retrans.append(syn_ack_count)
 
-        print "[%.4f] SYN segment #%d received %d SYN/ACKs." % \
-              (conn.syn.time, i, syn_ack_count)
+        if verbose:
+            print "[%.4f] SYN segment #%d received %d SYN/ACKs." % \
+                  (syn_time, i, syn_ack_count)
 
         synacks += syn_ack_count
         if syn_ack_count == 6:
@@ -126,20 +474,28 @@ def extract_retransmissions( connections ):
         syns += 1
         i += 1
 
+    stats.stop()
+
     return (orig_retrans, scan_retrans)
 
-def analyse_retransmissions( orig_retrans, scan_retrans ):
+def analyse_retransmissions( orig_retrans, scan_retrans, scan_type,
+                             verbose=True, mean_threshold=MEAN_THRESHOLD,
+                             required_synacks=REQUIRED_SYNACKS ):
     """
     Print high-level scan statistics used to filter and analyse the data.
+
+    Returns the tuple (verdict, mean SYN/ACKs per SYN).
     """
 
     # Calculate average number of SYN/ACK retransmissions during backlog scan.
     syn_ack_mean = (0 if len(scan_retrans) == 0 \
                     else sum(scan_retrans) / float(len(scan_retrans)))
-    print "On average, we received %.3f SYN/ACKs for every SYN." % syn_ack_mean
+    if verbose:
+        print "On average, we received %.3f SYN/ACKs for every SYN." % \
+              syn_ack_mean
 
     # Machines whose original backlog is not as expected have to be dumped.
-    if len(orig_retrans):
+    if verbose and len(orig_retrans):
         print "Max original backlog: %d (%s)." % (max(orig_retrans),
                                                   orig_retrans)
 
@@ -147,33 +503,555 @@ def analyse_retransmissions( orig_retrans, scan_retrans ):
     if syn_ack_mean == 0:
         verdict = "ERR"
 
-    # 3.5 is our threshold.
-    elif (syn_ack_mean < 3.5) and (3 in scan_retrans):
-        verdict = "!RST" if "rst" in sys.argv[1] else "SYN"
+    # By default, 3.5 is our threshold.
+    elif (syn_ack_mean < mean_threshold) and \
+         (required_synacks in scan_retrans):
+        verdict = "!RST" if scan_type == "rst" else "SYN"
+    else:
+        verdict = "RST" if scan_type == "rst" else "!SYN"
+
+    if verbose:
+        print "Verdict: %s" % verdict
+        print scan_retrans
+
+    return (verdict, syn_ack_mean)
+
+def get_scan_type( file_name ):
+    """
+    Return "rst" for captures written by rstscan.sh and "syn" otherwise.
+    """
+
+    return "rst" if "rst" in os.path.basename(file_name) else "syn"
+
+def read_packets( file_name ):
+    """
+    Lazily dissect the given capture using scapy and yield its SYN and SYN/ACK
+    segments one at a time.  This is slow but understands every link type
+    scapy does.
+    """
+
+    from scapy.all import TCP
+    from scapy.utils import PcapReader
+
+    # scapy cannot decompress xz and zstd itself.
+    if pcap_reader.is_compressed(file_name):
+        reader = PcapReader(pcap_reader.open_compressed(file_name))
+    else:
+        reader = PcapReader(file_name)
+    try:
+        for pkt in reader:
+            # Captures contain ICMP and other non-TCP packets, too.
+            if TCP not in pkt:
+                continue
+            tcp = pkt[TCP]
+            if int(tcp.flags) not in pcap_reader.PREFILTER_FLAGS:
+                continue
+            yield pcap_reader.Segment(float(pkt.time),
+                                      tcp.underlayer.src, tcp.underlayer.dst,
+                                      tcp.sport, tcp.dport, tcp.seq, tcp.ack,
+                                      int(tcp.flags))
+    finally:
+        reader.close()
+
+def read_segments( file_name ):
+    """
+    Return an iterator over the SYN and SYN/ACK segments in the given pcap or
+    pcapng file, which may be compressed with gzip, xz or zstd.
+
+    The raw parser in pcap_reader is used whenever it understands the file.
+    For everything else, we fall back to scapy.
+    """
+
+    try:
+        return iter_raw_segments(pcap_reader.read_segments(file_name))
+    except pcap_reader.UnsupportedFormat as err:
+        print >> sys.stderr, "%s  Falling back to scapy." % err
+        return read_packets(file_name)
+
+def iter_raw_segments( segments ):
+    """
+    Yield the segments found by the raw parser.  Streamed files may turn out
+    to be unsupported after segments were already yielded, e.g., if a later
+    pcapng section uses another link type.  It is then too late to fall back
+    to scapy, so we report the error and ignore the rest of the capture.
+    """
+
+    try:
+        for segment in segments:
+            yield segment
+    except pcap_reader.UnsupportedFormat as err:
+        print >> sys.stderr, "%s  Ignoring the rest of the capture." % err
+
+def analyse_connections( file_name, target, connections, verbose=True,
+                         params=DEFAULT_PARAMETERS, stats=NO_STATS ):
+    """
+    Run the verdict stage over the ConnectionTable of a single target and
+    return a Result.
+    """
+
+    orig_retrans, scan_retrans = extract_retransmissions(connections, verbose,
+                                                         params.time_threshold,
+                                                         stats)
+
+    with stats.timer("backoff"):
+        passed, _ = check_backoff(connections, params.backoff_model)
+
+    backoff_ok = all(passed)
+    if verbose:
+        for conn, conn_passed in zip(connections, passed):
+            if not conn_passed:
+                print [syn_ack_time - conn.syn_time
+                       for syn_ack_time in conn.syn_ack_times]
+                print "Connections don't follow exponential backoff."
+
+    scan_type = get_scan_type(file_name)
+    with stats.timer("verdict"):
+        verdict, syn_ack_mean = analyse_retransmissions(orig_retrans,
+                                                        scan_retrans,
+                                                        scan_type, verbose,
+                                                        params.mean_threshold,
+                                                        params.required_synacks)
+
+    return Result(file_name, target, scan_type, verdict, syn_ack_mean,
+                  orig_retrans, scan_retrans, backoff_ok)
+
+def analyse_targets( file_name, tables, verbose=True,
+                     params=DEFAULT_PARAMETERS, stats=NO_STATS ):
+    """
+    Return a list with one Result for every target in the given dictionary of
+    ConnectionTables.
+    """
+
+    # Without a single SYN, the scan failed and the target can only be
+    # determined by the directory the capture is in.
+    if not tables:
+        tables = {get_target(file_name): ConnectionTable().finish()}
+
+    results = []
+    for target in sorted(tables.keys()):
+        if verbose and len(tables) > 1:
+            print "Target %s:%s" % target
+        results.append(analyse_connections(file_name, target, tables[target],
+                                           verbose, params, stats))
+
+    return results
+
+def parse_file( file_name, stats=NO_STATS ):
+    """
+    Read the given .pcap file and return its dictionary of ConnectionTables.
+    """
+
+    stats.count("files")
+    stats.count("bytes_read", os.path.getsize(file_name))
+
+    with stats.timer("extract"):
+        segments = stats.timed("parse", read_segments(file_name))
+        return extract_connections(segments, stats)
+
+def load_entry( file_name, cache, stats=NO_STATS ):
+    """
+    Return the tuple (key, entry, is_new) for the given .pcap file in the
+    given ResultCache.  A file which is not cached yet is parsed into a new
+    entry, which the caller has to store.
+    """
+
+    with stats.timer("cache"):
+        key = cache.get_key(file_name)
+        entry = cache.load(key)
+
+    if entry is not None:
+        return (key, entry, False)
+
+    tables = parse_file(file_name, stats)
+    entry = {"tables": dict((target, connections.get_columns())
+                            for target, connections in tables.items()),
+             "results": {}}
+
+    return (key, entry, True)
+
+def get_tables( entry ):
+    """
+    Return the dictionary of ConnectionTables of the given cache entry.
+    """
+
+    return dict((target, ConnectionTable.from_columns(columns))
+                for target, columns in entry["tables"].items())
+
+def store_entry( cache, key, entry, stats=NO_STATS ):
+
+    with stats.timer("cache"):
+        cache.store(key, entry)
+
+def load_tables( file_name, cache=None, stats=NO_STATS ):
+    """
+    Return the dictionary of ConnectionTables of the given .pcap file.  If a
+    ResultCache is given, the tables of an unchanged file are not extracted
+    again.
+    """
+
+    if cache is None:
+        return parse_file(file_name, stats)
+
+    key, entry, is_new = load_entry(file_name, cache, stats)
+    if is_new:
+        store_entry(cache, key, entry, stats)
     else:
-        verdict = "RST" if "rst" in sys.argv[1] else "!SYN"
+        stats.count("cached_tables")
+
+    return get_tables(entry)
+
+def process_file( file_name, verbose=True, params=DEFAULT_PARAMETERS,
+                  cache=None, stats=NO_STATS ):
+    """
+    Analyse the given .pcap file and return a list of Results, one for every
+    target which was scanned in the capture.
+
+    If a ResultCache is given, the connection tables of an unchanged file are
+    not extracted again and, unless we are verbose, cached verdicts for the
+    same parameters are returned right away.
+    """
+
+    if cache is None:
+        tables = parse_file(file_name, stats)
+        return analyse_targets(file_name, tables, verbose, params, stats)
+
+    key, entry, is_new = load_entry(file_name, cache, stats)
+    result_key = (get_scan_type(file_name),) + tuple(params)
 
-    print "Verdict: %s" % verdict
-    print scan_retrans
+    if not is_new and not verbose and entry["results"].has_key(result_key):
+        stats.count("cached_results")
+        results = [Result(file_name, *result)
+                   for result in entry["results"][result_key]]
+        # Captures without SYNs share cache entries with all captures of the
+        # same content, so their target must come from their own directory.
+        if not entry["tables"]:
+            results = [result._replace(target=get_target(file_name))
+                       for result in results]
+        return results
 
-def process_file( file_name ):
+    if not is_new:
+        stats.count("cached_tables")
 
-    connections = extract_connections(rdpcap(file_name))
+    results = analyse_targets(file_name, get_tables(entry), verbose, params,
+                              stats)
 
-    orig_retrans, scan_retrans = extract_retransmissions(connections)
+    entry["results"][result_key] = [tuple(result)[1:] for result in results]
+    store_entry(cache, key, entry, stats)
 
-    for connection in connections.values():
-        if not has_exponential_backoff(connection):
-            print "Connections don't follow exponential backoff."
+    return results
 
-    analyse_retransmissions(orig_retrans, scan_retrans)
+def is_final( connections, now, params=DEFAULT_PARAMETERS ):
+    """
+    Return True if no segment arriving after `now' can change the analysis of
+    the given, unfinished ConnectionTable.
+
+    Besides the verdict, the analysis reports the original backlog, which is
+    estimated from the SYNs sent after the backlog scan.  We therefore wait
+    until the retransmission windows of all SYNs have closed, even if the
+    scan's SYN/ACK mean already settled the verdict.
+    """
+
+    rows = [row for row in xrange(len(connections.isns))
+            if connections.live[row]]
+    if not rows:
+        return False
+
+    last_syn = max(connections.syn_times[row] for row in rows)
 
-    return 0
+    return now > last_syn + max(upper for _, upper in params.backoff_model)
+
+def follow_file( file_name, params=DEFAULT_PARAMETERS ):
+    """
+    Analyse a capture while tcpdump is still writing it.  As soon as the
+    verdicts of all targets are final, print the analysis and return the
+    highest exit code of all verdicts.
+    """
+
+    tables = {}
+    newest = 0
+
+    try:
+        for segments in pcap_reader.follow_segments(file_name):
+            if segments:
+                add_segments(tables, segments)
+                newest = max(newest, segments[-1].time)
+                continue
+
+            # Only decide once we caught up with tcpdump.
+            now = max(time.time(), newest)
+            if tables and all([is_final(connections, now, params)
+                               for connections in tables.values()]):
+                break
+    except pcap_reader.UnsupportedFormat as err:
+        # scapy cannot follow a file which is still being written.
+        print >> sys.stderr, "%s  Cannot follow the capture." % err
+        return FOLLOW_EXIT_CODES["ERR"]
+
+    for connections in tables.values():
+        connections.finish()
+
+    results = analyse_targets(file_name, tables, True, params)
+
+    return max([FOLLOW_EXIT_CODES[result.verdict] for result in results])
+
+def find_pcaps( directory ):
+    """
+    Yield all SYN and RST scan captures, compressed or not, underneath the
+    given directory.
+    """
+
+    for dir_path, dir_names, file_names in os.walk(directory):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if file_name.endswith(CAPTURE_SUFFIXES):
+                yield os.path.join(dir_path, file_name)
+
+def get_target( file_name ):
+    """
+    Return the (host, port) tuple of the given capture.  Just like the ports
+    of targets which are taken from packets, the port is an integer, and 0 if
+    it is unknown.
+
+    probe_host.sh writes all captures of a host to a directory called IP:port.
+    """
+
+    target = os.path.basename(os.path.dirname(os.path.abspath(file_name)))
+    host, _, port = target.rpartition(":")
+
+    if not host or not port.isdigit():
+        return (target, 0)
+
+    return (host, int(port))
+
+def get_row( result ):
+    """
+    Turn a Result into a row of the verdict table.
+    """
+
+    host, port = result.target
+
+    return [host, port, result.scan_type, result.verdict,
+            "%.3f" % result.syn_ack_mean,
+            ",".join(map(str, result.orig_retrans)),
+            ",".join(map(str, result.scan_retrans)),
+            result.file_name]
+
+def analyse_file( args ):
+    """
+    Quietly analyse a single file in a worker process.
+    """
+
+    file_name, params, cache, instrument = args
+
+    stats = Stats() if instrument else NO_STATS
+
+    try:
+        results = process_file(file_name, False, params, cache, stats)
+    except Exception as err:
+        print >> sys.stderr, "Could not analyse `%s': %s" % (file_name, err)
+        results = None
+
+    return (file_name, results, stats.to_dict() if instrument else None)
+
+def process_batch( directory, output_file, processes=None,
+                   params=DEFAULT_PARAMETERS, cache=None, stats_file=None ):
+    """
+    Analyse all captures underneath the given directory in parallel and write
+    one verdict table to the given file.
+
+    If `stats_file' is given, the statistics of every capture as well as
+    their sum are written to it as JSON.
+    """
+
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    count = 0
+    started = time.time()
+    total_stats = Stats()
+    file_stats = {}
+
+    with open(output_file, "w") as fd:
+        writer = csv.writer(fd, delimiter="\t", lineterminator="\n")
+        writer.writerow(TABLE_HEADER)
+
+        jobs = ((file_name, params, cache, stats_file is not None)
+                for file_name in find_pcaps(directory))
+
+        for file_name, results, stats in pool.imap(analyse_file, jobs,
+                                                   chunksize=16):
+            if stats is not None:
+                file_stats[file_name] = stats
+                total_stats.merge(stats)
+
+            if results is None:
+                continue
+
+            for result in results:
+                writer.writerow(get_row(result))
+            count += 1
+
+    pool.close()
+    pool.join()
+
+    if cache is not None:
+        cache.evict()
+
+    print >> sys.stderr, "Wrote verdicts of %d captures to `%s'." % \
+                         (count, output_file)
+
+    if stats_file is not None:
+        with open(stats_file, "w") as fd:
+            json.dump({"wall_time": time.time() - started,
+                       "total": total_stats.to_dict(),
+                       "files": file_stats}, fd, indent=4, sort_keys=True,
+                      separators=(",", ": "))
+
+def run_worker( params=DEFAULT_PARAMETERS, cache=None ):
+    """
+    Read capture paths from stdin, one per line, and write a verdict table
+    row for every target to stdout.  This keeps the interpreter warm between
+    scans.
+    """
+
+    writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+
+    for line in iter(sys.stdin.readline, ""):
+        file_name = line.strip()
+        if not file_name:
+            continue
+
+        try:
+            results = process_file(file_name, False, params, cache)
+        except Exception as err:
+            print >> sys.stderr, "Could not analyse `%s': %s" % (file_name,
+                                                                err)
+            continue
+
+        for result in results:
+            writer.writerow(get_row(result))
+        sys.stdout.flush()
+
+    if cache is not None:
+        cache.evict()
+
+def parse_arguments( ):
+
+    parser = argparse.ArgumentParser(description="Determine SYN/ACK "
+                                     "retransmissions in backlog scan "
+                                     "captures.")
+
+    parser.add_argument("path", metavar="PCAP_FILE", nargs="?",
+                        help="The capture to analyse.  With --batch, the "
+                             "directory written to by probing_wrapper.sh.")
+
+    parser.add_argument("-w", "--worker", action="store_true",
+                        help="Keep running and analyse every capture whose "
+                             "path is written to stdin.  Verdicts are "
+                             "written to stdout in the format of --batch.")
+
+    parser.add_argument("-b", "--batch", action="store_true",
+                        help="Analyse all *_synscan.pcap and *_rstscan.pcap "
+                             "files underneath the given directory.")
+
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="Follow a capture which is still being written "
+                             "and exit as soon as the verdict is final.  "
+                             "The exit code is 0 if nothing was dropped, 2 "
+                             "if SYN/ACKs or RSTs were dropped, and 3 on "
+                             "error.")
+
+    parser.add_argument("-o", "--output", metavar="OUTPUT_FILE", type=str,
+                        default="verdicts.tsv",
+                        help="Where --batch writes its verdict table to.")
+
+    parser.add_argument("-j", "--jobs", metavar="NUM", type=int,
+                        default=None,
+                        help="Number of worker processes for --batch "
+                             "(default: number of cores).")
+
+    parser.add_argument("-r", "--synack-retries", metavar="NUM", type=int,
+                        default=5,
+                        help="The destination's tcp_synack_retries setting "
+                             "which determines the backoff model "
+                             "(default: 5).")
+
+    parser.add_argument("-m", "--backoff-model", metavar="MODEL", type=str,
+                        default=None,
+                        help="Custom backoff model given as comma-separated "
+                             "intervals, e.g.: \"0-1.125,1-2.27,3-4.5\".")
+
+    parser.add_argument("-t", "--time-threshold", metavar="SECONDS",
+                        type=float, default=TIME_THRESHOLD,
+                        help="Time between backlog scan and backlog size "
+                             "estimation (default: %.1f)." % TIME_THRESHOLD)
+
+    parser.add_argument("-M", "--mean-threshold", metavar="NUM",
+                        type=float, default=MEAN_THRESHOLD,
+                        help="Mean number of SYN/ACKs per SYN below which "
+                             "the backlog counts as full (default: %.1f)." %
+                             MEAN_THRESHOLD)
+
+    parser.add_argument("-n", "--required-synacks", metavar="NUM", type=int,
+                        default=REQUIRED_SYNACKS,
+                        help="A full backlog requires a SYN of the backlog "
+                             "scan which received exactly this many SYN/ACKs "
+                             "(default: %d)." % REQUIRED_SYNACKS)
+
+    parser.add_argument("-c", "--cache", metavar="CACHE_DIR", type=str,
+                        default=None,
+                        help="Cache connection tables and verdicts in the "
+                             "given directory.")
+
+    parser.add_argument("-s", "--cache-size", metavar="MBYTES", type=int,
+                        default=result_cache.DEFAULT_MAX_SIZE / 1024 / 1024,
+                        help="Size limit of the cache (default: %(default)d).")
+
+    parser.add_argument("-H", "--hash", action="store_true",
+                        help="Identify cached captures by their content hash "
+                             "instead of inode, size and modification time.")
+
+    parser.add_argument("-S", "--stats", metavar="STATS_FILE", type=str,
+                        default=None,
+                        help="Write stage timers and counters as JSON to the "
+                             "given file.")
+
+    args = parser.parse_args()
+    if not args.worker and args.path is None:
+        parser.error("PCAP_FILE is required unless --worker is given.")
+
+    return args
 
 if __name__ == "__main__":
 
-    if len(sys.argv) != 2:
-        print >> sys.stderr, "\nUsage: %s PCAP_FILE\n" % sys.argv[0]
-        exit(1)
+    args = parse_arguments()
+
+    if args.backoff_model:
+        backoff_model = parse_backoff_model(args.backoff_model)
+    else:
+        backoff_model = get_backoff_model(args.synack_retries)
+
+    params = Parameters(backoff_model, args.time_threshold,
+                        args.mean_threshold, args.required_synacks)
+
+    cache = None
+    if args.cache:
+        cache = result_cache.ResultCache(args.cache,
+                                         args.cache_size * 1024 * 1024,
+                                         args.hash)
+
+    if args.worker:
+        run_worker(params, cache)
+    elif args.follow:
+        exit(follow_file(args.path, params))
+    elif args.batch:
+        process_batch(args.path, args.output, args.jobs, params, cache,
+                      args.stats)
+    else:
+        stats = Stats() if args.stats else NO_STATS
+        process_file(args.path, params=params, cache=cache, stats=stats)
+        if cache is not None:
+            cache.evict()
+        if args.stats:
+            with open(args.stats, "w") as fd:
+                fd.write(stats.to_json() + "\n")
 
-    exit(process_file(sys.argv[1]))
+    exit(0)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Opt-in stage timers and counters for the analysis pipeline.  Code paths
+# take a Stats object and default to NO_STATS, whose methods do nothing, so
+# instrumentation costs next to nothing unless it is enabled.
+
+import json
+import time
+import contextlib
+
+class Stats( object ):
+
+    """
+    Collects the time spent in named stages as well as named counters.
+
+    Timers measure exclusive time: while a nested stage runs, the time is
+    attributed to the nested stage only.
+    """
+
+    def __init__( self ):
+
+        self.timers = {}
+        self.counters = {}
+        self.stack = []
+
+    def start( self, name ):
+
+        self.stack.append([name, time.time(), 0.0])
+
+    def stop( self ):
+
+        name, started, nested = self.stack.pop()
+        elapsed = time.time() - started
+
+        self.timers[name] = self.timers.get(name, 0.0) + elapsed - nested
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    @contextlib.contextmanager
+    def timer( self, name ):
+        """
+        Attribute the time spent in the with block to the given stage.
+        """
+
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def timed( self, name, iterable ):
+        """
+        Attribute the time spent producing the iterable's items to the given
+        stage.
+        """
+
+        iterator = iter(iterable)
+
+        while True:
+            self.start(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stop()
+            yield item
+
+    def count( self, name, value=1 ):
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge( self, other ):
+        """
+        Add the timers and counters of another Stats object or of a
+        dictionary returned by to_dict().
+        """
+
+        if isinstance(other, Stats):
+            other = other.to_dict()
+
+        for name, value in other["timers"].items():
+            self.timers[name] = self.timers.get(name, 0.0) + value
+        for name, value in other["counters"].items():
+            self.count(name, value)
+
+        return self
+
+    def to_dict( self ):
+
+        return {"timers": dict(self.timers), "counters": dict(self.counters)}
+
+    def to_json( self ):
+
+        return json.dumps(self.to_dict(), indent=4, sort_keys=True,
+                          separators=(",", ": "))
+
+class NullStats( Stats ):
+
+    """
+    Stands in for Stats when instrumentation is disabled.
+    """
+
+    def start( self, name ):
+        pass
+
+    def stop( self ):
+        pass
+
+    def timed( self, name, iterable ):
+        return iterable
+
+    def count( self, name, value=1 ):
+        pass
+
+    def merge( self, other ):
+        return self
+
+NO_STATS = NullStats()
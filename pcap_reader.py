@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Reads TCP segments straight out of a memory-mapped .pcap file.  Only the
+# link layer, IPv4 and TCP headers are decoded, at fixed offsets, which is all
+# count_retransmissions.py needs and a lot cheaper than a full scapy
+# dissection.  Only SYN and SYN/ACK segments are turned into Python objects;
+# all other frames are dropped as soon as their flags are known.
+#
+# Besides classic pcap files, we read pcapng files as written by
+# `tcpdump -i any' and Wireshark.
+#
+# Captures compressed with gzip, xz or zstd are decompressed on the fly and
+# parsed chunk by chunk, without ever writing the decompressed file to disk.
+
+import os
+import gzip
+import time
+import mmap
+import struct
+import socket
+import subprocess
+import collections
+
+from distutils.spawn import find_executable
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The subset of a TCP segment which we need to analyse backlog scans.
+Segment = collections.namedtuple("Segment", ["time", "src", "dst", "sport",
+                                             "dport", "seq", "ack", "flags"])
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+SUPPORTED_LINK_TYPES = (LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_LINUX_SLL,
+                        LINKTYPE_LINUX_SLL2)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = 0x8100
+
+IPPROTO_TCP = 6
+
+TH_SYN = 0x02
+TH_ACK = 0x10
+
+# The TCP flags of all segments which are needed to analyse backlog scans.
+PREFILTER_FLAGS = frozenset([TH_SYN, TH_SYN | TH_ACK])
+
+PCAP_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+
+# Magic numbers for microsecond and nanosecond timestamp resolution.
+MAGIC_USEC = 0xa1b2c3d4
+MAGIC_NSEC = 0xa1b23c4d
+
+# pcapng block types and options.
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 1
+PCAPNG_PB = 2
+PCAPNG_EPB = 6
+PCAPNG_OPT_ENDOFOPT = 0
+PCAPNG_OPT_TSRESOL = 9
+
+PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_BYTE_ORDER_MAGIC_SWAPPED = 0x4d3c2b1a
+
+# Command lines which decompress a file to stdout, by file name suffix.
+DECOMPRESSORS = {
+    ".gz": ("gzip", "-dc"),
+    ".xz": ("xz", "-dc"),
+    ".zst": ("zstd", "-dc"),
+}
+
+COMPRESSED_SUFFIXES = tuple(sorted(DECOMPRESSORS.keys()))
+
+# Amount of decompressed data which is parsed at once.
+CHUNK_SIZE = 1024 * 1024
+
+class UnsupportedFormat( Exception ):
+
+    """
+    Raised if a file cannot be handled by the raw parser.
+    """
+
+    pass
+
+class DecompressorPipe( object ):
+
+    """
+    Reads the output of an external decompressor.  The decompressor runs in
+    its own process, so decompression and parsing overlap.
+    """
+
+    def __init__( self, command, file_name ):
+
+        self.file_name = file_name
+        self.proc = subprocess.Popen(list(command) + [file_name],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def read( self, size=-1 ):
+
+        data = self.proc.stdout.read(size)
+
+        # Make sure that an empty read means the end of the file and not a
+        # decompression error.
+        if not data and size != 0 and self.proc.wait() != 0:
+            raise IOError("Could not decompress `%s': %s" %
+                          (self.file_name, self.proc.stderr.read().strip()))
+
+        return data
+
+    def close( self ):
+
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+
+class ZstdReader( object ):
+
+    """
+    Decompresses a zstd file in-process.  Closing the reader also closes the
+    underlying file.
+    """
+
+    def __init__( self, file_name ):
+
+        self.fd = open(file_name, "rb")
+        try:
+            self.reader = zstandard.ZstdDecompressor().stream_reader(self.fd)
+        except Exception:
+            self.fd.close()
+            raise
+
+    def read( self, size=-1 ):
+
+        return self.reader.read(size)
+
+    def close( self ):
+
+        try:
+            self.reader.close()
+        finally:
+            self.fd.close()
+
+def is_compressed( file_name ):
+
+    return file_name.endswith(COMPRESSED_SUFFIXES)
+
+def open_compressed( file_name ):
+    """
+    Return a file-like object which yields the decompressed content of the
+    given file.
+
+    We prefer the command line tools because they decompress in parallel to
+    our parsing.  If they are missing, we decompress in-process.
+    """
+
+    suffix = os.path.splitext(file_name)[1]
+    command = DECOMPRESSORS[suffix]
+
+    if find_executable(command[0]):
+        return DecompressorPipe(command, file_name)
+
+    if suffix == ".gz":
+        return gzip.GzipFile(file_name, "rb")
+    elif suffix == ".xz" and lzma is not None:
+        return lzma.LZMAFile(file_name, "rb")
+    elif suffix == ".zst" and zstandard is not None:
+        return ZstdReader(file_name)
+
+    raise IOError("Cannot decompress `%s' because neither %s nor a Python "
+                  "module for it is installed." % (file_name, command[0]))
+
+def get_l3_offset( buf, offset, link_type ):
+    """
+    Return the offset of the IPv4 header in the given frame or None if the
+    frame doesn't carry IPv4.
+    """
+
+    if link_type == LINKTYPE_ETHERNET:
+        ether_type, = struct.unpack_from("!H", buf, offset + 12)
+        offset += 14
+        if ether_type == ETHERTYPE_VLAN:
+            ether_type, = struct.unpack_from("!H", buf, offset + 2)
+            offset += 4
+
+    elif link_type == LINKTYPE_LINUX_SLL:
+        ether_type, = struct.unpack_from("!H", buf, offset + 14)
+        offset += 16
+
+    elif link_type == LINKTYPE_LINUX_SLL2:
+        ether_type, = struct.unpack_from("!H", buf, offset)
+        offset += 20
+
+    else:
+        # LINKTYPE_RAW frames begin with the IP header.
+        return offset
+
+    return offset if ether_type == ETHERTYPE_IPV4 else None
+
+def decode_tcp( buf, offset, length, link_type ):
+    """
+    Decode a single frame and return (src, dst, sport, dport, seq, ack, flags)
+    or None if the frame is not an unfragmented IPv4/TCP segment whose flags
+    are in PREFILTER_FLAGS.
+    """
+
+    end = offset + length
+
+    # Ethernet and cooked headers are at most 20 bytes long.
+    if length < 20:
+        return None
+
+    ip_offset = get_l3_offset(buf, offset, link_type)
+    if ip_offset is None or ip_offset + 20 > end:
+        return None
+
+    version_ihl, frag, proto = struct.unpack_from("!B5xH1xB", buf, ip_offset)
+    if (version_ihl >> 4) != 4 or proto != IPPROTO_TCP:
+        return None
+
+    # Only the first fragment contains the TCP header.
+    if frag & 0x1fff:
+        return None
+
+    tcp_offset = ip_offset + (version_ihl & 0x0f) * 4
+    if tcp_offset + 14 > end:
+        return None
+
+    # Look at the flags first, so we don't decode the bulk of the segments.
+    flags, = struct.unpack_from("!H", buf, tcp_offset + 12)
+    flags &= 0x1ff
+    if flags not in PREFILTER_FLAGS:
+        return None
+
+    sport, dport, seq, ack = struct.unpack_from("!HHII", buf, tcp_offset)
+
+    src = socket.inet_ntoa(buf[ip_offset + 12:ip_offset + 16])
+    dst = socket.inet_ntoa(buf[ip_offset + 16:ip_offset + 20])
+
+    return (src, dst, sport, dport, seq, ack, flags)
+
+def iter_segments( fd, buf, endian, ts_divisor, link_type ):
+    """
+    Yield a Segment for every IPv4/TCP frame in the memory-mapped file.
+    """
+
+    record_header = struct.Struct(endian + "IIII")
+    size = len(buf)
+    offset = PCAP_HEADER_LEN
+
+    try:
+        while offset + RECORD_HEADER_LEN <= size:
+            ts_sec, ts_frac, incl_len, _ = record_header.unpack_from(buf,
+                                                                     offset)
+            offset += RECORD_HEADER_LEN
+
+            # The last record is truncated if tcpdump was killed mid-write.
+            if offset + incl_len > size:
+                break
+
+            fields = decode_tcp(buf, offset, incl_len, link_type)
+            offset += incl_len
+
+            if fields is None:
+                continue
+
+            yield Segment(ts_sec + ts_frac / ts_divisor, *fields)
+    finally:
+        buf.close()
+        fd.close()
+
+class PcapDecoder( object ):
+
+    """
+    Decodes the records of a classic pcap file which follow its file header.
+    """
+
+    def __init__( self, endian, ts_divisor, link_type ):
+
+        self.record_header = struct.Struct(endian + "IIII")
+        self.ts_divisor = ts_divisor
+        self.link_type = link_type
+
+    def decode( self, buf ):
+        """
+        Decode all complete records in the given buffer, which must begin
+        with a record header.
+
+        Returns a list of Segments and the offset of the first incomplete
+        record, which the caller has to keep until more data arrives.
+        """
+
+        offset = 0
+        segments = []
+
+        while offset + RECORD_HEADER_LEN <= len(buf):
+            ts_sec, ts_frac, incl_len, _ = \
+                self.record_header.unpack_from(buf, offset)
+            if offset + RECORD_HEADER_LEN + incl_len > len(buf):
+                break
+            offset += RECORD_HEADER_LEN
+
+            fields = decode_tcp(buf, offset, incl_len, self.link_type)
+            offset += incl_len
+
+            if fields is not None:
+                segments.append(Segment(ts_sec + ts_frac / self.ts_divisor,
+                                        *fields))
+
+        return (segments, offset)
+
+class PcapngDecoder( object ):
+
+    """
+    Decodes the blocks of a pcapng file.  Every section may use its own byte
+    order and every interface its own link type and timestamp resolution.
+    """
+
+    def __init__( self, file_name ):
+
+        self.file_name = file_name
+        self.endian = "<"
+        # One (link type, timestamp units per second) tuple per interface.
+        self.interfaces = []
+
+    def parse_interface( self, buf, offset, end ):
+        """
+        Parse the interface description block body between the given offsets.
+        """
+
+        link_type, = struct.unpack_from(self.endian + "H", buf, offset)
+        if link_type not in SUPPORTED_LINK_TYPES:
+            raise UnsupportedFormat("Link type %d of `%s' is not supported." %
+                                    (link_type, self.file_name))
+
+        units = 10 ** 6
+        offset += 8
+
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(self.endian + "HH", buf, offset)
+            if code == PCAPNG_OPT_ENDOFOPT:
+                break
+            if code == PCAPNG_OPT_TSRESOL and length >= 1:
+                resolution, = struct.unpack_from("B", buf, offset + 4)
+                if resolution & 0x80:
+                    units = 2 ** (resolution & 0x7f)
+                else:
+                    units = 10 ** resolution
+            offset += 4 + ((length + 3) & ~3)
+
+        self.interfaces.append((link_type, units))
+
+    def decode( self, buf ):
+        """
+        Decode all complete blocks in the given buffer, which must begin with
+        a block header.
+
+        Returns a list of Segments and the offset of the first incomplete
+        block, which the caller has to keep until more data arrives.
+        """
+
+        offset = 0
+        segments = []
+
+        while offset + 12 <= len(buf):
+
+            # The section header's block type reads the same in both byte
+            # orders and is followed by the section's byte-order magic.
+            block_type, = struct.unpack_from("<I", buf, offset)
+            if block_type == PCAPNG_SHB:
+                magic, = struct.unpack_from("<I", buf, offset + 8)
+                if magic == PCAPNG_BYTE_ORDER_MAGIC:
+                    self.endian = "<"
+                elif magic == PCAPNG_BYTE_ORDER_MAGIC_SWAPPED:
+                    self.endian = ">"
+                else:
+                    raise UnsupportedFormat("File `%s' has a corrupt pcapng "
+                                            "section header." % self.file_name)
+                self.interfaces = []
+
+            block_type, block_len = struct.unpack_from(self.endian + "II", buf,
+                                                       offset)
+            if block_len < 12 or block_len % 4:
+                raise UnsupportedFormat("File `%s' has a corrupt pcapng "
+                                        "block." % self.file_name)
+            if offset + block_len > len(buf):
+                break
+
+            body = offset + 8
+            offset += block_len
+
+            if block_type == PCAPNG_IDB:
+                self.parse_interface(buf, body, offset - 4)
+                continue
+            elif block_type == PCAPNG_EPB:
+                interface, ts_high, ts_low, cap_len = \
+                    struct.unpack_from(self.endian + "IIII", buf, body)
+            elif block_type == PCAPNG_PB:
+                interface, _, ts_high, ts_low, cap_len = \
+                    struct.unpack_from(self.endian + "HHIII", buf, body)
+            else:
+                # Simple packet blocks lack timestamps and all other blocks
+                # don't carry packets.
+                continue
+
+            if interface >= len(self.interfaces) or \
+               body + 20 + cap_len > offset - 4:
+                continue
+            link_type, units = self.interfaces[interface]
+
+            fields = decode_tcp(buf, body + 20, cap_len, link_type)
+            if fields is not None:
+                ts_sec, ts_frac = divmod((ts_high << 32) | ts_low, units)
+                segments.append(Segment(ts_sec + ts_frac / float(units),
+                                        *fields))
+
+        return (segments, offset)
+
+def iter_stream_segments( fd, decoder, segments, buf ):
+    """
+    Yield the given, already decoded segments followed by a Segment for every
+    IPv4/TCP frame which the decoder finds in the rest of the stream.  `buf'
+    holds data which was read but not decoded yet.
+    """
+
+    try:
+        for segment in segments:
+            yield segment
+
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b""):
+            buf += chunk
+            segments, offset = decoder.decode(buf)
+            buf = buf[offset:]
+            for segment in segments:
+                yield segment
+    finally:
+        fd.close()
+
+def parse_header( buf, file_name ):
+    """
+    Parse the pcap file header at the beginning of the given buffer.
+
+    Returns the tuple (byte order, timestamp divisor, link type) or raises
+    UnsupportedFormat.
+    """
+
+    magic, = struct.unpack_from("<I", buf, 0)
+    if magic in (MAGIC_USEC, MAGIC_NSEC):
+        endian = "<"
+    else:
+        endian = ">"
+        magic, = struct.unpack_from(">I", buf, 0)
+
+    if magic not in (MAGIC_USEC, MAGIC_NSEC):
+        raise UnsupportedFormat("File `%s' is not a pcap file." % file_name)
+
+    ts_divisor = 1e9 if magic == MAGIC_NSEC else 1e6
+
+    link_type, = struct.unpack_from(endian + "I", buf, 20)
+    link_type &= 0x0fffffff
+    if link_type not in SUPPORTED_LINK_TYPES:
+        raise UnsupportedFormat("Link type %d of `%s' is not supported." %
+                                (link_type, file_name))
+
+    return (endian, ts_divisor, link_type)
+
+def is_pcapng( buf ):
+
+    return buf[:4] == PCAPNG_MAGIC
+
+def get_decoder( header, file_name ):
+    """
+    Return a decoder for the file which begins with the given header as well
+    as the part of the header which the decoder still has to see.
+    """
+
+    if is_pcapng(header):
+        return (PcapngDecoder(file_name), header)
+
+    return (PcapDecoder(*parse_header(header, file_name)), b"")
+
+def read_stream_segments( fd, file_name ):
+    """
+    Return an iterator over all IPv4/TCP segments in the given stream, which
+    holds a pcap or pcapng file.
+    """
+
+    header = fd.read(PCAP_HEADER_LEN)
+    if len(header) < PCAP_HEADER_LEN:
+        raise UnsupportedFormat("File `%s' has no complete pcap header." %
+                                file_name)
+
+    decoder, buf = get_decoder(header, file_name)
+
+    # pcapng files describe their link types right after the section header,
+    # so decoding the first chunk now raises UnsupportedFormat while the
+    # caller can still fall back to another parser.
+    buf += fd.read(CHUNK_SIZE)
+    segments, offset = decoder.decode(buf)
+
+    return iter_stream_segments(fd, decoder, segments, buf[offset:])
+
+def read_segments( file_name ):
+    """
+    Return an iterator over the IPv4/TCP segments with SYN or SYN/ACK flags
+    in the given pcap or pcapng file, which may be compressed.
+
+    UnsupportedFormat is raised right away if the file is in neither format
+    or uses a link type we cannot decode.
+    """
+
+    if is_compressed(file_name):
+        fd = open_compressed(file_name)
+    else:
+        fd = open(file_name, "rb")
+
+    try:
+        if is_compressed(file_name):
+            return read_stream_segments(fd, file_name)
+
+        # Classic pcap files are memory-mapped, pcapng files are streamed.
+        magic = fd.read(4)
+        fd.seek(0)
+        if is_pcapng(magic):
+            return read_stream_segments(fd, file_name)
+
+        if os.fstat(fd.fileno()).st_size < PCAP_HEADER_LEN:
+            raise UnsupportedFormat("File `%s' has no complete pcap header." %
+                                    file_name)
+
+        buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            endian, ts_divisor, link_type = parse_header(buf, file_name)
+        except UnsupportedFormat:
+            buf.close()
+            raise
+    except Exception:
+        fd.close()
+        raise
+
+    return iter_segments(fd, buf, endian, ts_divisor, link_type)
+
+def follow_segments( file_name, poll_interval=0.5 ):
+    """
+    Follow a pcap or pcapng file which is still being written to, e.g., by
+    tcpdump -U.
+
+    Yields a list of new segments for every chunk read from the file.  Once
+    we caught up with the writer, we wait for `poll_interval' seconds and
+    yield an empty list, so the caller gets a chance to stop following.
+    """
+
+    while not os.path.exists(file_name):
+        time.sleep(poll_interval)
+        yield []
+
+    with open(file_name, "rb") as fd:
+
+        buf = b""
+        while len(buf) < PCAP_HEADER_LEN:
+            chunk = fd.read(PCAP_HEADER_LEN - len(buf))
+            if not chunk:
+                time.sleep(poll_interval)
+                yield []
+            buf += chunk
+
+        decoder, buf = get_decoder(buf, file_name)
+
+        while True:
+            chunk = fd.read(CHUNK_SIZE)
+            if not chunk:
+                time.sleep(poll_interval)
+                yield []
+                continue
+
+            # Decode all complete records and keep the rest for later.
+            buf += chunk
+            segments, offset = decoder.decode(buf)
+            buf = buf[offset:]
+            yield segments
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# The state of an incrementally updated analysis directory.  It records how
+# far the idle scan file was processed, with which options, and the point and
+# path bitmaps of every map, so that an update only has to read the lines
+# which were appended since and redraw the maps which changed.
+
+import os
+import hashlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import atomic_file
+
+STATE_FILE = ".analysis_state"
+
+# Bump this whenever the format of the state changes.
+STATE_VERSION = 1
+
+# Number of bytes before the offset which must not change between updates.
+DIGEST_SIZE = 4096
+
+def get_digest( file_name, offset ):
+    """
+    Return the hash of the bytes right before the given offset, which tells
+    if the file was truncated or replaced rather than appended to.  Changes
+    further back in the file go unnoticed, so they are never read again.
+    """
+
+    start = max(0, offset - DIGEST_SIZE)
+
+    with open(file_name, "rb") as fd:
+        fd.seek(start)
+        return hashlib.sha1(fd.read(offset - start)).hexdigest()
+
+def merge_bitmaps( bitmaps, new_bitmaps ):
+    """
+    OR the given new bitmaps into the existing ones and return True if that
+    changed anything.
+    """
+
+    changed = False
+
+    for key, bitmap in new_bitmaps.iteritems():
+        old = bitmaps.get(key, 0)
+        if old | bitmap != old:
+            bitmaps[key] = old | bitmap
+            changed = True
+
+    return changed
+
+class AnalysisState( object ):
+
+    """
+    Maps the file name of every map in an analysis directory to its (points,
+    paths) bitmaps, as returned by aggregate_scans() in plot_scan_data.py.
+    The idle scan file was processed up to byte `offset'.
+    """
+
+    def __init__( self, options ):
+
+        self.version = STATE_VERSION
+        self.options = options
+        self.offset = 0
+        self.digest = None
+        self.maps = {}
+
+    def is_valid( self, options, scan_file ):
+        """
+        Return True if the state was built with the given options from an
+        earlier version of the given scan file.
+        """
+
+        if self.version != STATE_VERSION or self.options != options:
+            return False
+
+        try:
+            if os.path.getsize(scan_file) < self.offset:
+                return False
+            return get_digest(scan_file, self.offset) == self.digest
+        except (IOError, OSError):
+            return False
+
+    def update( self, file_name, points, paths ):
+        """
+        Merge the given bitmaps into the ones of the given map and return True
+        if the map changed.
+        """
+
+        if not self.maps.has_key(file_name):
+            self.maps[file_name] = (points, paths)
+            return True
+
+        old_points, old_paths = self.maps[file_name]
+        changed = merge_bitmaps(old_points, points)
+
+        return merge_bitmaps(old_paths, paths) or changed
+
+    def advance( self, scan_file, offset ):
+
+        self.offset = offset
+        self.digest = get_digest(scan_file, offset)
+
+def load( dirname ):
+    """
+    Return the state of the given analysis directory or None.
+    """
+
+    try:
+        with open(os.path.join(dirname, STATE_FILE), "rb") as fd:
+            return pickle.load(fd)
+    except (IOError, OSError, EOFError, AttributeError, ImportError,
+            pickle.UnpicklingError):
+        return None
+
+def save( dirname, state ):
+    """
+    Atomically write the state, so an interrupted update leaves the previous
+    state behind.
+    """
+
+    atomic_file.write_atomically(os.path.join(dirname, STATE_FILE),
+        lambda fd: pickle.dump(state, fd, pickle.HIGHEST_PROTOCOL))
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Atomically replaces files which other processes may read at the same time,
+# such as the scan cube, the geolocation index and the analysis state.
+
+import os
+import tempfile
+
+def write_atomically( file_name, write, mode=None ):
+    """
+    Call `write' with a temporary file object next to the given file and then
+    rename the temporary file, so concurrent readers never see half-written
+    files and an interrupted write leaves the previous file behind.  If given,
+    the file's permissions are set to `mode'.
+    """
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_name) or ".",
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_fd:
+            write(tmp_fd)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.rename(tmp_path, file_name)
+    except Exception:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# An index over the geolocation CSV file used by plot_scan_data.py.  The CSV
+# file is parsed once and turned into a compact binary sidecar file which is
+# memory-mapped on later runs.  Exact IP addresses are looked up in an
+# open-addressing hash table.  Address ranges, given as CIDR prefixes or as
+# "first-last", are looked up by binary search over their start addresses.
+
+import os
+import sys
+import csv
+import mmap
+import array
+import bisect
+import heapq
+import socket
+import struct
+import logging
+
+import atomic_file
+
+logger = logging.getLogger()
+
+# Bump the last byte whenever the sidecar format changes.
+INDEX_MAGIC = b"GEOIDX\x00\x01"
+
+INDEX_SUFFIX = ".idx"
+
+# Magic, size and mtime of the CSV file, hash table slots, ranges, records.
+HEADER = struct.Struct("<8sQdIII")
+
+# Latitude, longitude, and offset and length of "region\ttype".
+RECORD = struct.Struct("<ddII")
+
+UINT = struct.Struct("<I")
+
+# Marks an empty hash table slot.
+EMPTY = 0xffffffff
+
+HASH_MULTIPLIER = 2654435761
+
+# Indices which were already opened, by CSV file name.
+indices = {}
+
+def ip_to_int( ip_addr ):
+
+    if ip_addr.count(".") != 3:
+        raise ValueError("`%s' is not an IPv4 address." % ip_addr)
+
+    try:
+        return struct.unpack("!I", socket.inet_aton(ip_addr))[0]
+    except socket.error:
+        raise ValueError("`%s' is not an IPv4 address." % ip_addr)
+
+def parse_addresses( field ):
+    """
+    Return the first and last address, as integers, of a single IP address,
+    a CIDR prefix such as 1.2.3.0/24 or a range such as 1.2.3.0-1.2.3.255.
+    """
+
+    if "/" in field:
+        ip_addr, bits = field.split("/", 1)
+        bits = int(bits)
+        if not 0 <= bits <= 32:
+            raise ValueError("Invalid prefix `%s'." % field)
+        size = 1 << (32 - bits)
+        first = ip_to_int(ip_addr.strip()) & ~(size - 1) & 0xffffffff
+        return (first, first + size - 1)
+
+    if "-" in field:
+        first, last = [ip_to_int(ip_addr.strip())
+                       for ip_addr in field.split("-", 1)]
+        if last < first:
+            raise ValueError("Invalid range `%s'." % field)
+        return (first, last)
+
+    ip_addr = ip_to_int(field)
+
+    return (ip_addr, ip_addr)
+
+def get_slot( addr, bits ):
+
+    if not bits:
+        return 0
+
+    return ((addr * HASH_MULTIPLIER) & 0xffffffff) >> (32 - bits)
+
+def flatten_ranges( ranges ):
+    """
+    Turn the given (first, last, record) ranges into sorted, disjoint ranges.
+    Where ranges overlap, the most specific, i.e., smallest, range wins, and
+    of two equally large ranges the one which starts later.  Ranges need not
+    be nested: the part of a range outside a smaller one is kept.
+    """
+
+    ranges = sorted(ranges)
+
+    # The elementary intervals between all range boundaries are owned by a
+    # single range each.
+    points = sorted(set([first for first, _, _ in ranges] +
+                        [last + 1 for _, last, _ in ranges]))
+
+    flat = []
+    active = []
+    i = 0
+
+    for point, next_point in zip(points, points[1:]):
+
+        while i < len(ranges) and ranges[i][0] == point:
+            first, last, record = ranges[i]
+            heapq.heappush(active, (last - first, -first, last, record))
+            i += 1
+
+        # Ranges which ended are only dropped once they would win.
+        while active and active[0][2] < point:
+            heapq.heappop(active)
+        if not active:
+            continue
+
+        record = active[0][3]
+        if flat and flat[-1][1] == point - 1 and flat[-1][2] == record:
+            flat[-1] = (flat[-1][0], next_point - 1, record)
+        else:
+            flat.append((point, next_point - 1, record))
+
+    return flat
+
+def to_bytes( values ):
+    """
+    Return the given unsigned integers as little-endian 32-bit words.
+    """
+
+    words = array.array("I", values)
+    if sys.byteorder == "big":
+        words.byteswap()
+
+    return words.tostring()
+
+def build_index( csv_file ):
+    """
+    Parse the given geolocation CSV file and return the content of its
+    sidecar index.
+    """
+
+    st = os.stat(csv_file)
+
+    exact = {}
+    ranges = {}
+    records = []
+    strings = []
+    string_offset = skipped = 0
+
+    with open(csv_file, "r") as fd:
+        reader = csv.DictReader(fd,
+                                fieldnames = ['ip', 'lat', 'lon', 're', 'ipt'],
+                                delimiter = ',',
+                                quotechar = '"',
+                                skipinitialspace=True)
+
+        for row in reader:
+            try:
+                first, last = parse_addresses(row["ip"].strip())
+                latitude, longitude = float(row["lat"]), float(row["lon"])
+            except (ValueError, TypeError, AttributeError):
+                skipped += 1
+                continue
+
+            # Like a linear scan, the first row for an address wins.
+            if first == last:
+                if exact.has_key(first):
+                    continue
+                exact[first] = len(records)
+            else:
+                if ranges.has_key((first, last)):
+                    continue
+                ranges[(first, last)] = len(records)
+
+            string = "%s\t%s" % (row["re"] or "", row["ipt"] or "")
+            records.append(RECORD.pack(latitude, longitude, string_offset,
+                                       len(string)))
+            strings.append(string)
+            string_offset += len(string)
+
+    if skipped:
+        logger.warning("Skipped %d rows without IPv4 address or coordinates "
+                       "in `%s'." % (skipped, csv_file))
+
+    # Keep the hash table at most half full.
+    slots, bits = 1, 0
+    while slots < 2 * len(exact):
+        slots, bits = slots * 2, bits + 1
+
+    table = [0, EMPTY] * slots
+    for addr, record in exact.items():
+        slot = get_slot(addr, bits)
+        while table[2 * slot + 1] != EMPTY:
+            slot = (slot + 1) & (slots - 1)
+        table[2 * slot:2 * slot + 2] = [addr, record]
+
+    flat = flatten_ranges([(first, last, record)
+                           for (first, last), record in ranges.items()])
+
+    return b"".join([HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime, slots,
+                                 len(flat), len(records)),
+                     to_bytes(table),
+                     to_bytes([first for first, _, _ in flat]),
+                     to_bytes([last for _, last, _ in flat]),
+                     to_bytes([record for _, _, record in flat]),
+                     b"".join(records),
+                     b"".join(strings)])
+
+class MappedArray( object ):
+
+    """
+    A read-only sequence of 32-bit words in a buffer, so that bisect can
+    search a memory-mapped file without copying it.
+    """
+
+    def __init__( self, buf, offset, length ):
+
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__( self ):
+        return self.length
+
+    def __getitem__( self, i ):
+        return UINT.unpack_from(self.buf, self.offset + 4 * i)[0]
+
+class GeoIndex( object ):
+
+    """
+    Looks up the location of IP addresses in the content of a sidecar index,
+    which is either memory-mapped or held in a string.
+    """
+
+    def __init__( self, buf ):
+
+        magic, self.csv_size, self.csv_mtime, self.slots, ranges, records = \
+            HEADER.unpack_from(buf, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError("Not a geolocation index.")
+
+        self.buf = buf
+        self.bits = self.slots.bit_length() - 1
+
+        offset = HEADER.size + self.slots * 8
+        self.starts = MappedArray(buf, offset, ranges)
+        self.ends = MappedArray(buf, offset + ranges * 4, ranges)
+        self.range_records = MappedArray(buf, offset + ranges * 8, ranges)
+
+        self.records_offset = offset + ranges * 12
+        self.strings_offset = self.records_offset + records * RECORD.size
+
+    @classmethod
+    def load( cls, index_file ):
+
+        with open(index_file, "rb") as fd:
+            return cls(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def is_stale( self, csv_file ):
+
+        st = os.stat(csv_file)
+
+        return (st.st_size, st.st_mtime) != (self.csv_size, self.csv_mtime)
+
+    def find_record( self, addr ):
+        """
+        Return the record number of the given address or None.
+        """
+
+        offset = HEADER.size
+        slot = get_slot(addr, self.bits)
+
+        while True:
+            key, record = struct.unpack_from("<II", self.buf,
+                                             offset + slot * 8)
+            if record == EMPTY:
+                break
+            if key == addr:
+                return record
+            slot = (slot + 1) & (self.slots - 1)
+
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr <= self.ends[i]:
+            return self.range_records[i]
+
+        return None
+
+    def lookup( self, ip_addr ):
+        """
+        Return [latitude, longitude, region, type] of the given IP address or
+        None if it is not in the index.
+        """
+
+        try:
+            record = self.find_record(ip_to_int(ip_addr))
+        except ValueError:
+            return None
+        if record is None:
+            return None
+
+        latitude, longitude, offset, length = RECORD.unpack_from(self.buf,
+                self.records_offset + record * RECORD.size)
+        offset += self.strings_offset
+        region, machine_type = self.buf[offset:offset + length].split("\t", 1)
+
+        return [latitude, longitude, region, machine_type]
+
+def write_index( index_file, content ):
+    """
+    Atomically write the given index, so concurrent readers never see
+    half-written files.
+    """
+
+    atomic_file.write_atomically(index_file, lambda fd: fd.write(content),
+                                 0644)
+
+def open_index( csv_file ):
+    """
+    Return the GeoIndex of the given CSV file.  The sidecar index is (re)built
+    if it is missing or older than the CSV file.
+    """
+
+    if indices.has_key(csv_file):
+        return indices[csv_file]
+
+    index_file = csv_file + INDEX_SUFFIX
+
+    try:
+        index = GeoIndex.load(index_file)
+        if index.is_stale(csv_file):
+            index = None
+    except (IOError, OSError, ValueError, struct.error):
+        index = None
+
+    if index is None:
+        logger.info("Building geolocation index `%s'." % index_file)
+        content = build_index(csv_file)
+        try:
+            write_index(index_file, content)
+            index = GeoIndex.load(index_file)
+        except (IOError, OSError) as err:
+            logger.warning("Could not write geolocation index: %s" % err)
+            index = GeoIndex(content)
+
+    indices[csv_file] = index
+
+    return index
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        print >> sys.stderr, "Usage: %s LAT_LON_CSV" % sys.argv[0]
+        sys.exit(1)
+
+    open_index(sys.argv[1])
+    sys.exit(0)
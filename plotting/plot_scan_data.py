@@ -2,15 +2,21 @@
 #
 # Copyright 2014 Philipp Winter <phw@nymity.ch>
 
-import csv
 import sys
 import os
 import argparse
 import logging
 import datetime
 import time
+import math
+import multiprocessing
 
 import pygmaps
+import geo_index
+import scan_table
+import scan_cube
+import static_map
+import analysis_state
 
 LAT_LON_CSV = "gsIPs-lat-long.csv"
 
@@ -35,6 +41,23 @@ path_colours = {
     4: "#FF8800"  # Client-to-server drop.
 }
 
+# Supported map formats.  "compact" writes points and paths as JSON arrays
+# which are much smaller and faster to load for large maps.  "lod" is a compact
+# map whose points are merged into grid cells which shrink as the map is
+# zoomed in.  Both only create the markers and lines within the visible part of
+# the map.  "svg" and "png" are rendered offline by static_map.
+MAP_FORMATS = ["html", "compact", "lod", "svg", "png"]
+
+# File name suffixes of the formats which are not HTML.
+MAP_SUFFIXES = {"svg": ".svg", "png": ".png"}
+
+# (Minimum zoom level, grid cell size in degrees) of every layer of "lod" maps.
+# The last layer shows exact coordinates.
+LOD_LEVELS = [(0, 30.0), (3, 10.0), (5, 2.0), (7, None)]
+
+# The MapData shared with worker processes which render maps.
+shared_data = None
+
 class Machine( object ):
 
     """Represents a machine which is part of a scan."""
@@ -109,32 +132,45 @@ class Cluster( object ):
                "\n\t".join([str(m) for m in self.machines])
 
 def get_lat_long( loc_data, ip_addr ):
+    """
+    Return [latitude, longitude, region, type] of the given IP address as
+    listed in the given CSV file, or None if the address is unknown.
+    """
 
-    fd = open(loc_data, 'r')
-    reader = csv.DictReader(fd,
-                            fieldnames = ['ip', 'lat', 'lon', 're', 'ipt'],
-                            delimiter = ',',
-                            quotechar = '"',
-                            skipinitialspace=True)
-
-    loc_data = list(reader)
-
-    for lats in loc_data:
-        if ip_addr in lats['ip']:
-            return [lats['lat'], lats['lon'], lats['re'], lats['ipt']]
-
-    return None
+    return geo_index.open_index(loc_data).lookup(ip_addr)
 
-def print_clusters( clusters, file_name ):
+def new_map( map_format="html" ):
     """
-    Analyse all clusters and write a map to the given file.
+    Return an empty map of the given format.
     """
 
     # arg1: start latitude
     # arg2: start longitude
     # arg3: default zoom level (must be in {0..20})
 
-    my_map = pygmaps.maps(0, 0, 2)
+    if map_format == "svg":
+        return static_map.SvgMap()
+    elif map_format == "png":
+        return static_map.PngMap()
+
+    return pygmaps.maps(0, 0, 2, compact=(map_format in ("compact", "lod")))
+
+def get_map_name( file_name, map_format ):
+    """
+    Replace the suffix of the given file name with the one of the format.
+    """
+
+    if not MAP_SUFFIXES.has_key(map_format):
+        return file_name
+
+    return os.path.splitext(file_name)[0] + MAP_SUFFIXES[map_format]
+
+def print_clusters( clusters, file_name, map_format="html" ):
+    """
+    Analyse all clusters and write a map to the given file.
+    """
+
+    my_map = new_map(map_format)
 
     # First, parse all scans and create dictionaries for the markers/points as
     # well as paths.
@@ -144,13 +180,14 @@ def print_clusters( clusters, file_name ):
               "#770000", "#007700", "#000077", "#777700", "#007777",
               "#770077"]
 
-    for cluster in clusters:
+    for i, cluster in enumerate(clusters):
 
         points = {}
 
-        # Determine cluster color.
+        # Determine cluster color.  Colours are reused if there are more
+        # clusters than colours.
 
-        color = colors.pop(0)
+        color = colors[i % len(colors)]
 
         # points key=coordinates, value=ip address(es)
 
@@ -168,22 +205,21 @@ def print_clusters( clusters, file_name ):
     logger.info("Writing output to \"%s\"." % file_name)
     my_map.draw(file_name)
 
-def print_map( scans, file_name ):
+def print_map( scans, file_name, map_format="html" ):
     """
     Analyse all scans and write a map to the given file.
     """
 
-    global icon_paths
-    global path_colours
-
-    # arg1: start latitude
-    # arg2: start longitude
-    # arg3: default zoom level (must be in {0..20})
+    points, paths = aggregate_scans(scans)
+    plot_aggregates(points, paths, file_name, map_format)
 
-    my_map = pygmaps.maps(0, 0, 2)
+def aggregate_scans( scans ):
+    """
+    Return the point and path bitmaps of the given scans as dictionaries.
+    """
 
-    # First, parse all scans and create dictionaries for the markers/points as
-    # well as paths.
+    # Parse all scans and create dictionaries for the markers/points as well
+    # as paths.
 
     points = {}
     paths = {}
@@ -217,6 +253,19 @@ def print_map( scans, file_name ):
         else:
             points[dst_coordinates] = 2
 
+    return (points, paths)
+
+def plot_aggregates( points, paths, file_name, map_format="html" ):
+    """
+    Plot the point and path bitmaps returned by aggregate_scans() and write
+    the map to the given file.
+    """
+
+    global icon_paths
+    global path_colours
+
+    my_map = new_map(map_format)
+
     # Now that we have all our points, plot them.  Depending on the determined
     # bitmap, we plot the source, destination, or hybrid icon for the point.
 
@@ -242,33 +291,261 @@ def print_map( scans, file_name ):
     logger.info("Writing output to \"%s\"." % file_name)
     my_map.draw(file_name)
 
-def parse_file( file_name ):
+def add_aggregates( my_map, points, point_bits, point_counts, paths,
+                    path_bits, path_counts, counted=False ):
     """
-    Read the entire given file and create scan objects out of the data.
+    Add the points and paths returned by MapData.aggregate() to the given map.
+    If `counted' is set, points are titled with their number of scans and
+    paths get wider with their number of scans.
     """
 
-    scans = []
-    fd = open(file_name, 'r')
+    for (latitude, longitude), bitmap, count in zip(points.tolist(),
+                                                    point_bits.tolist(),
+                                                    point_counts.tolist()):
+        title = "%d scans" % count if counted else "n/a"
+        my_map.addpoint(latitude, longitude, "#FFFFFF",
+                        icon=icon_paths[bitmap], title=title)
 
-    while True:
-        line = fd.readline()
-        if not line:
-            break
-        line = line.strip()
+    for (src_lat, src_lon, dst_lat, dst_lon), bitmap, count in \
+        zip(paths.tolist(), path_bits.tolist(), path_counts.tolist()):
+
+        colour = path_colours.get(bitmap, "#0000FF")
+        weight = 1 + int(math.log10(count)) if counted else 1
+        my_map.addpath([(src_lat, src_lon), (dst_lat, dst_lon)], color=colour,
+                       weight=weight)
 
-        values = line.split(' ')
-        src_host = Machine(values[1], float(values[2]), float(values[3]),
-                           values[7], values[8])
-        dst_host = Machine(values[4], float(values[5]), float(values[6]),
-                           values[9], values[10])
+def draw_map( data, rows, file_name, map_format="html" ):
+    """
+    Plot the given rows of a MapData, or all of them, like print_map().
+    """
 
-        scans.append(Scan(int(values[0]), src_host, dst_host, int(values[11])))
+    my_map = new_map(map_format)
+
+    if map_format != "lod":
+        add_aggregates(my_map, *data.aggregate(rows))
+    else:
+        for min_zoom, cell_size in LOD_LEVELS:
+            my_map.addlayer(min_zoom)
+            add_aggregates(my_map, *data.aggregate(rows, cell_size),
+                           counted=True)
+
+    logger.info("Writing output to \"%s\"." % file_name)
+    my_map.draw(file_name)
+
+def init_worker( data ):
+
+    global shared_data
+    shared_data = data
+
+def render_job( job ):
+    """
+    Render a single map.  This is executed in a worker process.
+    """
+
+    kind, file_name, payload, map_format = job
+
+    if kind == "clusters":
+        print_clusters(payload, file_name, map_format)
+    elif kind == "bitmaps":
+        plot_aggregates(payload[0], payload[1], file_name, map_format)
+    else:
+        draw_map(shared_data, payload, file_name, map_format)
+
+    return file_name
+
+def render_maps( data, jobs, processes=None ):
+    """
+    Render all given (kind, file name, payload, format) jobs.  "clusters" jobs
+    plot a list of clusters, "bitmaps" jobs the (points, paths) bitmaps of
+    aggregate_scans() and "scans" jobs the rows of the given MapData which are
+    listed in the payload, or all rows if it is None.
+
+    The MapData is moved into shared memory before the worker processes are
+    forked, so they all read the same copy.
+    """
+
+    processes = min(processes or multiprocessing.cpu_count(), len(jobs))
+    if processes <= 1:
+        init_worker(data)
+        return [render_job(job) for job in jobs]
+
+    pool = multiprocessing.Pool(processes, initializer=init_worker,
+                                initargs=(data.share(),))
+    try:
+        return pool.map(render_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def get_bitmaps( data, rows=None ):
+    """
+    Return the point and path bitmaps of the given rows of a MapData, or of
+    all of them, like aggregate_scans() does.
+    """
+
+    points, point_bits, _, paths, path_bits, _ = data.aggregate(rows)
+
+    return (dict(zip(points.tolist(), point_bits.tolist())),
+            dict([(((src_lat, src_lon), (dst_lat, dst_lon)), bitmap)
+                  for (src_lat, src_lon, dst_lat, dst_lon), bitmap
+                  in zip(paths.tolist(), path_bits.tolist())]))
+
+def get_options( args ):
+    """
+    Return the options which determine the content of an analysis directory.
+    """
+
+    options = {"datafile": os.path.abspath(args.datafile),
+               "region": args.region,
+               "hour": args.hour,
+               "type": args.type,
+               "verdict": args.verdict,
+               "address": args.address,
+               "format": args.format,
+               "write": args.write,
+               "cluster": None}
+
+    if args.cluster:
+        st = os.stat(args.cluster)
+        options["cluster"] = (os.path.abspath(args.cluster), st.st_size,
+                              st.st_mtime)
+
+    return options
+
+def update_analysis( args ):
+    """
+    Bring the given analysis directory up to date with the idle scans which
+    were appended to the scan file since its last update.  Only maps whose
+    bitmaps changed are redrawn.  If the directory has no state yet, or was
+    built with other options or from a rewritten scan file, it is built from
+    scratch.
+    """
+
+    dirname = args.directory
+    if not os.path.isdir(dirname):
+        mkdir_analysis(dirname)
+
+    options = get_options(args)
+    state = analysis_state.load(dirname)
+    rebuild = state is None or not state.is_valid(options, args.datafile)
+    if rebuild:
+        logger.info("Building analysis directory `%s' from scratch." % dirname)
+        state = analysis_state.AnalysisState(options)
+
+    jobs = []
+    clusters = []
+
+    if args.cluster:
+        logger.debug("Parsing IP address cluster file `%s'." % args.cluster)
+        clusters = parse_clusters(args.cluster)
+        file_name = get_map_name("%s/ip_addr_clusters.html" % dirname,
+                                 args.format)
+        if rebuild or not os.path.exists(file_name):
+            jobs.append(("clusters", file_name, clusters, args.format))
+
+    table = scan_table.ScanTable.from_file(args.datafile, state.offset,
+                                           complete=True)
+    logger.info("Read %d new idle scans from file `%s'." %
+                (len(table), args.datafile))
+
+    mask = table.filter(region=args.region, hour=args.hour,
+                        machine_type=args.type, verdict=args.verdict,
+                        address=args.address)
+    data = scan_table.MapData(table, mask)
+
+    maps = [(get_map_name("%s/%s" % (dirname, args.write), args.format),
+             None)]
+
+    if clusters:
+        index = scan_table.AddressIndex(table, mask)
+        for cluster in clusters:
+            file_name = "%s/cluster_%s.html" % (dirname, cluster.cluster_id)
+            maps.append((get_map_name(file_name, args.format),
+                         index.lookup([machine.ip_addr
+                                       for machine in cluster])))
+
+    for file_name, rows in maps:
+        points, paths = get_bitmaps(data, rows)
+        if state.update(file_name, points, paths) or \
+           not os.path.exists(file_name):
+            jobs.append(("bitmaps", file_name, state.maps[file_name],
+                         args.format))
+
+    logger.info("Redrawing %d of %d maps." %
+                (len(jobs), len(maps) + (1 if clusters else 0)))
+    render_maps(data, jobs, args.jobs)
+
+    state.advance(args.datafile, table.end)
+    analysis_state.save(dirname, state)
+
+    return 0
+
+def load_table( file_name ):
+    """
+    Read the entire given file into a ScanTable.
+    """
+
+    table = scan_table.ScanTable.from_file(file_name)
 
     logger.info("Read %d idle scans from file `%s'." %
-                (len(scans), file_name))
+                (len(table), file_name))
+
+    return table
+
+def get_scans( table, mask=slice(None) ):
+    """
+    Create scan objects out of the rows of the given table which are selected
+    by the given mask.
+    """
+
+    addresses = table.addresses.values
+    regions = table.regions.values
+    types = table.types.values
+
+    scans = []
+
+    for verdict, src_addr, src_lat, src_lon, dst_addr, dst_lat, dst_lon, \
+        src_region, src_type, dst_region, dst_type, hour \
+        in table.rows[mask].tolist():
+
+        src_host = Machine(addresses[src_addr], src_lat, src_lon,
+                           regions[src_region], types[src_type])
+        dst_host = Machine(addresses[dst_addr], dst_lat, dst_lon,
+                           regions[dst_region], types[dst_type])
+
+        scans.append(Scan(verdict, src_host, dst_host, hour))
 
     return scans
 
+def query_counts( args ):
+    """
+    Print the number of scans of every verdict which pass the user's filters.
+    The counts come from the aggregate cube unless an address is given, which
+    the cube does not know about.
+    """
+
+    if args.address is None:
+        cube = scan_cube.open_cube(args.datafile)
+        counts = cube.count(region=args.region, hour=args.hour,
+                            machine_type=args.type, verdict=args.verdict)
+    else:
+        table = load_table(args.datafile)
+        mask = table.filter(region=args.region, hour=args.hour,
+                            machine_type=args.type, verdict=args.verdict,
+                            address=args.address)
+        counts = scan_cube.count_verdicts(table.rows["verdict"][mask])
+
+    for verdict, count in enumerate(counts.tolist()):
+        print "Verdict %d: %d" % (verdict, count)
+    print "Total: %d" % sum(counts.tolist())
+
+def parse_file( file_name ):
+    """
+    Read the entire given file and create scan objects out of the data.
+    """
+
+    return get_scans(load_table(file_name))
+
 def parse_clusters( file_name ):
     """
     Read the entire given file and create cluster objects out of the data.
@@ -344,10 +621,42 @@ def parse_arguments( args ):
                         help="Only display search result without printing "
                              "HTML/JavaScript.  Useful for manual analysis.")
 
+    parser.add_argument("-q", "--query",
+                        action="store_true",
+                        help="Only print the number of scans of every verdict "
+                             "which pass the filters.  The counts are taken "
+                             "from an aggregate cube which is stored next to "
+                             "the idle scan file.")
+
     parser.add_argument("-c", "--cluster", metavar="CLUSTER_FILE",
                         type=str, help="Use the given cluster file.")
 
-    return parser.parse_args()
+    parser.add_argument("-f", "--format", metavar="FORMAT", type=str,
+                        choices=MAP_FORMATS, default="html",
+                        help="Format of the written maps: %s (default: "
+                             "html)." % ", ".join(MAP_FORMATS))
+
+    parser.add_argument("-u", "--update",
+                        action="store_true",
+                        help="Incrementally update the analysis directory "
+                             "given by --directory with the idle scans which "
+                             "were appended since its last update.")
+
+    parser.add_argument("-j", "--jobs", metavar="NUM", type=int, default=None,
+                        help="Number of worker processes which render maps "
+                             "(default: number of CPUs).")
+
+    args = parser.parse_args()
+
+    if args.update:
+        if not args.directory:
+            parser.error("--update requires --directory.")
+        if args.inspect:
+            parser.error("--update cannot be combined with --inspect.")
+        if args.format == "lod":
+            parser.error("--update does not support the lod format.")
+
+    return args
 
 def mkdir_analysis( dirname ):
     """
@@ -373,72 +682,72 @@ def main( ):
 
     args = parse_arguments(sys.argv[0:])
 
+    if args.query:
+        query_counts(args)
+        return 0
+
+    if args.update:
+        return update_analysis(args)
+
     dirname = mkdir_analysis(args.directory)
 
+    # All maps are collected as jobs first and then rendered in parallel.
+    jobs = []
+
     if args.cluster:
         logger.debug("Parsing IP address cluster file `%s'." % args.cluster)
         clusters = parse_clusters(args.cluster)
-        print_clusters(clusters, "%s/ip_addr_clusters.html" % dirname)
+        jobs.append(("clusters",
+                     get_map_name("%s/ip_addr_clusters.html" % dirname,
+                                  args.format),
+                     clusters, args.format))
 
     logger.debug("Parsing idle scan file `%s'." % args.datafile)
-    scans = parse_file(args.datafile)
+    table = load_table(args.datafile)
 
-    # Filter scans based on the user's parameters.
+    # Filter scans based on the user's parameters.  Scan objects are only
+    # created for the scans which pass all filters.
 
     logger.debug("Filtering idle scan data.")
 
-    if args.region is not None:
-        scans = filter(lambda scan: scan.src_host.region == args.region or
-                                    scan.dst_host.region == args.region, scans)
-
-    if args.hour is not None:
-        scans = filter(lambda scan: scan.hour == args.hour, scans)
-
-    if args.type is not None:
-        scans = filter(lambda scan: scan.src_host.machine_type == args.type or
-                                    scan.dst_host.machine_type == args.type,
-                       scans)
-
-    if args.verdict is not None:
-        scans = filter(lambda scan: scan.scan_verdict == args.verdict, scans)
-
-    if args.address is not None:
-        scans = filter(lambda scan: scan.src_host.ip_addr == args.address or
-                                    scan.dst_host.ip_addr == args.address,
-                       scans)
+    mask = table.filter(region=args.region, hour=args.hour,
+                        machine_type=args.type, verdict=args.verdict,
+                        address=args.address)
+    data = scan_table.MapData(table, mask)
 
     # Depending on what user wants, print object representations or
     # browser-ready HTML/JavaScript.
 
-    if not scans:
+    if not len(data):
         logger.warning("No scan data after filtering steps.")
     else:
-        logger.info("%d idle scans remain after filtering step." % len(scans))
+        logger.info("%d idle scans remain after filtering step." % len(data))
 
     if args.inspect:
-        for scan in scans:
+        for scan in get_scans(table, mask):
             print scan
     else:
-        print_map(scans, "%s/%s" % (dirname, args.write))
-        logger.info("Wrote HTML data to `%s'." % args.write)
+        jobs.append(("scans", get_map_name("%s/%s" % (dirname, args.write),
+                                           args.format),
+                     None, args.format))
 
     # Create cluster-specific scan maps.  Every scan in all scan maps contains
     # an IP address which is part of a cluster.
 
-    if not args.cluster:
-        return 0
-
-    for cluster in clusters:
+    if args.cluster:
+        index = scan_table.AddressIndex(table, mask)
 
-        cluster_scans = []
+        for cluster in clusters:
+            rows = index.lookup([machine.ip_addr for machine in cluster])
+            file_name = "%s/cluster_%s.html" % (dirname, cluster.cluster_id)
+            jobs.append(("scans", get_map_name(file_name, args.format), rows,
+                         args.format))
 
-        for machine in cluster:
-            for scan in scans:
-                if machine.ip_addr in scan.get_ip_addresses():
-                    cluster_scans.append(scan)
+    render_maps(data, jobs, args.jobs)
 
-        print_map(cluster_scans, "%s/cluster_%s.html" % (dirname,
-                                                         cluster.cluster_id))
+    if not args.inspect:
+        logger.info("Wrote map data to `%s'." %
+                    get_map_name(args.write, args.format))
 
     return 0
 
@@ -1,12 +1,17 @@
 import math
+import json
+from array import array
 ###########################################################
 ## Google map python wrapper V0.1
 ## 
 ############################################################
 
+# Numbers written per chunk in compact mode.
+CHUNK = 4096
+
 class maps:
 
-    def __init__(self, centerLat, centerLng, zoom ):
+    def __init__(self, centerLat, centerLng, zoom, compact = False):
         self.center = (float(centerLat),float(centerLng))
         self.zoom = int(zoom)
         self.grids = None
@@ -16,10 +21,40 @@ class maps:
         self.gridsetting = None
         self.coloricon = 'http://chart.apis.google.com/chart?cht=mm&chs=12x16&chco=FFFFFF,XXXXXX,000000&ext=.png'
 
+        # In compact mode, points and paths are kept in flat arrays and
+        # written as JSON which a single loop turns into markers and lines.
+        # Colours, icons and titles are stored once and referenced by index.
+        self.compact = compact
+        self.styles = {}
+        self.stylelist = []
+        self.pointdata = array('d')    # lat, lng
+        self.pointstyles = array('L')  # colour, icon, title
+        self.pathdata = array('d')     # lat, lng, lat, lng, ...
+        self.pathinfo = array('L')     # number of coordinates, colour, weight
+        # Minimum zoom and start offsets into pointdata, pathinfo and
+        # pathdata of every layer.  Only one layer is shown at a time.
+        self.layers = array('L')
+
+    def getstyle(self, value):
+        index = self.styles.get(value)
+        if index is None:
+            index = self.styles[value] = len(self.stylelist)
+            self.stylelist.append(value)
+        return index
+
+    def addlayer(self, minzoom):
+        # Points and paths added from now on are only shown from the given
+        # zoom level until the next layer's zoom level.  Compact mode only.
+        self.layers.extend((minzoom,len(self.pointdata),len(self.pathinfo),len(self.pathdata)))
+
     def setgrids(self,slat,elat,latin,slng,elng,lngin):
         self.gridsetting = [slat,elat,latin,slng,elng,lngin]
 
     def addpoint(self, lat, lng, color = '#FF0000', icon=None, title="n/a"):
+        if self.compact:
+            self.pointdata.extend((lat,lng))
+            self.pointstyles.extend((self.getstyle(color[1:]),self.getstyle(icon),self.getstyle(title)))
+            return
         self.points.append((lat,lng,color[1:],icon,title))
 
     #def addpointcoord(self, coord):
@@ -28,13 +63,19 @@ class maps:
     def addradpoint(self, lat,lng,rad,color = '#0000FF'):
         self.radpoints.append((lat,lng,rad,color))
 
-    def addpath(self,path,color = '#FF0000'):
+    def addpath(self,path,color = '#FF0000',weight = 1):
+        if self.compact:
+            for coordinate in path:
+                self.pathdata.extend(coordinate[:2])
+            self.pathinfo.extend((len(path),self.getstyle(color),weight))
+            return
         path.append(color)
+        path.append(weight)
         self.paths.append(path)
     
     #create the html file which inlcude one google map and all points and paths
     def draw(self, htmlfile):
-        f = open(htmlfile,'w')
+        f = open(htmlfile,'w',1024*1024)
         f.write('<html>\n')
         f.write('<head>\n')
         f.write('<meta name="viewport" content="initial-scale=1.0, user-scalable=no" />\n')
@@ -48,6 +89,8 @@ class maps:
         self.drawpoints(f)
         self.drawradpoints(f)
         self.drawpaths(f,self.paths)
+        if self.compact:
+            self.drawcompact(f)
         f.write('\t}\n')
         f.write('</script>\n')
         f.write('</head>\n')
@@ -108,7 +151,25 @@ class maps:
     def drawpaths(self, f, paths):
         for path in paths:
             #print path
-            self.drawPolyline(f,path[:-1], strokeColor = path[-1])
+            self.drawPolyline(f,path[:-2], strokeColor = path[-2], strokeWeight = path[-1])
+
+    def writearray(self, f, name, values, fmt):
+        f.write('var %s = [' % name)
+        for i in range(0, len(values), CHUNK):
+            if i:
+                f.write(',')
+            f.write(','.join([fmt % value for value in values[i:i+CHUNK]]))
+        f.write('];\n')
+
+    def drawcompact(self, f):
+        f.write('var styles = %s;\n' % json.dumps(self.stylelist, separators=(',',':')).replace('</','<\\/'))
+        f.write('var coloricon = "%s";\n' % self.coloricon)
+        self.writearray(f, 'points', self.pointdata, '%.10g')
+        self.writearray(f, 'pointstyles', self.pointstyles, '%d')
+        self.writearray(f, 'paths', self.pathdata, '%.10g')
+        self.writearray(f, 'pathinfo', self.pathinfo, '%d')
+        self.writearray(f, 'layers', self.layers or array('L', (0,0,0,0)), '%d')
+        f.write(COMPACT_LOOP)
 
     #############################################
     # # # # # # Low level Map Drawing # # # # # # 
@@ -192,6 +253,132 @@ class maps:
         f.write('polygon.setMap(map);\n')
         f.write('\n\n')
 
+# Turns the arrays written by drawcompact() into markers and polylines.  Only
+# the objects of the layers of the current zoom level which lie within the
+# map's bounds are shown, and every object is created when it is first shown.
+COMPACT_LOOP = """\
+var layerstate = [], layervisible = [];
+function tovector(lat, lng) {
+lat *= Math.PI / 180;
+lng *= Math.PI / 180;
+return [Math.cos(lat) * Math.cos(lng), Math.cos(lat) * Math.sin(lng), Math.sin(lat)];
+}
+function cross(u, v) {
+return [u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2], u[0] * v[1] - u[1] * v[0]];
+}
+function dot(u, v) {
+return u[0] * v[0] + u[1] * v[1] + u[2] * v[2];
+}
+function extendarc(path, j) {
+// Geodesic lines bulge towards the poles, so the bounds of a path also
+// cover the northern- and southernmost point of every great circle arc.
+var a = tovector(paths[j], paths[j + 1]), c = tovector(paths[j + 2], paths[j + 3]), n = cross(a, c);
+var top = [-n[0] * n[2], -n[1] * n[2], n[0] * n[0] + n[1] * n[1]];
+var lat = Math.atan2(top[2], Math.sqrt(top[0] * top[0] + top[1] * top[1])) * 180 / Math.PI;
+if (dot(cross(a, top), n) > 0 && dot(cross(top, c), n) > 0) {
+path[3] = Math.max(path[3], lat);
+}
+var bottom = [-top[0], -top[1], -top[2]];
+if (dot(cross(a, bottom), n) > 0 && dot(cross(bottom, c), n) > 0) {
+path[2] = Math.min(path[2], -lat);
+}
+// Arcs across the antimeridian may lie at any longitude.
+if (Math.abs(paths[j + 1] - paths[j + 3]) > 180) {
+path[4] = -180;
+path[5] = 180;
+}
+}
+function getlayer(l) {
+if (layerstate[l]) {
+return layerstate[l];
+}
+var next = 4 * l + 4, last = next >= layers.length;
+var state = {points: layers[4 * l + 1], pointend: last ? points.length : layers[next + 1], paths: [], objects: [], shown: []};
+var infoend = last ? pathinfo.length : layers[next + 2];
+for (var i = layers[4 * l + 2], j = layers[4 * l + 3]; i < infoend; i += 3) {
+var path = [i, j, 90, -90, 180, -180];
+for (var k = 0; k < pathinfo[i]; k++, j += 2) {
+path[2] = Math.min(path[2], paths[j]);
+path[3] = Math.max(path[3], paths[j]);
+path[4] = Math.min(path[4], paths[j + 1]);
+path[5] = Math.max(path[5], paths[j + 1]);
+}
+for (var k = path[1]; k + 2 < j; k += 2) {
+extendarc(path, k);
+}
+state.paths.push(path);
+}
+return layerstate[l] = state;
+}
+function overlaps(b, south, north, west, east) {
+if (north < b.south || south > b.north) {
+return false;
+}
+if (b.west <= b.east) {
+return east >= b.west && west <= b.east;
+}
+return east >= b.west || west <= b.east;
+}
+function makeobject(state, n) {
+var count = (state.pointend - state.points) / 2;
+if (n < count) {
+var i = state.points + 2 * n, j = 3 * i / 2;
+return new google.maps.Marker({
+title: styles[pointstyles[j + 2]],
+icon: styles[pointstyles[j + 1]] || coloricon.replace("XXXXXX", styles[pointstyles[j]]),
+position: new google.maps.LatLng(points[i], points[i + 1])
+});
+}
+var i = state.paths[n - count][0], j = state.paths[n - count][1], coords = [];
+for (var k = 0; k < pathinfo[i]; k++, j += 2) {
+coords.push(new google.maps.LatLng(paths[j], paths[j + 1]));
+}
+return new google.maps.Polyline({
+clickable: false,
+geodesic: true,
+path: coords,
+strokeColor: styles[pathinfo[i + 1]],
+strokeOpacity: 0.5,
+strokeWeight: pathinfo[i + 2]
+});
+}
+function showobject(state, n, show) {
+if (show == !!state.shown[n]) {
+return;
+}
+if (!state.objects[n]) {
+state.objects[n] = makeobject(state, n);
+}
+state.objects[n].setMap(show ? map : null);
+state.shown[n] = show;
+}
+function showlayers() {
+var bounds = map.getBounds();
+if (!bounds) {
+return;
+}
+var sw = bounds.getSouthWest(), ne = bounds.getNorthEast();
+var b = {south: sw.lat(), north: ne.lat(), west: sw.lng(), east: ne.lng()};
+var zoom = map.getZoom();
+for (var l = 0; 4 * l < layers.length; l++) {
+var visible = zoom >= layers[4 * l] && (4 * l + 4 >= layers.length || zoom < layers[4 * l + 4]);
+if (!visible && !layervisible[l]) {
+continue;
+}
+var state = getlayer(l), n = 0;
+for (var i = state.points; i < state.pointend; i += 2, n++) {
+showobject(state, n, visible && overlaps(b, points[i], points[i], points[i + 1], points[i + 1]));
+}
+for (var p = 0; p < state.paths.length; p++, n++) {
+var path = state.paths[p];
+showobject(state, n, visible && overlaps(b, path[2], path[3], path[4], path[5]));
+}
+layervisible[l] = visible;
+}
+}
+google.maps.event.addListener(map, "idle", showlayers);
+"""
+
 if __name__ == "__main__":
 
     ########## CONSTRUCTOR: pygmaps(latitude, longitude, zoom) ##############################
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# A precomputed aggregate cube over an idle scan file.  The cube counts the
+# scans of every combination of source and destination region, source and
+# destination machine type, hour and verdict.  It is stored in a sidecar file
+# next to the scan file, so counting the scans which pass a set of filters
+# does not require parsing the scan file again.
+
+import os
+import sys
+import logging
+
+import numpy
+
+import scan_table
+import atomic_file
+
+logger = logging.getLogger()
+
+CUBE_SUFFIX = ".cube"
+
+# The cube's dimensions.  They carry the same names as the columns of a
+# ScanTable, so both are filtered by scan_table.get_mask().
+DIMENSIONS = ["src_region", "src_type", "dst_region", "dst_type", "hour",
+              "verdict"]
+
+KEY_DTYPE = numpy.dtype([(name, scan_table.SCAN_DTYPE[name])
+                         for name in DIMENSIONS])
+
+CUBE_DTYPE = numpy.dtype(KEY_DTYPE.descr + [("count", numpy.uint64)])
+
+class ScanCube( object ):
+
+    """
+    Holds one row per combination of dimensions which occurs in an idle scan
+    file, together with its number of scans.
+    """
+
+    def __init__( self, rows, regions, types, scan_size=0, scan_mtime=0 ):
+
+        self.rows = rows
+        self.regions = scan_table.Categories(regions)
+        self.types = scan_table.Categories(types)
+        self.scan_size = scan_size
+        self.scan_mtime = scan_mtime
+
+    def __len__( self ):
+        return len(self.rows)
+
+    @classmethod
+    def from_table( cls, table ):
+        """
+        Aggregate the rows of the given ScanTable.
+        """
+
+        keys = numpy.empty(len(table), dtype=KEY_DTYPE)
+        for name in DIMENSIONS:
+            keys[name] = table.rows[name]
+
+        keys, counts = numpy.unique(keys, return_counts=True)
+
+        rows = numpy.empty(len(keys), dtype=CUBE_DTYPE)
+        for name in DIMENSIONS:
+            rows[name] = keys[name]
+        rows["count"] = counts
+
+        return cls(rows, table.regions.values, table.types.values)
+
+    @classmethod
+    def load( cls, cube_file ):
+
+        with open(cube_file, "rb") as fd:
+            cube = numpy.load(fd)
+            scan_size, scan_mtime = cube["source"].tolist()
+            return cls(cube["rows"], cube["regions"].tolist(),
+                       cube["types"].tolist(), scan_size, scan_mtime)
+
+    def is_stale( self, scan_file ):
+
+        st = os.stat(scan_file)
+
+        return (st.st_size, st.st_mtime) != (self.scan_size, self.scan_mtime)
+
+    def save( self, cube_file ):
+        """
+        Atomically write the cube, so concurrent readers never see
+        half-written files.
+        """
+
+        def write( fd ):
+            numpy.savez(fd, rows=self.rows,
+                        regions=numpy.array(self.regions.values, dtype=str),
+                        types=numpy.array(self.types.values, dtype=str),
+                        source=numpy.array([self.scan_size, self.scan_mtime]))
+
+        atomic_file.write_atomically(cube_file, write, 0644)
+
+    def count( self, region=None, hour=None, machine_type=None,
+               verdict=None ):
+        """
+        Return an array holding the number of scans which pass all given
+        filters for every verdict.  Filters which are None are ignored.
+        """
+
+        mask = scan_table.get_mask(self.rows, self.regions, self.types, None,
+                                   region, hour, machine_type, verdict)
+
+        return count_verdicts(self.rows["verdict"][mask],
+                              self.rows["count"][mask])
+
+def count_verdicts( verdicts, weights=None ):
+    """
+    Return the number of scans of every verdict, given the verdicts of rows
+    which stand for `weights' scans each.
+    """
+
+    counts = numpy.bincount(verdicts, weights=weights, minlength=4)
+
+    return counts.astype(numpy.uint64)
+
+def build_cube( scan_file ):
+    """
+    Parse the given idle scan file and return its cube.
+    """
+
+    st = os.stat(scan_file)
+
+    cube = ScanCube.from_table(scan_table.ScanTable.from_file(scan_file))
+    cube.scan_size, cube.scan_mtime = st.st_size, st.st_mtime
+
+    return cube
+
+def open_cube( scan_file ):
+    """
+    Return the ScanCube of the given idle scan file.  The sidecar cube is
+    (re)built if it is missing or older than the scan file.
+    """
+
+    cube_file = scan_file + CUBE_SUFFIX
+
+    try:
+        cube = ScanCube.load(cube_file)
+        if not cube.is_stale(scan_file):
+            return cube
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    logger.info("Building aggregate cube `%s'." % cube_file)
+    cube = build_cube(scan_file)
+    try:
+        cube.save(cube_file)
+    except (IOError, OSError) as err:
+        logger.warning("Could not write aggregate cube: %s" % err)
+
+    return cube
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        print >> sys.stderr, "Usage: %s IDLE_SCAN_FILE" % sys.argv[0]
+        sys.exit(1)
+
+    open_cube(sys.argv[1])
+    sys.exit(0)
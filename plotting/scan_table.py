@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Holds idle scan files in a columnar NumPy table.  Every line of an idle scan
+# file becomes a row of a structured array; IP addresses, regions and machine
+# types are interned as integer codes.  Filters are evaluated as one combined
+# boolean mask over the whole table.
+
+import multiprocessing
+
+import numpy
+
+# Number of whitespace-separated fields of every line, which has the format:
+# verdict src_ip src_lat src_lon dst_ip dst_lat dst_lon src_region src_type
+# dst_region dst_type hour
+FIELDS = 12
+
+# The table's columns in the same order as the file's fields.
+SCAN_DTYPE = numpy.dtype([("verdict", numpy.uint8),
+                          ("src_addr", numpy.uint32),
+                          ("src_lat", numpy.float64),
+                          ("src_lon", numpy.float64),
+                          ("dst_addr", numpy.uint32),
+                          ("dst_lat", numpy.float64),
+                          ("dst_lon", numpy.float64),
+                          ("src_region", numpy.uint16),
+                          ("src_type", numpy.uint16),
+                          ("dst_region", numpy.uint16),
+                          ("dst_type", numpy.uint16),
+                          ("hour", numpy.uint8)])
+
+# Amount of the file which is parsed at once.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+POINT_DTYPE = numpy.dtype([("lat", numpy.float64), ("lon", numpy.float64)])
+
+PATH_DTYPE = numpy.dtype([("src_lat", numpy.float64),
+                          ("src_lon", numpy.float64),
+                          ("dst_lat", numpy.float64),
+                          ("dst_lon", numpy.float64)])
+
+# Point bitmap flags of scan sources and destinations.
+SOURCE = 1
+DESTINATION = 2
+
+def share_array( values ):
+    """
+    Return a copy of the given array which lives in shared memory.  Worker
+    processes which are forked afterwards read it without copying it.
+    """
+
+    raw = multiprocessing.RawArray("b", max(values.nbytes, 1))
+    shared = numpy.frombuffer(raw, dtype=values.dtype, count=len(values))
+    shared[...] = values
+
+    return shared
+
+def or_reduce( groups, values, count ):
+    """
+    Return the bitwise OR of the values in each of `count' groups.
+    """
+
+    result = numpy.zeros(count, dtype=numpy.uint8)
+    if not len(values):
+        return result
+
+    bit = 1
+    while bit <= values.max():
+        hits = numpy.bincount(groups, weights=values & bit, minlength=count)
+        result |= (hits > 0).astype(numpy.uint8) * bit
+        bit <<= 1
+
+    return result
+
+def get_mask( rows, regions, types, addresses, region=None, hour=None,
+              machine_type=None, verdict=None, address=None ):
+    """
+    Return a boolean mask of the given rows which pass all given filters.  A
+    region, machine type or address matches if either the source or the
+    destination has it.  Filters which are None are ignored.
+    """
+
+    mask = numpy.ones(len(rows), dtype=bool)
+
+    def either( column, categories, value ):
+        code = categories.get_code(value)
+        if code is None:
+            return numpy.zeros(len(rows), dtype=bool)
+        return (rows["src_" + column] == code) | \
+               (rows["dst_" + column] == code)
+
+    if region is not None:
+        mask &= either("region", regions, region)
+
+    if hour is not None:
+        mask &= rows["hour"] == hour
+
+    if machine_type is not None:
+        mask &= either("type", types, machine_type)
+
+    if verdict is not None:
+        mask &= rows["verdict"] == verdict
+
+    if address is not None:
+        mask &= either("addr", addresses, address)
+
+    return mask
+
+class Categories( object ):
+
+    """
+    Interns strings, e.g., regions, as small integer codes.
+    """
+
+    def __init__( self, values=() ):
+
+        self.values = []
+        self.codes = {}
+
+        for value in values:
+            self.add(value)
+
+    def __len__( self ):
+        return len(self.values)
+
+    def add( self, value ):
+
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+
+        return code
+
+    def get_code( self, value ):
+        """
+        Return the code of the given string or None if it is unknown.
+        """
+
+        return self.codes.get(value)
+
+    def intern( self, column ):
+        """
+        Return an array holding the codes of all strings in the given list.
+        """
+
+        for value in set(column).difference(self.codes):
+            self.add(value)
+
+        return numpy.array(map(self.codes.__getitem__, column),
+                           dtype=numpy.uint32)
+
+class ScanTable( object ):
+
+    """
+    Holds idle scans with one row per scan in the structured array `rows'.
+
+    The address columns hold codes of `addresses', the region columns codes
+    of `regions' and the machine type columns codes of `types'.
+    """
+
+    def __init__( self ):
+
+        self.rows = numpy.zeros(0, dtype=SCAN_DTYPE)
+        self.end = 0
+        self.addresses = Categories()
+        self.regions = Categories()
+        self.types = Categories()
+
+    def __len__( self ):
+        return len(self.rows)
+
+    def parse_block( self, block ):
+        """
+        Turn the given complete lines into rows of the table's dtype.
+        """
+
+        tokens = block.split()
+        if len(tokens) % FIELDS:
+            raise ValueError("Every line of an idle scan file must have %d "
+                             "fields." % FIELDS)
+
+        rows = numpy.empty(len(tokens) / FIELDS, dtype=SCAN_DTYPE)
+
+        for i, name in enumerate(SCAN_DTYPE.names):
+            column = tokens[i::FIELDS]
+            if name.endswith("_addr"):
+                rows[name] = self.addresses.intern(column)
+            elif name.endswith("_region"):
+                rows[name] = self.regions.intern(column)
+            elif name.endswith("_type"):
+                rows[name] = self.types.intern(column)
+            elif name.endswith(("_lat", "_lon")):
+                rows[name] = map(float, column)
+            else:
+                rows[name] = map(int, column)
+
+        return rows
+
+    @classmethod
+    def from_file( cls, file_name, offset=0, complete=False ):
+        """
+        Read the given idle scan file chunk by chunk, starting at the given
+        byte offset, and return its table.  If `complete' is set, a last line
+        without newline is left out because it may still be written to.  The
+        offset after the last parsed line is kept in the table's `end'.
+        """
+
+        table = cls()
+        chunks = []
+
+        with open(file_name, "r") as fd:
+            fd.seek(offset)
+            while True:
+                block = fd.read(CHUNK_SIZE)
+                if not block:
+                    break
+                block += fd.readline()
+                if complete and not block.endswith("\n"):
+                    block = block[:block.rfind("\n") + 1]
+                    chunks.append(table.parse_block(block))
+                    offset += len(block)
+                    break
+                offset += len(block)
+                chunks.append(table.parse_block(block))
+
+        if chunks:
+            table.rows = numpy.concatenate(chunks)
+        table.end = offset
+
+        return table
+
+    def filter( self, region=None, hour=None, machine_type=None,
+                verdict=None, address=None ):
+        """
+        Return a boolean mask of the rows which pass all given filters.
+        Filters which are None are ignored.
+        """
+
+        return get_mask(self.rows, self.regions, self.types, self.addresses,
+                        region, hour, machine_type, verdict, address)
+
+class AddressIndex( object ):
+
+    """
+    Maps IP addresses to the rows of a filtered ScanTable in which they are
+    the source or destination.  Row numbers count the rows selected by the
+    mask only.
+    """
+
+    def __init__( self, table, mask ):
+
+        rows = table.rows[mask]
+        addresses = numpy.concatenate([rows["src_addr"], rows["dst_addr"]])
+        order = addresses.argsort(kind="mergesort")
+
+        self.table = table
+        self.codes = addresses[order]
+        self.rows = order % len(rows) if len(rows) else order
+
+    def lookup( self, ip_addrs ):
+        """
+        Return the sorted row numbers of all scans which involve any of the
+        given IP addresses.  Every row is only returned once.
+        """
+
+        codes = [self.table.addresses.get_code(ip_addr)
+                 for ip_addr in ip_addrs]
+        codes = [code for code in codes if code is not None]
+        if not codes:
+            return numpy.zeros(0, dtype=numpy.intp)
+
+        starts = self.codes.searchsorted(codes, side="left")
+        ends = self.codes.searchsorted(codes, side="right")
+
+        return numpy.unique(numpy.concatenate([self.rows[start:end]
+                                               for start, end
+                                               in zip(starts, ends)]))
+
+class MapData( object ):
+
+    """
+    The points and paths of a filtered ScanTable.  Identical coordinates are
+    merged once, so the map of any subset of rows only has to combine the
+    bitmaps of its rows.
+    """
+
+    def __init__( self, table, mask ):
+
+        rows = table.rows[mask]
+
+        # Paths are plotted in the colour of the OR of all their verdicts.
+        self.values = rows["verdict"].astype(numpy.uint8) + 1
+
+        paths = numpy.empty(len(rows), dtype=PATH_DTYPE)
+        for name in PATH_DTYPE.names:
+            paths[name] = rows[name]
+        self.paths, self.path_ids = numpy.unique(paths, return_inverse=True)
+
+        points = numpy.empty(2 * len(rows), dtype=POINT_DTYPE)
+        points["lat"] = numpy.concatenate([rows["src_lat"], rows["dst_lat"]])
+        points["lon"] = numpy.concatenate([rows["src_lon"], rows["dst_lon"]])
+        self.points, point_ids = numpy.unique(points, return_inverse=True)
+        self.src_ids = point_ids[:len(rows)]
+        self.dst_ids = point_ids[len(rows):]
+
+        # Grid cells of all points, by cell size.
+        self.bins = {}
+
+    def __len__( self ):
+        return len(self.values)
+
+    def share( self ):
+        """
+        Move all arrays into shared memory.
+        """
+
+        for name in ("values", "paths", "path_ids", "points", "src_ids",
+                     "dst_ids"):
+            setattr(self, name, share_array(getattr(self, name)))
+
+        return self
+
+    def get_bins( self, cell_size ):
+        """
+        Return the number of the grid cell of every point.  Cells are
+        `cell_size' degrees wide and high, counted from -90/-180.
+        """
+
+        bins = self.bins.get(cell_size)
+        if bins is None:
+            columns = int(numpy.ceil(360.0 / cell_size)) + 1
+            rows = numpy.floor((self.points["lat"] + 90) / cell_size)
+            cols = numpy.floor((self.points["lon"] + 180) / cell_size)
+            bins = self.bins[cell_size] = (rows * columns +
+                                           cols).astype(numpy.int64)
+
+        return bins
+
+    def aggregate( self, rows=None, cell_size=None ):
+        """
+        Return the points and paths of the given rows, or of all rows, as
+        arrays of coordinates together with their bitmaps and the number of
+        scans they stand for.
+
+        A point's bitmap tells if it is a SOURCE, DESTINATION or both.  A
+        path's bitmap is the OR of its scans' verdicts plus one.  If a cell
+        size is given, all points in a grid cell are merged into one point at
+        their centroid and paths connect these merged points.
+        """
+
+        if rows is None:
+            rows = slice(None)
+
+        src_ids, dst_ids = self.src_ids[rows], self.dst_ids[rows]
+        values = self.values[rows]
+        scans = len(src_ids)
+
+        point_ids = numpy.concatenate([src_ids, dst_ids])
+        flags = numpy.concatenate([numpy.repeat(numpy.uint8(SOURCE), scans),
+                                   numpy.repeat(numpy.uint8(DESTINATION),
+                                                scans)])
+
+        if cell_size is None:
+            keys = point_ids
+        else:
+            keys = self.get_bins(cell_size)[point_ids]
+
+        keys, groups = numpy.unique(keys, return_inverse=True)
+        src_groups, dst_groups = groups[:scans], groups[scans:]
+
+        # Scans within a single point or cell only count once.
+        point_bits = or_reduce(groups, flags, len(keys))
+        point_counts = numpy.bincount(groups, minlength=len(keys)) - \
+                       numpy.bincount(src_groups[src_groups == dst_groups],
+                                      minlength=len(keys))
+
+        if cell_size is None:
+            points = self.points[keys]
+            path_ids, path_groups = numpy.unique(self.path_ids[rows],
+                                                 return_inverse=True)
+            paths = self.paths[path_ids]
+        else:
+            coordinates = self.points[point_ids]
+            points = numpy.empty(len(keys), dtype=POINT_DTYPE)
+            for name in POINT_DTYPE.names:
+                points[name] = numpy.bincount(groups,
+                                              weights=coordinates[name],
+                                              minlength=len(keys)) / \
+                               numpy.bincount(groups, minlength=len(keys))
+                # Finer centroids would only make the map larger.
+                points[name] = points[name].round(4)
+
+            pairs, path_groups = numpy.unique(src_groups.astype(numpy.int64) *
+                                              len(keys) + dst_groups,
+                                              return_inverse=True)
+            paths = numpy.empty(len(pairs), dtype=PATH_DTYPE)
+            for end, ends in (("src", pairs // len(keys)),
+                              ("dst", pairs % len(keys))):
+                paths[end + "_lat"] = points["lat"][ends]
+                paths[end + "_lon"] = points["lon"][ends]
+
+        path_bits = or_reduce(path_groups, values, len(paths))
+        path_counts = numpy.bincount(path_groups, minlength=len(paths))
+
+        return (points, point_bits, point_counts,
+                paths, path_bits, path_counts)
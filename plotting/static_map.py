@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Renders maps offline as SVG or PNG files.  The maps offer the same addpoint()
+# and addpath() interface as pygmaps.maps but project coordinates locally, so
+# they need no network connection to be viewed and can be created headless.
+# Paths are buffered in fixed-size chunks which are streamed into temporary
+# files (SVG) or drawn right away (PNG), so memory use does not grow with the
+# number of paths.
+
+import os
+import math
+import zlib
+import array
+import base64
+import shutil
+import struct
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy
+
+PROJECTIONS = ["equirectangular", "mercator"]
+
+# Mercator maps are cut off at this latitude, which makes them square.
+MAX_MERCATOR_LATITUDE = 85.0511287798
+
+# Distance between the lines of the graticule in degrees.
+GRATICULE = 30
+
+BACKGROUND = "#FFFFFF"
+GRATICULE_COLOUR = "#DDDDDD"
+
+# Opacity of paths, just like in pygmaps.
+PATH_OPACITY = 0.5
+
+# Radius of points which have a colour but no icon.
+POINT_RADIUS = 4
+
+# Number of path segments which are buffered before they are drawn.
+CHUNK = 65536
+
+# Number of pixels which are set at once when rasterising paths.
+MAX_PIXELS = 1024 * 1024
+
+# Where pygmaps' icons can be found locally.
+ICON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "icons")
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def parse_colour( colour ):
+    """
+    Turn an HTML colour such as "#FF8800" into an (r, g, b) tuple.
+    """
+
+    colour = colour.lstrip("#")
+
+    return tuple([int(colour[i:i + 2], 16) for i in (0, 2, 4)])
+
+def read_png_chunks( data ):
+
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG file.")
+
+    offset = len(PNG_SIGNATURE)
+    while offset < len(data):
+        length, tag = struct.unpack_from("!I4s", data, offset)
+        yield (tag, data[offset + 8:offset + 8 + length])
+        offset += 12 + length
+
+def read_png( file_name ):
+    """
+    Return the pixels of the given 8-bit RGB(A) PNG file as an array of shape
+    (height, width, 4).
+    """
+
+    with open(file_name, "rb") as fd:
+        data = fd.read()
+
+    idat = []
+    for tag, chunk in read_png_chunks(data):
+        if tag == b"IHDR":
+            width, height, depth, colour_type, _, _, interlace = \
+                struct.unpack("!IIBBBBB", chunk)
+        elif tag == b"IDAT":
+            idat.append(chunk)
+
+    if depth != 8 or colour_type not in (2, 6) or interlace:
+        raise ValueError("Unsupported PNG file `%s'." % file_name)
+
+    channels = 4 if colour_type == 6 else 3
+    stride = width * channels
+    raw = bytearray(zlib.decompress(b"".join(idat)))
+
+    # Undo the filter of every scan line.
+    pixels = bytearray(height * stride)
+    for row in xrange(height):
+        kind = raw[row * (stride + 1)]
+        line = raw[row * (stride + 1) + 1:(row + 1) * (stride + 1)]
+        start = row * stride
+        for i in xrange(stride):
+            left = pixels[start + i - channels] if i >= channels else 0
+            up = pixels[start + i - stride] if row else 0
+            upper_left = pixels[start + i - stride - channels] \
+                         if row and i >= channels else 0
+            if kind == 1:
+                predictor = left
+            elif kind == 2:
+                predictor = up
+            elif kind == 3:
+                predictor = (left + up) / 2
+            elif kind == 4:
+                estimate = left + up - upper_left
+                distances = [abs(estimate - left), abs(estimate - up),
+                             abs(estimate - upper_left)]
+                predictor = [left, up, upper_left][
+                                distances.index(min(distances))]
+            else:
+                predictor = 0
+            pixels[start + i] = (line[i] + predictor) & 0xff
+
+    pixels = numpy.frombuffer(bytes(pixels), dtype=numpy.uint8).reshape(
+                height, width, channels)
+    if channels == 3:
+        opaque = numpy.empty((height, width, 1), dtype=numpy.uint8)
+        opaque.fill(255)
+        pixels = numpy.concatenate([pixels, opaque], axis=2)
+
+    return pixels
+
+def write_png( file_name, pixels ):
+    """
+    Write the given array of shape (height, width, 3) as RGB PNG file.
+    """
+
+    height, width, _ = pixels.shape
+
+    def chunk( tag, data ):
+        return struct.pack("!I", len(data)) + tag + data + \
+               struct.pack("!I", zlib.crc32(tag + data) & 0xffffffff)
+
+    compressor = zlib.compressobj(6)
+    idat = []
+    for row in xrange(height):
+        idat.append(compressor.compress(b"\x00" + pixels[row].tostring()))
+    idat.append(compressor.flush())
+
+    with open(file_name, "wb") as fd:
+        fd.write(PNG_SIGNATURE)
+        fd.write(chunk(b"IHDR", struct.pack("!IIBBBBB", width, height, 8, 2,
+                                            0, 0, 0)))
+        fd.write(chunk(b"IDAT", b"".join(idat)))
+        fd.write(chunk(b"IEND", b""))
+
+def get_icon_file( icon ):
+    """
+    Return the local copy of the given icon, which is usually one of the URLs
+    in plot_scan_data.icon_paths, or None.
+    """
+
+    if not icon:
+        return None
+
+    file_name = os.path.join(ICON_DIR, os.path.basename(icon))
+    if not os.path.isfile(file_name):
+        return None
+
+    return file_name
+
+class StaticMap( object ):
+
+    """
+    Projects points and paths onto a world map of the given width.  Paths are
+    split into segments which are buffered by colour and width until
+    draw_segments() of a subclass draws them.
+    """
+
+    def __init__( self, width=2048, projection="equirectangular" ):
+
+        if projection not in PROJECTIONS:
+            raise ValueError("Unknown projection `%s'." % projection)
+
+        self.width = width
+        self.projection = projection
+        if projection == "mercator":
+            self.height = width
+        else:
+            self.height = width / 2
+
+        self.segments = {}
+        self.buffered = 0
+
+    def project( self, latitudes, longitudes ):
+        """
+        Return the x and y pixel coordinates of the given coordinates, which
+        are scalars or arrays.
+        """
+
+        x = (numpy.asarray(longitudes, dtype=float) + 180.0) / 360.0 * \
+            self.width
+
+        latitudes = numpy.asarray(latitudes, dtype=float)
+        if self.projection == "mercator":
+            latitudes = numpy.radians(numpy.clip(latitudes,
+                                                 -MAX_MERCATOR_LATITUDE,
+                                                 MAX_MERCATOR_LATITUDE))
+            y = (1 - numpy.log(numpy.tan(math.pi / 4 + latitudes / 2)) /
+                 math.pi) / 2 * self.height
+        else:
+            y = (90.0 - latitudes) / 180.0 * self.height
+
+        return (x, y)
+
+    def get_graticule( self ):
+        """
+        Return the segments of a graticule as lat, lng, lat, lng rows.
+        """
+
+        max_latitude = 90
+        if self.projection == "mercator":
+            max_latitude = MAX_MERCATOR_LATITUDE
+
+        lines = [(latitude, -180, latitude, 180)
+                 for latitude in xrange(-90 + GRATICULE, 90, GRATICULE)]
+        lines.extend([(-max_latitude, longitude, max_latitude, longitude)
+                      for longitude in xrange(-180, 181, GRATICULE)])
+
+        return numpy.array(lines, dtype=float)
+
+    def project_segments( self, segments ):
+        """
+        Turn rows of lat, lng, lat, lng into rows of x, y, x, y.
+        """
+
+        projected = numpy.empty(segments.shape)
+        projected[:, 0], projected[:, 1] = self.project(segments[:, 0],
+                                                        segments[:, 1])
+        projected[:, 2], projected[:, 3] = self.project(segments[:, 2],
+                                                        segments[:, 3])
+
+        return projected
+
+    def addpath( self, path, color="#FF0000", weight=1 ):
+
+        coordinates = self.segments.get((color, weight))
+        if coordinates is None:
+            coordinates = self.segments[(color, weight)] = array.array("d")
+
+        for start, end in zip(path, path[1:]):
+            coordinates.extend(start[:2])
+            coordinates.extend(end[:2])
+            self.buffered += 1
+
+        if self.buffered >= CHUNK:
+            self.flush()
+
+    def flush( self ):
+        """
+        Draw and forget all buffered segments.
+        """
+
+        for (colour, weight), coordinates in self.segments.items():
+            if coordinates:
+                segments = numpy.frombuffer(coordinates, dtype=float)
+                self.draw_segments(colour, weight, self.project_segments(
+                                   segments.reshape(-1, 4)))
+
+        self.segments = {}
+        self.buffered = 0
+
+class SvgMap( StaticMap ):
+
+    """
+    Writes an SVG file.  The segments of every colour and width become a
+    single SVG path and points are drawn on top of all paths.  Points with an
+    icon are drawn with a local copy of the icon, which is embedded once.
+    """
+
+    def __init__( self, width=2048, projection="equirectangular" ):
+
+        StaticMap.__init__(self, width, projection)
+
+        self.path_files = {}
+        self.point_file = tempfile.TemporaryFile()
+        self.icons = {}
+
+    def get_icon_id( self, icon ):
+
+        if not self.icons.has_key(icon):
+            self.icons[icon] = "icon%d" % len(self.icons)
+
+        return self.icons[icon]
+
+    def addpoint( self, lat, lng, color="#FF0000", icon=None, title="n/a" ):
+
+        x, y = [float(value) for value in self.project(lat, lng)]
+
+        if icon:
+            element = '<use xlink:href="#%s" x="%.1f" y="%.1f"' % \
+                      (self.get_icon_id(icon), x, y)
+        else:
+            element = '<circle cx="%.1f" cy="%.1f" r="%d" fill=%s ' \
+                      'stroke="#000000"' % (x, y, POINT_RADIUS,
+                                            quoteattr(color))
+
+        if title and title != "n/a":
+            element += "><title>%s</title></%s>\n" % \
+                       (escape(title), element[1:element.index(" ")])
+        else:
+            element += "/>\n"
+
+        self.point_file.write(element)
+
+    def draw_segments( self, colour, weight, segments ):
+
+        fd = self.path_files.get((colour, weight))
+        if fd is None:
+            fd = self.path_files[(colour, weight)] = tempfile.TemporaryFile()
+
+        fd.write("".join(["M%.1f %.1fL%.1f %.1f" % tuple(segment)
+                          for segment in segments.tolist()]))
+
+    def write_icons( self, fd ):
+        """
+        Define every icon once, anchored at its bottom centre like Google
+        Maps markers.
+        """
+
+        fd.write("<defs>\n")
+
+        for icon, icon_id in sorted(self.icons.items()):
+            file_name = get_icon_file(icon)
+            if file_name:
+                height, width = read_png(file_name).shape[:2]
+                with open(file_name, "rb") as icon_fd:
+                    href = "data:image/png;base64," + \
+                           base64.b64encode(icon_fd.read())
+            else:
+                width, height, href = 12, 15, icon
+            fd.write('<image id="%s" x="%.1f" y="%d" width="%d" height="%d" '
+                     'xlink:href=%s/>\n' % (icon_id, -width / 2.0, -height,
+                                            width, height, quoteattr(href)))
+
+        fd.write("</defs>\n")
+
+    def draw( self, file_name ):
+
+        self.flush()
+
+        with open(file_name, "w", 1024 * 1024) as fd:
+            fd.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            fd.write('<svg xmlns="http://www.w3.org/2000/svg" '
+                     'xmlns:xlink="http://www.w3.org/1999/xlink" '
+                     'width="%d" height="%d" viewBox="0 0 %d %d">\n' %
+                     (self.width, self.height, self.width, self.height))
+            self.write_icons(fd)
+            fd.write('<rect width="100%%" height="100%%" fill="%s"/>\n' %
+                     BACKGROUND)
+
+            fd.write('<path fill="none" stroke="%s" d="' % GRATICULE_COLOUR)
+            fd.write("".join(["M%.1f %.1fL%.1f %.1f" % tuple(segment)
+                              for segment in self.project_segments(
+                                  self.get_graticule()).tolist()]))
+            fd.write('"/>\n')
+
+            for (colour, weight), path_fd in sorted(self.path_files.items()):
+                fd.write('<path fill="none" stroke=%s stroke-opacity="%.1f" '
+                         'stroke-width="%d" d="' % (quoteattr(colour),
+                                                    PATH_OPACITY, weight))
+                path_fd.seek(0)
+                shutil.copyfileobj(path_fd, fd)
+                path_fd.close()
+                fd.write('"/>\n')
+
+            self.point_file.seek(0)
+            shutil.copyfileobj(self.point_file, fd)
+            self.point_file.close()
+
+            fd.write("</svg>\n")
+
+        self.path_files = {}
+
+class PngMap( StaticMap ):
+
+    """
+    Rasterises paths into an RGB canvas as soon as a chunk of them is
+    buffered.  Points are drawn into a separate overlay which is put on top
+    of all paths in the end.
+    """
+
+    def __init__( self, width=2048, projection="equirectangular" ):
+
+        StaticMap.__init__(self, width, projection)
+
+        self.canvas = numpy.empty((self.height, self.width, 3),
+                                  dtype=numpy.uint8)
+        self.canvas[...] = parse_colour(BACKGROUND)
+        self.overlay = numpy.zeros((self.height, self.width, 4),
+                                   dtype=numpy.uint8)
+        self.sprites = {}
+
+        self.rasterise(self.project_segments(self.get_graticule()),
+                       parse_colour(GRATICULE_COLOUR), 1, 1.0)
+
+    def rasterise( self, segments, colour, weight, opacity ):
+        """
+        Blend the given projected segments into the canvas.  Every segment is
+        sampled once per pixel along its longer axis.  Like overlapping parts
+        of a single SVG path, pixels which are hit by several of the segments
+        are only blended once.
+        """
+
+        x0, y0, x1, y1 = segments.astype(numpy.float32).T
+        dx, dy = x1 - x0, y1 - y0
+        steps = numpy.ceil(numpy.maximum(abs(dx), abs(dy))).astype(int) + 1
+        scale = (1.0 / numpy.maximum(steps - 1, 1)).astype(numpy.float32)
+        step_x, step_y = dx * scale, dy * scale
+        steep = (abs(dy) > abs(dx)).astype(numpy.int32)
+        ends = numpy.cumsum(steps)
+
+        # Samples are rounded by truncating them, and samples beyond the map's
+        # borders end up on the borders.
+        x0 = numpy.clip(x0, 0, self.width - 1) + 0.5
+        y0 = numpy.clip(y0, 0, self.height - 1) + 0.5
+
+        pixels = self.canvas.reshape(-1, 3)
+        hit = numpy.zeros(len(pixels), dtype=bool)
+        colour = numpy.array(colour, dtype=float) * opacity
+        first = 0
+
+        while first < len(segments):
+
+            # Bound the number of pixels which are sampled at once.
+            offset = ends[first - 1] if first else 0
+            last = max(first + 1, numpy.searchsorted(ends, offset + MAX_PIXELS,
+                                                     side="right"))
+
+            counts = steps[first:last]
+            ids = numpy.repeat(numpy.arange(last - first, dtype=numpy.int32),
+                               counts)
+            starts = (ends[first:last] - counts - offset).astype(numpy.float32)
+            k = numpy.arange(len(ids), dtype=numpy.float32) - starts[ids]
+
+            xs = x0[first:last][ids] + k * step_x[first:last][ids]
+            ys = y0[first:last][ids] + k * step_y[first:last][ids]
+            xs = numpy.clip(xs, 0, self.width - 1).astype(numpy.int32)
+            ys = numpy.clip(ys, 0, self.height - 1).astype(numpy.int32)
+
+            if weight == 1:
+                hit[ys * self.width + xs] = True
+            else:
+                sample_steep = steep[first:last][ids]
+                for shift in xrange(weight):
+                    shift -= weight / 2
+                    px = numpy.clip(xs + shift * sample_steep, 0,
+                                    self.width - 1)
+                    py = numpy.clip(ys + shift * (1 - sample_steep), 0,
+                                    self.height - 1)
+                    hit[py * self.width + px] = True
+
+            first = last
+
+        pixels[hit] = pixels[hit] * (1 - opacity) + colour
+
+    def draw_segments( self, colour, weight, segments ):
+
+        self.rasterise(segments, parse_colour(colour), weight, PATH_OPACITY)
+
+    def get_sprite( self, colour, icon ):
+        """
+        Return the RGBA pixels of the given icon or, if it is not available
+        locally, of a circle in the given colour.  Icons are anchored at their
+        bottom centre, circles at their centre, which is also returned as
+        (x, y) offset.
+        """
+
+        key = (colour, icon)
+        if self.sprites.has_key(key):
+            return self.sprites[key]
+
+        file_name = get_icon_file(icon)
+        if file_name:
+            sprite = read_png(file_name)
+            anchor = (sprite.shape[1] / 2, sprite.shape[0])
+        else:
+            size = 2 * POINT_RADIUS + 1
+            y, x = numpy.mgrid[:size, :size] - POINT_RADIUS
+            distance = numpy.sqrt(x ** 2 + y ** 2)
+            sprite = numpy.zeros((size, size, 4), dtype=numpy.uint8)
+            sprite[distance <= POINT_RADIUS + 0.5] = (0, 0, 0, 255)
+            sprite[distance <= POINT_RADIUS - 0.5] = \
+                parse_colour(colour) + (255,)
+            anchor = (POINT_RADIUS, POINT_RADIUS)
+
+        self.sprites[key] = (sprite, anchor)
+
+        return self.sprites[key]
+
+    def addpoint( self, lat, lng, color="#FF0000", icon=None, title="n/a" ):
+
+        sprite, (anchor_x, anchor_y) = self.get_sprite(color, icon)
+        height, width = sprite.shape[:2]
+
+        x, y = [int(round(float(value))) for value in self.project(lat, lng)]
+        left, top = x - anchor_x, y - anchor_y
+
+        # Clip the sprite at the map's borders.
+        sx, sy = max(0, -left), max(0, -top)
+        left, top = max(0, left), max(0, top)
+        right = min(self.width, left + width - sx)
+        bottom = min(self.height, top + height - sy)
+        if right <= left or bottom <= top:
+            return
+
+        # The overlay holds colours premultiplied with their alpha.
+        source = sprite[sy:sy + bottom - top, sx:sx + right - left]
+        target = self.overlay[top:bottom, left:right]
+        alpha = source[..., 3:] / 255.0
+        target[..., :3] = source[..., :3] * alpha + \
+                          target[..., :3] * (1 - alpha)
+        target[..., 3:] = 255 * alpha + target[..., 3:] * (1 - alpha)
+
+    def draw( self, file_name ):
+
+        self.flush()
+
+        alpha = self.overlay[..., 3:] / 255.0
+        pixels = self.canvas * (1 - alpha) + self.overlay[..., :3]
+
+        write_png(file_name, numpy.rint(pixels).astype(numpy.uint8))
@@ -4,7 +4,8 @@
 #
 # Probes a given host using traceroutes, SYN scans and RST scans.  All data is
 # written to the given directory.  Probing should happen in sync with the
-# censored machine behind the GFW.
+# censored machine behind the GFW.  Exits with a non-zero status if one of the
+# scans failed.
 
 source log.sh
 source config.sh
@@ -29,6 +30,10 @@ outdir="$3"
 
 log "0. Now probing host ${ip_addr}:${port}."
 
+# Becomes 1 as soon as a scan fails.  Even then, we go through all steps to
+# stay in sync with the other prober.
+status=0
+
 # Traceroutes are only run by the censored machine.  We want to make sure that
 # the route doesn't change during the scan.  To be (reasonably) sure, we run
 # traceroutes before, during, and after the scan.
@@ -43,6 +48,11 @@ sleep 5
 
 log "2. Running SYN scan to determine if SYN or SYN/ACK segments are dropped."
 "$synscan" "$ip_addr" "$port" "${outdir}/$(date -u +'%F.%T')_synscan.pcap"
+if [ $? != 0 ]
+then
+	err "SYN scan to ${ip_addr}:${port} failed."
+	status=1
+fi
 
 
 if [ $prober_type = "censored" ]
@@ -56,6 +66,11 @@ sleep 5
 
 log "4. Running RST scan to determine if RST segments are dropped."
 "$rstscan" "$ip_addr" "$port" "$spoofed_addr" "${outdir}/$(date -u +'%F.%T')_rstscan.pcap"
+if [ $? != 0 ]
+then
+	err "RST scan to ${ip_addr}:${port} failed."
+	status=1
+fi
 
 
 if [ $prober_type = "censored" ]
@@ -65,3 +80,5 @@ then
 fi
 
 sleep 5
+
+exit "$status"
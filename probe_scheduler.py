@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Probes many hosts at once instead of one host per invocation of
+# probing_wrapper.sh.  Every host goes through the same steps as in
+# probe_host.sh: traceroute, SYN scan, traceroute, RST scan, traceroute.  While
+# one host's scan waits 65 seconds for SYN/ACKs, other hosts are already
+# probed.  Start times are planned ahead so that the SYNs and RSTs of all scans
+# stay within a global packet rate and only few hosts of a /24 are probed at
+# the same time.  The plan only depends on the hosts file, the options and the
+# start time, but not on the prober type, so the censored and the uncensored
+# prober stay in sync if both are started with the same --start-at.  Hosts
+# whose start already passed when the scheduler is (re)started are written to
+# a hosts file in the output directory, so that they can be probed later.
+
+import os
+import re
+import sys
+import time
+import asyncio
+import argparse
+import logging
+import collections
+
+# Where the probing scripts and their configuration live.
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG_FILE = os.path.join(SCRIPT_DIR, "config.sh")
+
+# Seconds between the steps of a host, just like the sleeps in probe_host.sh.
+STEP_DELAY = 5
+
+# Upper limit for a scan's duration: starting tcpdump (2s), sending (up to 5s),
+# waiting for SYN/ACKs (65s) and some slack.
+SCAN_DURATION = 75
+
+# Seconds after a scan's start during which it sends segments.
+SEND_START = 2
+SEND_DURATION = 5
+
+# When every step begins, in seconds after the host's start.
+TRACEROUTE_OFFSETS = [0,
+                      STEP_DELAY + SCAN_DURATION,
+                      2 * (STEP_DELAY + SCAN_DURATION)]
+SCAN_OFFSETS = collections.OrderedDict([
+    ("synscan", STEP_DELAY),
+    ("rstscan", 2 * STEP_DELAY + SCAN_DURATION)])
+
+HOST_DURATION = TRACEROUTE_OFFSETS[-1] + STEP_DELAY
+
+# Segments sent by every scan, as configured in synscan.sh and rstscan.sh.
+SCAN_SEGMENTS = {
+    "censored": {"synscan": 145, "rstscan": 145 + 145},
+    "uncensored": {"synscan": 10 + 3, "rstscan": 10 + 145},
+}
+
+# Both probers plan with the segments of whichever sends more, so that they
+# come up with the same plan.
+PLAN_SEGMENTS = dict([(scan, max([segments[scan]
+                                  for segments in SCAN_SEGMENTS.values()]))
+                      for scan in SCAN_OFFSETS])
+
+# Files in the output directory listing the hosts which were probed and the
+# hosts which were skipped because their start already passed.
+PROBED_FILE = "probed_hosts.txt"
+SKIPPED_FILE = "skipped_hosts.txt"
+
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(fmt="[%(asctime)s] %(message)s"))
+
+logger = logging.getLogger()
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+def read_config( file_name ):
+    """
+    Return the variables assigned in the given shell configuration file.
+    """
+
+    config = {}
+
+    with open(file_name) as fd:
+        for line in fd:
+            match = re.match(r'^(\w+)="(.*)"$', line.strip())
+            if match:
+                config[match.group(1)] = match.group(2)
+
+    return config
+
+def read_hosts( file_name ):
+    """
+    Return the (IP address, port) tuples of the given file, which holds one
+    IP:port tuple per line.
+    """
+
+    hosts = []
+
+    with open(file_name) as fd:
+        for line in fd:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            ip_addr, port = line.split(":")
+            hosts.append((ip_addr, port))
+
+    return hosts
+
+def read_probed( file_name ):
+    """
+    Return the set of IP:port strings which were completely probed according to
+    the given file, which may not exist yet.
+    """
+
+    try:
+        with open(file_name) as fd:
+            return set([line.strip() for line in fd if line.strip()])
+    except FileNotFoundError:
+        return set()
+
+def write_hosts( file_name, hosts ):
+    """
+    Write the given (IP address, port) tuples to the given file, in the format
+    which read_hosts() expects.
+    """
+
+    with open(file_name, "w") as fd:
+        for ip_addr, port in hosts:
+            fd.write("%s:%s\n" % (ip_addr, port))
+
+def get_prefix( ip_addr ):
+
+    return ip_addr.rsplit(".", 1)[0]
+
+class Schedule( object ):
+
+    """
+    Plans the start of every host, in seconds after the start of probing.
+    Every host gets the earliest start which fits, so a host waiting for its
+    /24 does not hold back the hosts after it.
+    """
+
+    def __init__( self, rate, per_prefix, segments ):
+
+        self.rate = rate
+        self.per_prefix = per_prefix
+        self.segments = segments
+
+        # Segments sent in every second.
+        self.load = collections.defaultdict(float)
+        # (start, end) of the hosts being probed in every /24.
+        self.busy = collections.defaultdict(list)
+        # All hosts send the same segments, so no host fits the packet rate
+        # before this start, and it only grows as the load grows.
+        self.earliest = 0
+
+    def get_sends( self, start ):
+        """
+        Return (second, segments) tuples for every second in which the scans
+        of a host starting at the given time send segments.
+        """
+
+        sends = []
+
+        for scan, offset in SCAN_OFFSETS.items():
+            first = start + offset + SEND_START
+            sends.extend([(second, self.segments[scan] / SEND_DURATION)
+                          for second in range(first, first + SEND_DURATION)])
+
+        return sends
+
+    def fits_rate( self, start ):
+
+        return all([self.load[second] + segments <= self.rate
+                    for second, segments in self.get_sends(start)])
+
+    def get_prefix_end( self, prefix, start ):
+        """
+        Return the earliest end of the hosts in the given /24 which would be
+        probed together with a host starting at the given time, if there are
+        too many of them, or None otherwise.
+        """
+
+        probing = [end for begin, end in self.busy[prefix]
+                   if begin < start + HOST_DURATION and start < end]
+        if len(probing) < self.per_prefix:
+            return None
+
+        return min(probing)
+
+    def add( self, ip_addr ):
+        """
+        Plan the given host and return its start.
+        """
+
+        while not self.fits_rate(self.earliest):
+            self.earliest += 1
+
+        prefix = get_prefix(ip_addr)
+        start = self.earliest
+        while True:
+            # The /24 stays too busy until one of its hosts is done.
+            end = self.get_prefix_end(prefix, start)
+            if end is not None:
+                start = end
+            elif not self.fits_rate(start):
+                start += 1
+            else:
+                break
+
+        for second, segments in self.get_sends(start):
+            self.load[second] += segments
+        self.busy[prefix].append((start, start + HOST_DURATION))
+
+        # Nothing before the earliest start is ever looked at again.
+        self.busy[prefix] = [(begin, end) for begin, end in self.busy[prefix]
+                             if end > self.earliest]
+        for second in [second for second in self.load
+                       if second < self.earliest]:
+            del self.load[second]
+
+        return start
+
+def plan( hosts, rate, per_prefix, segments ):
+    """
+    Return a list of (start, IP address, port) tuples for the given hosts,
+    sorted by start.
+    """
+
+    schedule = Schedule(rate, per_prefix, segments)
+    starts = [(schedule.add(ip_addr), ip_addr, port)
+              for ip_addr, port in hosts]
+
+    return sorted(starts, key=lambda entry: entry[0])
+
+async def sleep_until( timestamp ):
+
+    await asyncio.sleep(max(0, timestamp - time.time()))
+
+async def run( *command ):
+    """
+    Run one of the probing scripts and wait for it to finish.
+    """
+
+    env = dict(os.environ)
+    env["PATH"] = "%s:%s" % (env.get("PATH", ""), SCRIPT_DIR)
+
+    process = await asyncio.create_subprocess_exec(*command, cwd=SCRIPT_DIR,
+                                                   env=env)
+    status = await process.wait()
+    if status != 0:
+        logger.warning("`%s' exited with status %d." % (" ".join(command),
+                                                        status))
+
+def get_pcap_name( outdir, scan ):
+
+    return os.path.join(outdir, "%s_%s.pcap" %
+                        (time.strftime("%Y-%m-%d.%H:%M:%S", time.gmtime()),
+                         scan))
+
+async def probe_host( start, ip_addr, port, outdir, config ):
+    """
+    Probe the given host just like probe_host.sh, starting at the given time.
+    """
+
+    censored = config.get("prober_type") == "censored"
+
+    await sleep_until(start)
+    logger.info("Now probing host %s:%s." % (ip_addr, port))
+    os.makedirs(outdir, exist_ok=True)
+
+    steps = [(offset, "traceroute") for offset in TRACEROUTE_OFFSETS] + \
+            [(offset, scan) for scan, offset in SCAN_OFFSETS.items()]
+
+    for offset, step in sorted(steps):
+
+        if time.time() > start + offset + 1:
+            logger.warning("Probing of %s:%s is %.0fs behind schedule." %
+                           (ip_addr, port, time.time() - start - offset))
+        await sleep_until(start + offset)
+
+        if step == "traceroute":
+            # Traceroutes are only run by the censored machine.
+            if censored:
+                await run("traceroute_host.sh", ip_addr, port, outdir)
+        elif step == "synscan":
+            await run("synscan.sh", ip_addr, port,
+                      get_pcap_name(outdir, step))
+        else:
+            await run("rstscan.sh", ip_addr, port,
+                      config.get("spoofed_addr", ""),
+                      get_pcap_name(outdir, step))
+
+    with open(os.path.join(os.path.dirname(outdir), PROBED_FILE), "a") as fd:
+        fd.write("%s:%s\n" % (ip_addr, port))
+
+    logger.info("Done probing host %s:%s." % (ip_addr, port))
+
+async def probe_hosts( schedule, start_at, outdir, config ):
+    """
+    Start probing every host at its planned time.  Hosts whose start already
+    passed, e.g., because the scheduler was restarted, are skipped.  Unless
+    they were completely probed before, they are written to SKIPPED_FILE,
+    which can be passed as hosts file to another run of both probers.
+    """
+
+    os.makedirs(outdir, exist_ok=True)
+
+    now = time.time()
+    probed = read_probed(os.path.join(outdir, PROBED_FILE))
+    skipped = [(ip_addr, port) for start, ip_addr, port in schedule
+               if start + start_at < now - 1 and
+               "%s:%s" % (ip_addr, port) not in probed]
+
+    if skipped:
+        skipped_file = os.path.join(outdir, SKIPPED_FILE)
+        write_hosts(skipped_file, skipped)
+        logger.warning("Skipping %d hosts whose start already passed.  They "
+                       "are listed in `%s'." % (len(skipped), skipped_file))
+
+    tasks = []
+
+    for start, ip_addr, port in schedule:
+
+        start += start_at
+        if start < now - 1:
+            continue
+
+        await sleep_until(start)
+        tasks.append(asyncio.ensure_future(probe_host(
+            start, ip_addr, port,
+            os.path.join(outdir, "%s:%s" % (ip_addr, port)), config)))
+
+    await asyncio.gather(*tasks)
+
+def parse_arguments( ):
+
+    parser = argparse.ArgumentParser(description="Probe many hosts at once "
+                                     "while staying within a global packet "
+                                     "rate.")
+
+    parser.add_argument("hosts_file", metavar="HOSTS_FILE",
+                        help="File with one IP:port tuple per line.")
+
+    parser.add_argument("output_dir", metavar="OUTPUT_DIR",
+                        help="Where to write the results of every host to.")
+
+    parser.add_argument("-r", "--rate", metavar="SEGMENTS", type=float,
+                        default=500,
+                        help="Upper limit for the SYN and RST segments sent "
+                             "per second by all scans (default: 500).")
+
+    parser.add_argument("-p", "--per-prefix", metavar="NUM", type=int,
+                        default=1,
+                        help="Number of hosts in a /24 which are probed at "
+                             "the same time (default: 1).")
+
+    parser.add_argument("-s", "--start-at", metavar="TIMESTAMP", type=float,
+                        default=None,
+                        help="UNIX time at which probing starts.  Both "
+                             "probers must use the same value (default: "
+                             "now).")
+
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="Only print the schedule.")
+
+    args = parser.parse_args()
+
+    if args.per_prefix < 1:
+        parser.error("--per-prefix must be at least 1.")
+
+    return args
+
+def main( ):
+
+    args = parse_arguments()
+
+    config = read_config(CONFIG_FILE)
+    prober_type = config.get("prober_type")
+    if not SCAN_SEGMENTS.get(prober_type):
+        logger.error("Unknown prober type `%s' in `%s'." %
+                     (prober_type, CONFIG_FILE))
+        return 1
+
+    if max(PLAN_SEGMENTS.values()) / SEND_DURATION > args.rate:
+        logger.error("A single scan sends %.0f segments per second, which "
+                     "exceeds the rate of %.0f." %
+                     (max(PLAN_SEGMENTS.values()) / SEND_DURATION, args.rate))
+        return 1
+
+    schedule = plan(read_hosts(args.hosts_file), args.rate, args.per_prefix,
+                    PLAN_SEGMENTS)
+    if not schedule:
+        logger.error("No hosts in file `%s'." % args.hosts_file)
+        return 1
+
+    duration = schedule[-1][0] + HOST_DURATION
+    logger.info("Planned %d hosts which take %.1f hours." %
+                (len(schedule), duration / 3600.0))
+
+    if args.dry_run:
+        for start, ip_addr, port in schedule:
+            print("%6d %s:%s" % (start, ip_addr, port))
+        return 0
+
+    start_at = args.start_at if args.start_at is not None else time.time()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(probe_hosts(schedule, start_at, args.output_dir,
+                                        config))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
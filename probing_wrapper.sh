@@ -12,6 +12,9 @@ PATH=$PATH:.
 # Path to the script which probes a single host.
 probe="probe_host.sh"
 
+# Path to the script which manages the queue of hosts.
+queue_tool="target_queue.py"
+
 if [ "$#" -lt 2 ]
 then
 	echo
@@ -23,6 +26,10 @@ fi
 hosts_file="$1"
 outdir="$2"
 
+# The hosts file is imported into a persistent queue once and never rewritten.
+queue="${hosts_file}.queue"
+worker="$(hostname)"
+
 if [ ! -f "$hosts_file" ]
 then
 	err "File \"${hosts_file}\" does not exist."
@@ -45,10 +52,22 @@ then
 	exit 1
 fi
 
-host=$(head -1 "$hosts_file")
+if [ ! -f "$queue" ]
+then
+	log "Importing hosts from file \"${hosts_file}\" into \"${queue}\"."
+	"$queue_tool" "$queue" import "$hosts_file"
+	if [ $? != 0 ]
+	then
+		rm -f "$queue" "${queue}-wal" "${queue}-shm"
+		err "Could not import hosts from file \"${hosts_file}\"."
+		exit 1
+	fi
+fi
+
+host=$("$queue_tool" "$queue" claim --worker "$worker")
 if [ -z "$host" ]
 then
-	err "No more hosts in file \"${hosts_file}\"."
+	err "No more hosts in queue \"${queue}\"."
 else
 	# Extract IP address and port from the IP:port tuple.
 	array=(${host//:/ })
@@ -59,9 +78,12 @@ else
 	mkdir -p "${outdir}/${host}"
 	"$probe" "${ip_addr}" "${port}" "${outdir}/${host}"
 
-	# Drain the first relay and write back the remaining relays.
-	log "Draining first relay from file \"${hosts_file}\"."
-	tmpfile=$(mktemp '/tmp/relay_list-XXXXXXXXXX')
-	tail -n +2 "$hosts_file" > "$tmpfile"
-	mv "$tmpfile" "$hosts_file"
+	if [ $? = 0 ]
+	then
+		log "Marking host ${host} as done."
+		"$queue_tool" "$queue" done "$host"
+	else
+		err "Probing host ${host} failed."
+		"$queue_tool" "$queue" fail "$host" --worker "$worker"
+	fi
 fi
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# An on-disk cache for the analysis results of .pcap files.  Every capture gets
+# one cache entry which is addressed either by the file's content hash or by
+# its device, inode, size and modification time.  Entries are evicted in
+# least-recently-used order once the cache grows beyond its size limit.
+
+import os
+import errno
+import hashlib
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Bump this whenever the format of cache entries changes.
+CACHE_VERSION = 2
+
+# Default upper limit for the cache's size in bytes.
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+class ResultCache( object ):
+
+    """
+    Maps .pcap files to a dictionary of previously computed results.
+    """
+
+    def __init__( self, directory, max_size=DEFAULT_MAX_SIZE,
+                  hash_content=False ):
+
+        self.directory = directory
+        self.max_size = max_size
+        self.hash_content = hash_content
+
+        try:
+            os.makedirs(directory)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def get_key( self, file_name ):
+        """
+        Return the cache key of the given file.
+        """
+
+        digest = hashlib.sha1()
+
+        if self.hash_content:
+            with open(file_name, "rb") as fd:
+                for block in iter(lambda: fd.read(1024 * 1024), b""):
+                    digest.update(block)
+        else:
+            st = os.stat(file_name)
+            digest.update(("%d:%d:%d:%r" % (st.st_dev, st.st_ino, st.st_size,
+                                            st.st_mtime)).encode("ascii"))
+
+        return "%s-v%d" % (digest.hexdigest(), CACHE_VERSION)
+
+    def get_path( self, key ):
+
+        return os.path.join(self.directory, key + ".entry")
+
+    def load( self, key ):
+        """
+        Return the cache entry for the given key or None if there is none.
+        """
+
+        path = self.get_path(key)
+
+        try:
+            with open(path, "rb") as fd:
+                entry = pickle.load(fd)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        # Mark the entry as recently used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return entry
+
+    def store( self, key, entry ):
+        """
+        Atomically write the given entry, so concurrent workers never see
+        half-written files.
+        """
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as tmp_fd:
+                pickle.dump(entry, tmp_fd, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.get_path(key))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def evict( self ):
+        """
+        Delete the least recently used entries until the cache fits into its
+        size limit.  Returns the number of deleted entries.
+        """
+
+        entries = []
+        total_size = 0
+
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".entry"):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total_size += st.st_size
+
+        entries.sort()
+        evicted = 0
+
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+            evicted += 1
+
+        return evicted
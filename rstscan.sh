@@ -4,6 +4,7 @@
 
 source log.sh
 source config.sh
+source scan.sh
 
 # The amount of (unspoofed) TCP SYNs used to estimate the destination's backlog
 # size.
@@ -13,12 +14,6 @@ control_syns=10
 # more than 50%.
 probing_syns=145
 
-# How long we should wait for SYN/ACKs after sending data.  65 is a reasonable
-# value given 5 SYN/ACK retransmissions and exponential backoff in between
-# segments.  After 65 seconds, our SYNs should no longer be in the destinations
-# backlog.
-timeout=65
-
 if [ "$#" -lt 3 ]
 then
 	echo
@@ -41,7 +36,7 @@ fi
 log "Beginning RST probing."
 
 log "Invoking tcpdump(8) to capture network data."
-tcpdump -i any -n "host ${dst_addr}" -w "${outfile}" &
+tcpdump -i any -n -U "host ${dst_addr}" -w "${outfile}" &
 pid=$!
 
 # Give tcpdump some time to start.
@@ -83,11 +78,4 @@ then
 	iptables -D OUTPUT -d ${dst_addr} -p tcp --tcp-flags RST RST -j DROP
 fi
 
-log "Terminating tcpdump."
-if [ ! -z "$pid" ]
-then
-	kill "$pid"
-	log "Sent SIGTERM to tcpdump's PID ${pid}."
-fi
-
-log "Experimental results written to: ${outfile}"
+stop_capture "$pid" "$outfile"
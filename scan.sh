@@ -0,0 +1,57 @@
+#!/bin/bash
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Settings and functions shared by synscan.sh and rstscan.sh.  Requires log.sh
+# and config.sh to be sourced first.
+
+# hping3(8) runs under timeout(1), so our last segment is sent at most this
+# many seconds after the last invocation of hping3(8).
+send_duration=5
+
+# Upper bound, in seconds after a SYN, of the last SYN/ACK retransmission it
+# triggers.  This is the last interval of BACKOFF_MODEL in
+# count_retransmissions.py.
+max_backoff=33
+
+# How long we should wait for SYN/ACKs after sending data.  65 is a reasonable
+# value given 5 SYN/ACK retransmissions and exponential backoff in between
+# segments.  After 65 seconds, our SYNs should no longer be in the destinations
+# backlog.  With early_stop, we only wait until the last retransmission caused
+# by our last segment arrived, plus some slack for the round trip.  Both
+# probers shorten their scans by the same amount, so they stay in sync as long
+# as both use the same setting.
+if [ "$early_stop" = "yes" ]
+then
+	timeout=$(($send_duration + $max_backoff + 4))
+else
+	timeout=65
+fi
+
+# Terminate the tcpdump(8) with the given PID and check the given capture.  A
+# tcpdump(8) which is no longer running or an empty capture means that the scan
+# failed, in which case we return 1.
+stop_capture() {
+	local pid="$1"
+	local outfile="$2"
+	local status=0
+
+	log "Terminating tcpdump."
+	if [ ! -z "$pid" ] && kill "$pid"
+	then
+		log "Sent SIGTERM to tcpdump's PID ${pid}."
+	else
+		err "tcpdump(8) was no longer running."
+		status=1
+	fi
+
+	if [ -s "$outfile" ]
+	then
+		log "Experimental results written to: ${outfile}"
+	else
+		err "No experimental results in: ${outfile}"
+		status=1
+	fi
+
+	return "$status"
+}
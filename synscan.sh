@@ -10,6 +10,7 @@
 
 source log.sh
 source config.sh
+source scan.sh
 
 # The amount of TCP SYNs used to estimate the destination's backlog size.
 if [ $prober_type = "censored" ]
@@ -19,12 +20,6 @@ else
 	control_syns=10
 fi
 
-# How long we should wait for SYN/ACKs after sending data.  65 is a reasonable
-# value given 5 SYN/ACK retransmissions and exponential backoff in between
-# segments.  After 65 seconds, our SYNs should no longer be in the destinations
-# backlog.
-timeout=65
-
 if [ "$#" -lt 2 ]
 then
 	echo
@@ -48,7 +43,7 @@ log "Setting iptables rules to ignore RST segments."
 iptables -A OUTPUT -d ${dst_addr} -p tcp --tcp-flags RST RST -j DROP
 
 log "Invoking tcpdump(8) to capture network data."
-tcpdump -i any -n "host ${dst_addr} and port ${port}" -w "${outfile}" &
+tcpdump -i any -n -U "host ${dst_addr} and port ${port}" -w "${outfile}" &
 pid=$!
 
 # Give tcpdump some time to start.
@@ -72,11 +67,4 @@ fi
 log "Removing iptables rule."
 iptables -D OUTPUT -d ${dst_addr} -p tcp --tcp-flags RST RST -j DROP
 
-log "Terminating tcpdump."
-if [ ! -z "$pid" ]
-then
-	kill "$pid"
-	log "Sent SIGTERM to PID ${pid}."
-fi
-
-log "Experimental results written to: ${outfile}"
+stop_capture "$pid" "$outfile"
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# A persistent queue of IP:port targets, kept in an SQLite database.  Every
+# target is pending, in-flight, done or failed.  A worker claims the pending
+# target which was imported first, which leases it to the worker for a while,
+# and reports it done or failed after probing it.  Targets whose lease ran
+# out, e.g., because the worker crashed, count as failed.  Failed targets are
+# never handed out again during a campaign, so that the censored and the
+# uncensored prober keep claiming the same sequence of targets.  They can be
+# requeued for another campaign instead.  Works with Python 2 and 3.
+
+import re
+import sys
+import time
+import socket
+import sqlite3
+import argparse
+
+PENDING = "pending"
+IN_FLIGHT = "in-flight"
+DONE = "done"
+FAILED = "failed"
+
+STATES = [PENDING, IN_FLIGHT, DONE, FAILED]
+
+# Default number of seconds a claimed target stays leased to its worker.
+DEFAULT_LEASE = 600
+
+# Default number of attempts after which a failed target is no longer
+# requeued.
+DEFAULT_MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS targets (
+    id INTEGER PRIMARY KEY,
+    addr TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expiry REAL,
+    updated REAL,
+    UNIQUE (addr, port)
+);
+CREATE INDEX IF NOT EXISTS targets_state ON targets (state, id);
+CREATE INDEX IF NOT EXISTS targets_lease ON targets (state, lease_expiry);
+"""
+
+def parse_target( line, port=None ):
+    """
+    Return the (IP address, port) tuple of the given line, which is either an
+    IP:port tuple as written by get_relays.sh or a plain IP address, which is
+    then combined with the given port.
+    """
+
+    match = re.match(r"^([0-9.]+)(?::([0-9]+))?$", line)
+    if not match:
+        raise ValueError("Invalid target `%s'." % line)
+
+    addr, target_port = match.groups()
+    try:
+        socket.inet_aton(addr)
+    except socket.error:
+        raise ValueError("Invalid IP address `%s'." % addr)
+
+    if target_port is None:
+        if port is None:
+            raise ValueError("Target `%s' lacks a port." % line)
+        target_port = port
+
+    target_port = int(target_port)
+    if not (0 < target_port < 65536):
+        raise ValueError("Invalid port in target `%s'." % line)
+
+    return addr, target_port
+
+class TargetQueue( object ):
+
+    """
+    Hands out the targets of an SQLite database to one or more workers.
+    """
+
+    def __init__( self, file_name ):
+
+        # Autocommit mode, so that every transaction is begun explicitly.
+        self.db = sqlite3.connect(file_name, timeout=60,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(SCHEMA)
+
+    def close( self ):
+
+        self.db.close()
+
+    def transaction( self ):
+        """
+        Begin a transaction which holds the database's write lock right away,
+        so that concurrent workers never claim the same target.
+        """
+
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def add( self, targets ):
+        """
+        Add the given (IP address, port) tuples and return how many were new.
+        Targets which are already in the queue keep their state.
+        """
+
+        now = time.time()
+
+        self.transaction()
+        try:
+            before = self.db.execute("SELECT COUNT(*) FROM "
+                                     "targets").fetchone()[0]
+            self.db.executemany("INSERT OR IGNORE INTO targets (addr, port, "
+                                "updated) VALUES (?, ?, ?)",
+                                ((addr, port, now) for addr, port in targets))
+            after = self.db.execute("SELECT COUNT(*) FROM "
+                                    "targets").fetchone()[0]
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+        return after - before
+
+    def expire_leases( self, now ):
+        """
+        Mark targets whose lease ran out as failed.
+        """
+
+        self.db.execute("UPDATE targets SET state = ?, worker = NULL, "
+                        "lease_expiry = NULL, updated = ? WHERE state = ? "
+                        "AND lease_expiry < ?", (FAILED, now, IN_FLIGHT, now))
+
+    def claim( self, worker, lease=DEFAULT_LEASE ):
+        """
+        Lease the next pending target to the given worker and return its (IP
+        address, port) tuple, or None if no target is pending.
+        """
+
+        now = time.time()
+
+        self.transaction()
+        try:
+            self.expire_leases(now)
+            row = self.db.execute("SELECT id, addr, port FROM targets WHERE "
+                                  "state = ? ORDER BY id LIMIT 1",
+                                  (PENDING,)).fetchone()
+            if row is not None:
+                self.db.execute("UPDATE targets SET state = ?, attempts = "
+                                "attempts + 1, worker = ?, lease_expiry = ?, "
+                                "updated = ? WHERE id = ?",
+                                (IN_FLIGHT, worker, now + lease, now, row[0]))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+        return None if row is None else (row[1], row[2])
+
+    def finish( self, target ):
+        """
+        Mark the given target as done and return True if it was in the queue.
+        The result counts even if the target's lease ran out in the meantime.
+        """
+
+        cursor = self.db.execute("UPDATE targets SET state = ?, worker = "
+                                 "NULL, lease_expiry = NULL, updated = ? "
+                                 "WHERE addr = ? AND port = ?",
+                                 (DONE, time.time()) + tuple(target))
+
+        return cursor.rowcount > 0
+
+    def fail( self, target, worker=None ):
+        """
+        Mark the given target as failed and return True if the given worker
+        still held its lease.
+        """
+
+        query = "UPDATE targets SET state = ?, worker = NULL, lease_expiry " \
+                "= NULL, updated = ? WHERE addr = ? AND port = ? AND state = ?"
+        params = (FAILED, time.time()) + tuple(target) + (IN_FLIGHT,)
+        if worker is not None:
+            query += " AND worker = ?"
+            params += (worker,)
+
+        return self.db.execute(query, params).rowcount > 0
+
+    def requeue( self, max_attempts=DEFAULT_MAX_ATTEMPTS ):
+        """
+        Make failed targets which were attempted fewer than `max_attempts'
+        times pending again and return how many there were.
+        """
+
+        cursor = self.db.execute("UPDATE targets SET state = ?, updated = ? "
+                                 "WHERE state = ? AND attempts < ?",
+                                 (PENDING, time.time(), FAILED, max_attempts))
+
+        return cursor.rowcount
+
+    def count( self ):
+        """
+        Return a dictionary mapping every state to its number of targets.
+        """
+
+        counts = dict([(state, 0) for state in STATES])
+        counts.update(self.db.execute("SELECT state, COUNT(*) FROM targets "
+                                      "GROUP BY state").fetchall())
+
+        return counts
+
+def read_targets( file_name, port=None ):
+    """
+    Yield the (IP address, port) tuples of the given file, which holds one
+    target per line.
+    """
+
+    with open(file_name) as fd:
+        for line in fd:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield parse_target(line, port)
+
+def parse_arguments( ):
+
+    parser = argparse.ArgumentParser(description="Manage a persistent queue "
+                                     "of IP:port targets.")
+
+    parser.add_argument("queue", metavar="QUEUE_FILE",
+                        help="SQLite database holding the queue.")
+
+    parser.add_argument("command", metavar="COMMAND",
+                        choices=["import", "claim", "done", "fail", "status",
+                                 "requeue"],
+                        help="One of `import', `claim', `done', `fail', "
+                             "`status' and `requeue'.")
+
+    parser.add_argument("argument", metavar="ARGUMENT", nargs="?",
+                        help="The file to import or the IP:port target which "
+                             "is done or failed.")
+
+    parser.add_argument("-p", "--port", metavar="PORT", type=int,
+                        default=None,
+                        help="Port of imported targets which are plain IP "
+                             "addresses.")
+
+    parser.add_argument("-w", "--worker", metavar="NAME", type=str,
+                        default=None,
+                        help="Name of the worker which claims targets "
+                             "(default: the host name).")
+
+    parser.add_argument("-l", "--lease", metavar="SECONDS", type=float,
+                        default=DEFAULT_LEASE,
+                        help="How long a claimed target stays leased to its "
+                             "worker (default: %d)." % DEFAULT_LEASE)
+
+    parser.add_argument("-m", "--max-attempts", metavar="NUM", type=int,
+                        default=DEFAULT_MAX_ATTEMPTS,
+                        help="Only requeue failed targets which were "
+                             "attempted fewer times (default: %d)." %
+                             DEFAULT_MAX_ATTEMPTS)
+
+    args = parser.parse_args()
+
+    if args.command in ["import", "done", "fail"] and not args.argument:
+        parser.error("Command `%s' requires an argument." % args.command)
+
+    return args
+
+def main( ):
+
+    args = parse_arguments()
+
+    worker = args.worker or socket.gethostname()
+
+    try:
+        queue = TargetQueue(args.queue)
+    except sqlite3.Error as err:
+        sys.stderr.write("Could not open queue `%s': %s\n" % (args.queue, err))
+        return 1
+
+    try:
+        if args.command == "import":
+            added = queue.add(read_targets(args.argument, args.port))
+            sys.stderr.write("Added %d targets to `%s'.\n" %
+                             (added, args.queue))
+
+        elif args.command == "claim":
+            target = queue.claim(worker, args.lease)
+            if target is None:
+                return 1
+            sys.stdout.write("%s:%d\n" % target)
+
+        elif args.command == "done":
+            if not queue.finish(parse_target(args.argument)):
+                sys.stderr.write("Target `%s' is not in the queue.\n" %
+                                 args.argument)
+                return 1
+
+        elif args.command == "fail":
+            if not queue.fail(parse_target(args.argument), worker):
+                sys.stderr.write("Target `%s' is not leased to us.\n" %
+                                 args.argument)
+                return 1
+
+        elif args.command == "requeue":
+            sys.stderr.write("Requeued %d failed targets.\n" %
+                             queue.requeue(args.max_attempts))
+
+        else:
+            counts = queue.count()
+            for state in STATES:
+                sys.stdout.write("%-10s %d\n" % (state, counts[state]))
+
+    except (IOError, ValueError, sqlite3.Error) as err:
+        sys.stderr.write("%s\n" % err)
+        return 1
+
+    finally:
+        queue.close()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Compares the lookups of plotting/geo_index.py with a linear scan over the
+# rows of random geolocation CSV files, whose exact addresses, CIDR prefixes
+# and ranges overlap in all possible ways.
+
+import os
+import sys
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "plotting"))
+
+import geo_index
+
+# All rows fall into 10.0.0.0/22, so that they overlap a lot.
+BASE = geo_index.ip_to_int("10.0.0.0")
+SPACE = 1024
+
+def int_to_ip( addr ):
+
+    return socket.inet_ntoa(struct.pack("!I", addr))
+
+def random_field( rand ):
+    """
+    Return a random exact address, CIDR prefix or first-last range and its
+    first and last address.
+    """
+
+    kind = rand.randint(0, 2)
+
+    if kind == 0:
+        addr = BASE + rand.randrange(SPACE)
+        return int_to_ip(addr), addr, addr
+
+    if kind == 1:
+        host_bits = rand.randint(1, 8)
+        size = 1 << host_bits
+        first = BASE + rand.randrange(SPACE / size) * size
+        return "%s/%d" % (int_to_ip(first), 32 - host_bits), \
+               first, first + size - 1
+
+    first = BASE + rand.randrange(SPACE)
+    last = min(first + rand.randint(1, 300), BASE + SPACE - 1)
+    return "%s-%s" % (int_to_ip(first), int_to_ip(last)), first, last
+
+def write_csv( file_name, rows, rand ):
+    """
+    Write the given number of random rows and return them as (first, last,
+    [latitude, longitude, region, type]) tuples.
+    """
+
+    written = []
+
+    with open(file_name, "w") as fd:
+        for i in xrange(rows):
+            field, first, last = random_field(rand)
+            location = [float(rand.randint(-90, 90)),
+                        float(rand.randint(-180, 180)),
+                        "region%d" % i, rand.choice(["PlanetLab", "VPS"])]
+            fd.write('"%s",%.1f,%.1f,"%s","%s"\n' % tuple([field] + location))
+            written.append((first, last, location))
+
+    return written
+
+def linear_lookup( rows, addr ):
+    """
+    Return the location of the given address by scanning all rows.  The first
+    row with the exact address wins, then the smallest containing range and,
+    of equally small ranges, the one which starts later.
+    """
+
+    for first, last, location in rows:
+        if first == last == addr:
+            return location
+
+    best = None
+    for i, (first, last, location) in enumerate(rows):
+        if first == last or not first <= addr <= last:
+            continue
+        key = (last - first, -first, i)
+        if best is None or key < best[0]:
+            best = (key, location)
+
+    return None if best is None else best[1]
+
+class TestGeoIndex( unittest.TestCase ):
+
+    def setUp( self ):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown( self ):
+
+        shutil.rmtree(self.directory)
+
+    def test_flatten_partial_overlap( self ):
+
+        self.assertEqual(geo_index.flatten_ranges([(0, 10, "A"),
+                                                   (5, 20, "B")]),
+                         [(0, 10, "A"), (11, 20, "B")])
+        self.assertEqual(geo_index.flatten_ranges([(0, 20, "A"),
+                                                   (5, 10, "B")]),
+                         [(0, 4, "A"), (5, 10, "B"), (11, 20, "A")])
+
+    def test_lookup( self ):
+
+        rand = random.Random(0)
+
+        for i in xrange(20):
+            csv_file = os.path.join(self.directory, "locations%d.csv" % i)
+            rows = write_csv(csv_file, rand.randint(1, 60), rand)
+            index = geo_index.GeoIndex(geo_index.build_index(csv_file))
+
+            # Include addresses just outside of all rows.
+            for addr in xrange(BASE - 2, BASE + SPACE + 2):
+                self.assertEqual(index.lookup(int_to_ip(addr)),
+                                 linear_lookup(rows, addr),
+                                 "Lookup of %s in `%s' differs." %
+                                 (int_to_ip(addr), csv_file))
+
+    def test_open_index( self ):
+
+        csv_file = os.path.join(self.directory, "locations.csv")
+        rows = write_csv(csv_file, 50, random.Random(1))
+
+        index = geo_index.open_index(csv_file)
+        self.assertTrue(os.path.exists(csv_file + geo_index.INDEX_SUFFIX))
+
+        for addr in xrange(BASE, BASE + SPACE):
+            self.assertEqual(index.lookup(int_to_ip(addr)),
+                             linear_lookup(rows, addr))
+
+if __name__ == "__main__":
+    unittest.main()
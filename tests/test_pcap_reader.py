@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Compares the raw pcap and pcapng decoders of pcap_reader.py with the scapy
+# fallback of count_retransmissions.py on synthetic backlog scan captures, in
+# both byte orders.
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import synthetic
+import pcap_reader
+import count_retransmissions
+
+LINKTYPE_LINUX_SLL = 113
+
+def get_frames( seed=0, targets=2 ):
+    """
+    Return a time-sorted list of (timestamp, frame) tuples of synthetic scans
+    which mix SYNs, SYN/ACKs and RSTs.
+    """
+
+    records = []
+    for i in xrange(targets):
+        records.extend(synthetic.generate_scan(syns=20, rsts=(i % 2 == 1),
+                                               seed=seed + i,
+                                               target=("192.0.2.%d" % (i + 1),
+                                                       443)))
+    records.sort()
+
+    return [(ts, record[16:]) for ts, record in records]
+
+def write_pcap( file_name, frames, endian, nsec=False ):
+
+    magic = pcap_reader.MAGIC_NSEC if nsec else pcap_reader.MAGIC_USEC
+    units = 10 ** 9 if nsec else 10 ** 6
+
+    with open(file_name, "wb") as fd:
+        fd.write(struct.pack(endian + "IHHiIII", magic, 2, 4, 0, 0, 65535,
+                             LINKTYPE_LINUX_SLL))
+        for ts, frame in frames:
+            sec, frac = divmod(int(round(ts * units)), units)
+            fd.write(struct.pack(endian + "IIII", sec, frac, len(frame),
+                                 len(frame)) + frame)
+
+def pack_block( endian, block_type, body ):
+
+    body += b"\0" * (-len(body) % 4)
+    length = len(body) + 12
+
+    return struct.pack(endian + "II", block_type, length) + body + \
+           struct.pack(endian + "I", length)
+
+def write_pcapng( file_name, frames, endian ):
+
+    blocks = [pack_block(endian, pcap_reader.PCAPNG_SHB,
+                         struct.pack(endian + "IHHq",
+                                     pcap_reader.PCAPNG_BYTE_ORDER_MAGIC, 1,
+                                     0, -1)),
+              pack_block(endian, pcap_reader.PCAPNG_IDB,
+                         struct.pack(endian + "HHI", LINKTYPE_LINUX_SLL, 0,
+                                     65535))]
+
+    for ts, frame in frames:
+        units = int(round(ts * 10 ** 6))
+        blocks.append(pack_block(endian, pcap_reader.PCAPNG_EPB,
+                                 struct.pack(endian + "IIIII", 0, units >> 32,
+                                             units & 0xffffffff, len(frame),
+                                             len(frame)) + frame))
+
+    with open(file_name, "wb") as fd:
+        fd.write(b"".join(blocks))
+
+class TestDecoders( unittest.TestCase ):
+
+    def setUp( self ):
+
+        self.directory = tempfile.mkdtemp()
+        self.frames = get_frames()
+
+    def tearDown( self ):
+
+        shutil.rmtree(self.directory)
+
+    def assertSameSegments( self, file_name ):
+        """
+        Check that the raw parser and scapy find the same segments.
+        """
+
+        raw = list(pcap_reader.read_segments(file_name))
+        dissected = list(count_retransmissions.read_packets(file_name))
+
+        self.assertTrue(len(raw) > 0)
+        self.assertEqual(len(raw), len(dissected))
+        for raw_segment, segment in zip(raw, dissected):
+            self.assertAlmostEqual(raw_segment.time, segment.time, places=5)
+            self.assertEqual(tuple(raw_segment)[1:], tuple(segment)[1:])
+
+        return raw
+
+    def test_pcap( self ):
+
+        segments = {}
+        for endian, nsec in [("<", False), (">", False), ("<", True),
+                             (">", True)]:
+            file_name = os.path.join(self.directory, "scan.pcap")
+            write_pcap(file_name, self.frames, endian, nsec)
+            segments[(endian, nsec)] = self.assertSameSegments(file_name)
+
+        # Byte order and resolution must not change what we decode.
+        self.assertEqual(segments[("<", False)], segments[(">", False)])
+
+    def test_pcapng( self ):
+
+        segments = {}
+        for endian in ["<", ">"]:
+            file_name = os.path.join(self.directory, "scan.pcapng")
+            write_pcapng(file_name, self.frames, endian)
+            segments[endian] = self.assertSameSegments(file_name)
+
+        self.assertEqual(segments["<"], segments[">"])
+
+    def test_prefilter( self ):
+
+        file_name = os.path.join(self.directory, "scan.pcap")
+        write_pcap(file_name, self.frames, "<")
+
+        flags = set([segment.flags
+                     for segment in pcap_reader.read_segments(file_name)])
+
+        # The RSTs of the RST scan are dropped, SYNs and SYN/ACKs are kept.
+        self.assertEqual(flags, set(pcap_reader.PREFILTER_FLAGS))
+
+    def test_truncated( self ):
+
+        file_name = os.path.join(self.directory, "scan.pcap")
+        write_pcap(file_name, self.frames[:-1], "<")
+        expected = list(pcap_reader.read_segments(file_name))
+
+        # tcpdump may be killed in the middle of writing a record.
+        write_pcap(file_name, self.frames, "<")
+        with open(file_name, "r+b") as fd:
+            fd.truncate(os.path.getsize(file_name) - 10)
+
+        self.assertEqual(list(pcap_reader.read_segments(file_name)),
+                         expected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Philipp Winter <phw@nymity.ch>
+#
+# Evaluates the verdicts of count_retransmissions.py over a grid of time
+# thresholds, mean thresholds and required SYN/ACK counts.  Every capture is
+# parsed only once into a compact table with one row per connection.  All grid
+# points are then evaluated on that table, which makes it cheap to calibrate
+# the thresholds on a whole data set.
+
+import sys
+import csv
+import time
+import array
+import argparse
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import result_cache
+import count_retransmissions
+
+VERDICTS = ["SYN", "!SYN", "RST", "!RST", "ERR"]
+
+class ScanTable( object ):
+
+    """
+    Holds the connections of many backlog scans in parallel typed arrays.
+
+    Row i represents a SYN of the scan scans[scan_ids[i]] which was sent at
+    syn_times[i] and received syn_ack_counts[i] SYN/ACKs.  starts[j] is the
+    time of the first SYN of scan j.
+    """
+
+    def __init__( self ):
+
+        # (file name, target, scan type) tuples.
+        self.scans = []
+        self.starts = array.array("d")
+
+        self.scan_ids = array.array("L")
+        self.syn_times = array.array("d")
+        self.syn_ack_counts = array.array("L")
+
+    def __len__( self ):
+        return len(self.scans)
+
+    def add_scan( self, file_name, target, scan_type, syn_times,
+                  syn_ack_counts ):
+
+        scan_id = len(self.scans)
+
+        self.scans.append((file_name, target, scan_type))
+        self.starts.append(min(syn_times) if len(syn_times) else 0.0)
+
+        self.scan_ids.extend([scan_id] * len(syn_times))
+        self.syn_times.extend(syn_times)
+        self.syn_ack_counts.extend(syn_ack_counts)
+
+def get_scans( args ):
+    """
+    Return a list of (target, scan type, SYN times, SYN/ACK counts) tuples for
+    every target in the given capture.  This is executed in a worker process.
+    """
+
+    file_name, cache = args
+
+    try:
+        tables = count_retransmissions.load_tables(file_name, cache)
+    except Exception as err:
+        print >> sys.stderr, "Could not analyse `%s': %s" % (file_name, err)
+        return (file_name, None)
+
+    scan_type = count_retransmissions.get_scan_type(file_name)
+
+    # Just like analyse_targets(), count a scan without SYNs as ERR.
+    if not tables:
+        return (file_name, [(count_retransmissions.get_target(file_name),
+                             scan_type, array.array("d"), array.array("L"))])
+
+    return (file_name, [(target, scan_type, tables[target].syn_times,
+                         tables[target].syn_ack_counts)
+                        for target in sorted(tables.keys())])
+
+def build_table( directory, processes=None, cache=None ):
+    """
+    Parse all captures underneath the given directory in parallel and return
+    their connections as a ScanTable.
+    """
+
+    table = ScanTable()
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+
+    jobs = [(file_name, cache)
+            for file_name in count_retransmissions.find_pcaps(directory)]
+    for file_name, scans in pool.imap(get_scans, jobs, chunksize=4):
+        for scan in scans or []:
+            table.add_scan(file_name, *scan)
+
+    pool.close()
+    pool.join()
+
+    if cache is not None:
+        cache.evict()
+
+    return table
+
+def count_verdicts( err, dropped, is_rst ):
+    """
+    Count the verdicts of all scans for every mean threshold.  `err' and
+    `is_rst' hold one boolean per scan, `dropped' one row per scan and one
+    column per mean threshold.
+    """
+
+    dropped = dropped & ~err[:, numpy.newaxis]
+    syn_scans = (~err & ~is_rst).sum()
+    rst_scans = (~err & is_rst).sum()
+
+    syn_drops = dropped[~is_rst].sum(axis=0)
+    rst_drops = dropped[is_rst].sum(axis=0)
+
+    return [{"SYN": int(syn_drop),
+             "!SYN": int(syn_scans - syn_drop),
+             "RST": int(rst_scans - rst_drop),
+             "!RST": int(rst_drop),
+             "ERR": int(err.sum())}
+            for syn_drop, rst_drop in zip(syn_drops, rst_drops)]
+
+def evaluate_grid( table, time_thresholds, mean_thresholds,
+                   required_synacks ):
+    """
+    Return a list of (time threshold, mean threshold, required SYN/ACKs,
+    verdict counts) tuples, one for every point of the grid.
+
+    For every time threshold, the connections are split into backlog scan and
+    original backlog once.  All mean thresholds are then decided at once.
+    """
+
+    if numpy is None:
+        return evaluate_grid_scalar(table, time_thresholds, mean_thresholds,
+                                    required_synacks)
+
+    to_ndarray = count_retransmissions.to_ndarray
+
+    scan_ids = to_ndarray(table.scan_ids).astype(numpy.intp)
+    syn_times = to_ndarray(table.syn_times)
+    syn_ack_counts = to_ndarray(table.syn_ack_counts)
+    starts = to_ndarray(table.starts)[scan_ids]
+
+    is_rst = numpy.array([scan_type == "rst"
+                          for _, _, scan_type in table.scans], dtype=bool)
+    means_wanted = numpy.array(mean_thresholds, dtype=float)
+    scans = len(table)
+
+    grid = []
+
+    for time_threshold in time_thresholds:
+
+        # Same comparison as extract_retransmissions(), so results are
+        # identical down to the last bit.
+        in_scan = ~(syn_times > (starts + time_threshold))
+        ids = scan_ids[in_scan]
+        counts = syn_ack_counts[in_scan]
+
+        syns = numpy.bincount(ids, minlength=scans)
+        synacks = numpy.bincount(ids, weights=counts, minlength=scans)
+        means = synacks / numpy.maximum(syns, 1)
+
+        err = means == 0
+        below = means[:, numpy.newaxis] < means_wanted[numpy.newaxis, :]
+
+        for required in required_synacks:
+            has_required = numpy.bincount(ids[counts == required],
+                                          minlength=scans) > 0
+            verdicts = count_verdicts(err, below &
+                                      has_required[:, numpy.newaxis], is_rst)
+            grid.extend([(time_threshold, mean_threshold, required,
+                          verdict_counts)
+                         for mean_threshold, verdict_counts
+                         in zip(mean_thresholds, verdicts)])
+
+    return sorted(grid)
+
+def evaluate_grid_scalar( table, time_thresholds, mean_thresholds,
+                          required_synacks ):
+    """
+    Evaluate the grid by running analyse_retransmissions() for every scan and
+    grid point.  This is slow and only used if NumPy is missing.
+    """
+
+    connections = [[] for _ in xrange(len(table))]
+    for row in xrange(len(table.scan_ids)):
+        connections[table.scan_ids[row]].append((table.syn_times[row],
+                                                 table.syn_ack_counts[row]))
+
+    grid = []
+
+    for time_threshold in time_thresholds:
+
+        scan_retrans = []
+        for scan_id, rows in enumerate(connections):
+            start = table.starts[scan_id]
+            scan_retrans.append([int(count) for syn_time, count in rows
+                                 if not syn_time > (start + time_threshold)])
+
+        for mean_threshold in mean_thresholds:
+            for required in required_synacks:
+                counts = dict((verdict, 0) for verdict in VERDICTS)
+                for scan_id, retrans in enumerate(scan_retrans):
+                    verdict, _ = count_retransmissions.analyse_retransmissions(
+                                    [], retrans, table.scans[scan_id][2],
+                                    False, mean_threshold, required)
+                    counts[verdict] += 1
+                grid.append((time_threshold, mean_threshold, required,
+                             counts))
+
+    return sorted(grid)
+
+def parse_values( spec, convert=float ):
+    """
+    Parse a list of grid values which is either given as comma-separated
+    values, e.g., "1,2,4", or as an inclusive range, e.g., "0.5:3:0.25".
+    """
+
+    if ":" not in spec:
+        return sorted(set([convert(value) for value in spec.split(",")]))
+
+    start, stop, step = [convert(value) for value in spec.split(":")]
+    if step <= 0 or stop < start:
+        raise ValueError("Invalid range `%s'." % spec)
+
+    steps = int(round((stop - start) / float(step)))
+
+    return [convert(round(start + i * step, 6)) for i in xrange(steps + 1)]
+
+def write_grid( grid, scans, output_file ):
+
+    with open(output_file, "w") as fd:
+        writer = csv.writer(fd, delimiter="\t", lineterminator="\n")
+        writer.writerow(["time_threshold", "mean_threshold",
+                         "required_synacks", "scans"] + VERDICTS)
+        for time_threshold, mean_threshold, required, counts in grid:
+            writer.writerow([time_threshold, mean_threshold, required,
+                             scans] + [counts[verdict]
+                                       for verdict in VERDICTS])
+
+def parse_arguments( ):
+
+    parser = argparse.ArgumentParser(description="Evaluate the verdicts of "
+                                     "all backlog scans in a directory for "
+                                     "a grid of thresholds.")
+
+    parser.add_argument("directory", metavar="DIRECTORY",
+                        help="The directory written to by "
+                             "probing_wrapper.sh.")
+
+    parser.add_argument("-t", "--time-thresholds", metavar="VALUES",
+                        type=str, default="0.5:3:0.25",
+                        help="Time thresholds in seconds, given as "
+                             "comma-separated values or as START:STOP:STEP "
+                             "(default: 0.5:3:0.25).")
+
+    parser.add_argument("-M", "--mean-thresholds", metavar="VALUES",
+                        type=str, default="2:5:0.25",
+                        help="Mean thresholds, given like --time-thresholds "
+                             "(default: 2:5:0.25).")
+
+    parser.add_argument("-n", "--required-synacks", metavar="VALUES",
+                        type=str, default="1:6:1",
+                        help="Required SYN/ACK counts, given like "
+                             "--time-thresholds (default: 1:6:1).")
+
+    parser.add_argument("-o", "--output", metavar="OUTPUT_FILE", type=str,
+                        default="sweep.tsv",
+                        help="Where to write the verdict counts of every grid "
+                             "point to (default: sweep.tsv).")
+
+    parser.add_argument("-j", "--jobs", metavar="NUM", type=int, default=None,
+                        help="Number of worker processes which parse "
+                             "captures (default: number of CPUs).")
+
+    parser.add_argument("-c", "--cache", metavar="CACHE_DIR", type=str,
+                        default=None,
+                        help="Share the cache of count_retransmissions.py, "
+                             "so captures are only parsed once across runs.")
+
+    parser.add_argument("-s", "--cache-size", metavar="MBYTES", type=int,
+                        default=result_cache.DEFAULT_MAX_SIZE / 1024 / 1024,
+                        help="Upper limit for the cache's size.")
+
+    parser.add_argument("-H", "--hash", action="store_true",
+                        help="Identify cached captures by content hash.")
+
+    args = parser.parse_args()
+
+    try:
+        args.time_thresholds = parse_values(args.time_thresholds)
+        args.mean_thresholds = parse_values(args.mean_thresholds)
+        args.required_synacks = parse_values(args.required_synacks, int)
+    except ValueError as err:
+        parser.error(str(err))
+
+    return args
+
+def main( ):
+
+    args = parse_arguments()
+
+    cache = None
+    if args.cache:
+        cache = result_cache.ResultCache(args.cache,
+                                         args.cache_size * 1024 * 1024,
+                                         args.hash)
+
+    started = time.time()
+    table = build_table(args.directory, args.jobs, cache)
+    parsed = time.time()
+
+    grid = evaluate_grid(table, args.time_thresholds, args.mean_thresholds,
+                         args.required_synacks)
+    write_grid(grid, len(table), args.output)
+
+    print "Parsed %d scans with %d connections in %.2fs." % \
+          (len(table), len(table.scan_ids), parsed - started)
+    print "Evaluated %d grid points in %.2fs and wrote them to `%s'." % \
+          (len(grid), time.time() - parsed, args.output)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())